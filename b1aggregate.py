@@ -0,0 +1,616 @@
+#!/usr/local/bin/python3
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+'''
+------------------------------------------------------------------------
+
+ Description:
+
+ Local aggregation of streamed security hits
+
+ Hits are stored as dictionary encoded columns so that any number of
+ pivots (per feed, user, network, etc.) can be computed exactly from a
+ single download, e.g.
+
+    agg = b1aggregate.HitAggregator([ 'feed_name', 'user', 'device_name' ])
+    agg.extend(b1r.iter_security_activity('30d'))
+    data = agg.group('feed_name', sub_keys=[ 'user', 'device_name' ],
+                     size=20)
+
+ Date Last Updated: 20261017
+
+ Todo:
+
+ Copyright (c) 2022 Chris Marrison / Infoblox
+
+ Redistribution and use in source and binary forms,
+ with or without modification, are permitted provided
+ that the following conditions are met:
+
+ 1. Redistributions of source code must retain the above copyright
+ notice, this list of conditions and the following disclaimer.
+
+ 2. Redistributions in binary form must reproduce the above copyright
+ notice, this list of conditions and the following disclaimer in the
+ documentation and/or other materials provided with the distribution.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+ "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+ LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+ FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+ COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+ INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+ BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+ LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+ CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+ LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+ ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ POSSIBILITY OF SUCH DAMAGE.
+
+------------------------------------------------------------------------
+'''
+import logging
+import array
+import collections
+import heapq
+import json
+import sys
+
+__version__ = '0.0.1'
+__author__ = 'Chris Marrison'
+__author_email__ = 'chris@infoblox.com'
+
+
+def get_path(record, path):
+    '''
+    Get value from nested dict using a dotted key path
+
+    Parameters:
+        record (dict): Hit record
+        path (str): Key path, e.g. 'user' or 'feed.name'
+
+    Returns:
+        value or None if not present
+    '''
+    value = record
+    for part in path.split('.'):
+        if isinstance(value, dict):
+            value = value.get(part)
+        else:
+            return None
+
+    return value
+
+
+def top_n(counter, size=0):
+    '''
+    Exact top-N of a Counter, ordered by count then key
+
+    Parameters:
+        counter (Counter): Counts
+        size (int): Number of entries, 0 for all
+
+    Returns:
+        List of (key, count) tuples
+    '''
+    if size and size < len(counter):
+        items = heapq.nsmallest(size, counter.items(), key=_rank)
+    else:
+        items = sorted(counter.items(), key=_rank)
+
+    return items
+
+
+def _rank(item):
+    '''
+    Sort key for top_n(), count descending then key, keys of different
+    types (such as a None key from the API) are grouped by type name
+    '''
+    key, count = item
+    return -count, type(key).__name__, key
+
+
+def change(current, previous):
+    '''
+    Period over period change of a count
+
+    Parameters:
+        current (int): Count for the current period, None if unknown
+        previous (int): Count for the previous period, None if unknown
+
+    Returns:
+        dict of current, previous, delta and change (percent rounded to
+        one decimal place, None if previous is 0), delta and change are
+        None if either count is unknown, e.g. a failed request
+    '''
+    current = None if current is None else int(current)
+    previous = None if previous is None else int(previous)
+    delta = None
+    percent = None
+    if current is not None and previous is not None:
+        delta = current - previous
+        if previous:
+            percent = round(delta * 100 / previous, 1)
+
+    return { 'current': current, 'previous': previous,
+             'delta': delta, 'change': percent }
+
+
+def compare_counts(current, previous, size=0):
+    '''
+    Per key change between two periods
+
+    Parameters:
+        current (dict): key: count for the current period
+        previous (dict): key: count for the previous period, None if
+                         unknown
+        size (int): Number of entries, 0 for all
+
+    Returns:
+        List of change() dicts with key added, ordered by current then
+        previous count, keys in only one period have a 0 count for the
+        other
+    '''
+    known = previous is not None
+    previous = previous or {}
+    keys = sorted(set(current) | set(previous),
+                  key=lambda k: (-int(current.get(k) or 0),
+                                 -int(previous.get(k) or 0), str(k)))
+    if size:
+        keys = keys[:size]
+
+    return [ dict(change(current.get(k, 0),
+                         previous.get(k, 0) if known else None), key=k)
+             for k in keys ]
+
+
+class HitAggregator:
+    '''
+    Columnar, dictionary encoded store of hit records
+
+    Each column holds an array of integer codes, code 0 is reserved for
+    missing values. String values are held once per column.
+    '''
+    def __init__(self, columns):
+        '''
+        Parameters:
+            columns (list): Key paths to keep from each record
+        '''
+        self.columns = list(columns)
+        self.rows = 0
+        self._codes = { c: array.array('I') for c in self.columns }
+        self._lookup = { c: { None: 0 } for c in self.columns }
+        self._values = { c: [ None ] for c in self.columns }
+
+        return
+
+
+    def __len__(self):
+        return self.rows
+
+
+    def add(self, record):
+        '''
+        Add a single hit record
+        '''
+        for column in self.columns:
+            value = get_path(record, column)
+            if isinstance(value, (dict, list)):
+                value = json.dumps(value, sort_keys=True)
+            lookup = self._lookup[column]
+            code = lookup.get(value)
+            if code is None:
+                code = len(self._values[column])
+                lookup[value] = code
+                self._values[column].append(value)
+            self._codes[column].append(code)
+        self.rows += 1
+
+        return
+
+
+    def extend(self, records, progress=0):
+        '''
+        Add hit records from any iterable, e.g. a streaming iterator
+
+        Parameters:
+            records (iterable): Hit records
+            progress (int): Log progress every n records
+
+        Returns:
+            Number of records added
+        '''
+        count = 0
+        for record in records:
+            self.add(record)
+            count += 1
+            if progress and count % progress == 0:
+                logging.info(f' - {count:,} hits aggregated')
+
+        return count
+
+
+    def counts(self, *columns):
+        '''
+        Count rows for each distinct combination of column values
+
+        Parameters:
+            columns (str): One or more key paths
+
+        Returns:
+            Counter keyed by value (one column) or tuple of values
+        '''
+        values = [ self._values[c] for c in columns ]
+        if len(columns) == 1:
+            coded = collections.Counter(self._codes[columns[0]])
+            result = collections.Counter({ values[0][code]: n
+                                           for code, n in coded.items() })
+        else:
+            coded = collections.Counter(zip(*[ self._codes[c]
+                                               for c in columns ]))
+            result = collections.Counter({
+                tuple(v[code] for v, code in zip(values, codes)): n
+                for codes, n in coded.items() })
+
+        return result
+
+
+    def group(self, key, sub_keys=None, size=0, sub_size=0,
+              skip_missing=True):
+        '''
+        Grouped counts in the same form as an insight aggregation
+
+        Parameters:
+            key (str): Key path to group on
+            sub_keys (list): Key paths counted within each group
+            size (int): Top-N groups to return, 0 for all
+            sub_size (int): Top-N values per sub key, 0 for all
+            skip_missing (bool): Ignore records without the key
+
+        Returns:
+            dict of form { 'results': [ { 'key': key,
+                'sub_bucket': [ { 'key': value, 'count': n,
+                  'sub_bucket': [ { 'key': sub_key,
+                    'sub_bucket': [ { 'key': value, 'count': n } ] } ] } ]
+                } ] }
+        '''
+        key_codes = self._codes[key]
+        key_values = self._values[key]
+        coded = collections.Counter(key_codes)
+        if skip_missing:
+            coded.pop(0, None)
+        top = top_n(coded, size)
+        selected = { code for code, _ in top }
+
+        sub_counts = {}
+        for sub_key in sub_keys or []:
+            pairs = collections.Counter(zip(key_codes, self._codes[sub_key]))
+            per_group = collections.defaultdict(collections.Counter)
+            for (code, sub_code), n in pairs.items():
+                if code in selected and sub_code:
+                    per_group[code][sub_code] = n
+            sub_counts[sub_key] = per_group
+
+        buckets = []
+        for code, count in top:
+            bucket = { 'key': key_values[code], 'count': count }
+            if sub_keys:
+                bucket['sub_bucket'] = []
+                for sub_key in sub_keys:
+                    sub_values = self._values[sub_key]
+                    bucket['sub_bucket'].append({ 'key': sub_key,
+                        'sub_bucket': [ { 'key': sub_values[c], 'count': n }
+                            for c, n in top_n(sub_counts[sub_key][code],
+                                              sub_size) ] })
+            buckets.append(bucket)
+
+        return { 'results': [ { 'key': key, 'sub_bucket': buckets } ] }
+
+
+    def nbytes(self):
+        '''
+        Approximate memory used by the code arrays
+        '''
+        return sum(a.itemsize * len(a) for a in self._codes.values())
+
+# End of class
+
+
+class BucketTree:
+    '''
+    Compact, indexed form of a nested aggregation response
+
+    The results[].sub_bucket tree is stored breadth first in flat arrays
+    so that the children of each node are contiguous. Keys are
+    dictionary encoded, counts held as integers (-1 where a node has no
+    count, e.g. results and sub keys). The children of a node are
+    indexed by key on first lookup, so further steps along a key path
+    are O(1) and index memory is only used for nodes searched, e.g.
+
+        tree = BucketTree.from_data(response.json())
+        feed = tree.find(tree.result(0), 'Feed X', 'user')
+        users = tree.counts(feed)
+        malware = tree.sum_matching(tree.result(0), 'Malware')
+
+    Node 0 is the root, its children are the results.
+    '''
+    ROOT = 0
+
+    def __init__(self):
+        self.parent = array.array('i', [ -1 ])
+        self.key = array.array('I', [ 0 ])
+        self.count = array.array('q', [ -1 ])
+        self.first = array.array('I', [ 1 ])
+        self.last = array.array('I', [ 1 ])
+        self.str_counts = False
+        self._values = [ None ]
+        self._lookup = { None: 0 }
+        self._index = {}
+
+        return
+
+
+    def __len__(self):
+        return len(self.parent) - 1
+
+
+    def _codes(self):
+        # Key to code lookup, dropped after building to save memory and
+        # rebuilt on first search
+        if self._lookup is None:
+            self._lookup = { v: c for c, v in enumerate(self._values) }
+
+        return self._lookup
+
+
+    def _code(self, value):
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value, sort_keys=True)
+        code = self._codes().get(value)
+        if code is None:
+            code = len(self._values)
+            self._lookup[value] = code
+            self._values.append(value)
+
+        return code
+
+
+    def _add_level(self, parents, children):
+        '''
+        Append the children of each parent node, breadth first
+
+        Parameters:
+            parents (list): Node indexes
+            children (list): For each parent a list of (key, count,
+                             sub list) tuples
+        Returns:
+            list of (node, sub list) for the next level
+        '''
+        level = []
+        for node, items in zip(parents, children):
+            self.first[node] = len(self.parent)
+            for key, count, subs in items:
+                child = len(self.parent)
+                code = self._code(key)
+                self.parent.append(node)
+                self.key.append(code)
+                self.count.append(count)
+                self.first.append(0)
+                self.last.append(0)
+                level.append((child, subs))
+            self.last[node] = len(self.parent)
+
+        return level
+
+
+    @staticmethod
+    def _items(buckets, tree):
+        items = []
+        for bucket in buckets or []:
+            count = bucket.get('count')
+            if isinstance(count, str):
+                tree.str_counts = True
+            items.append((bucket.get('key'),
+                          -1 if count is None else int(count),
+                          bucket.get('sub_bucket')))
+
+        return items
+
+
+    @classmethod
+    def from_data(cls, data):
+        '''
+        Build tree from a decoded aggregation response
+
+        Parameters:
+            data (dict): { 'results': [ { 'key': ..., 'sub_bucket': [
+                           { 'key': ..., 'count': ..., 'sub_bucket': [
+                           ... ] } ] } ] }
+        Returns:
+            BucketTree
+        '''
+        tree = cls()
+        level = [ (cls.ROOT, data.get('results') or []) ]
+        while level:
+            parents = [ node for node, _ in level ]
+            children = [ cls._items(subs, tree) for _, subs in level ]
+            level = tree._add_level(parents, children)
+        tree._lookup = None
+
+        return tree
+
+
+    def value(self, node):
+        '''
+        Key of node
+        '''
+        return self._values[self.key[node]]
+
+
+    def children(self, node=ROOT):
+        '''
+        Child node indexes of node
+        '''
+        return range(self.first[node], self.last[node])
+
+
+    def child(self, node, key):
+        '''
+        Child of node with key, -1 if not present
+        '''
+        code = self._codes().get(key)
+        if code is None or node < 0:
+            return -1
+        index = self._index.get(node)
+        if index is None:
+            index = { self.key[c]: c for c in self.children(node) }
+            self._index[node] = index
+
+        return index.get(code, -1)
+
+
+    def result(self, index=0):
+        '''
+        Node of the result for aggregation at index, -1 if not present
+        '''
+        results = self.children(self.ROOT)
+
+        return results[index] if index < len(results) else -1
+
+
+    def find(self, node, *keys):
+        '''
+        Follow a key path from node
+
+        Parameters:
+            node (int): Start node, e.g. result(0)
+            keys: Keys of each level, e.g. 'Feed X', 'user'
+
+        Returns:
+            node index or -1 if not found
+        '''
+        for key in keys:
+            if node < 0:
+                break
+            node = self.child(node, key)
+
+        return node
+
+
+    def items(self, node):
+        '''
+        (key, count) of the children of node, in response order
+        '''
+        if node < 0:
+            return []
+
+        return [ (self._values[self.key[c]], self.count[c])
+                 for c in self.children(node) ]
+
+
+    def counts(self, node):
+        '''
+        dict of key: count for the children of node
+        '''
+        return dict(self.items(node))
+
+
+    def total(self, node):
+        '''
+        Sum of the counts of the children of node
+        '''
+        if node < 0:
+            return 0
+
+        return sum([ c for c in self.count[self.first[node]:self.last[node]]
+                     if c > 0 ])
+
+
+    def sum_matching(self, node, text):
+        '''
+        Sum of the counts of children of node whose key contains text
+        '''
+        total = 0
+        if node >= 0:
+            for c in self.children(node):
+                value = self._values[self.key[c]]
+                if isinstance(value, str) and text in value:
+                    total += max(0, self.count[c])
+
+        return total
+
+
+    def to_data(self, node=ROOT):
+        '''
+        Convert back to the decoded response form
+
+        Returns:
+            dict with results, or the sub_bucket list for another node
+        '''
+        def buckets(parent):
+            result = []
+            for c in self.children(parent):
+                bucket = { 'key': self._values[self.key[c]] }
+                if self.count[c] >= 0:
+                    count = self.count[c]
+                    bucket['count'] = str(count) if self.str_counts else count
+                if self.last[c] > self.first[c]:
+                    bucket['sub_bucket'] = buckets(c)
+                result.append(bucket)
+            return result
+
+        if node == self.ROOT:
+            return { 'results': buckets(self.ROOT) }
+
+        return buckets(node)
+
+
+    def nbytes(self):
+        '''
+        Approximate memory used by the node arrays and key table
+        '''
+        arrays = sum([ a.itemsize * len(a) for a in
+                       (self.parent, self.key, self.count, self.first,
+                        self.last) ])
+
+        return (arrays + sys.getsizeof(self._lookup or {}) +
+                sys.getsizeof(self._values) +
+                sum([ sys.getsizeof(v) for v in self._values ]))
+
+
+    @classmethod
+    def merge(cls, *trees):
+        '''
+        Merge trees, e.g. for adjacent time windows
+
+        Nodes are matched on key path and counts summed, children are
+        kept in order of first appearance.
+
+        Returns:
+            BucketTree
+        '''
+        merged = cls()
+        merged.str_counts = any([ t.str_counts for t in trees ])
+        level = [ (cls.ROOT, [ (t, cls.ROOT) for t in trees ]) ]
+        while level:
+            parents = []
+            children = []
+            for node, sources in level:
+                groups = {}
+                for tree, source in sources:
+                    for c in tree.children(source):
+                        key = tree._values[tree.key[c]]
+                        if key not in groups:
+                            groups[key] = [ -1, [] ]
+                        if tree.count[c] >= 0:
+                            groups[key][0] = (max(0, groups[key][0]) +
+                                              tree.count[c])
+                        groups[key][1].append((tree, c))
+                parents.append(node)
+                children.append([ (k, g[0], g[1])
+                                  for k, g in groups.items() ])
+            level = merged._add_level(parents, children)
+        merged._lookup = None
+
+        return merged
+
+# End of class
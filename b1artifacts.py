@@ -0,0 +1,230 @@
+#!/usr/local/bin/python3
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+'''
+------------------------------------------------------------------------
+
+ Description:
+
+ Content addressed store for report artifacts
+
+ Chart images and finished documents are stored under a hash of the
+ inputs that produced them (insight data, template and report fields),
+ so a stage whose inputs are unchanged, e.g. a re-run within the
+ response cache TTL or a batch retry, reuses its earlier output rather
+ than rendering again.
+
+    store = b1artifacts.ArtifactStore('artifacts')
+    key = b1artifacts.digest('chart', keys, counts)
+    png = store.get(key)
+    if png is None:
+        png = render(keys, counts)
+        store.put(key, png)
+
+ Date Last Updated: 20261017
+
+ Todo:
+
+ Copyright (c) 2022 Chris Marrison / Infoblox
+
+ Redistribution and use in source and binary forms,
+ with or without modification, are permitted provided
+ that the following conditions are met:
+
+ 1. Redistributions of source code must retain the above copyright
+ notice, this list of conditions and the following disclaimer.
+
+ 2. Redistributions in binary form must reproduce the above copyright
+ notice, this list of conditions and the following disclaimer in the
+ documentation and/or other materials provided with the distribution.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+ "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+ LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+ FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+ COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+ INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+ BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+ LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+ CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+ LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+ ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ POSSIBILITY OF SUCH DAMAGE.
+
+------------------------------------------------------------------------
+'''
+import logging
+import hashlib
+import json
+import os
+import threading
+
+__version__ = '0.0.1'
+__author__ = 'Chris Marrison'
+__author_email__ = 'chris@infoblox.com'
+
+# Included in every digest, change to invalidate stored artifacts when
+# the rendering code changes
+FORMAT_VERSION = 1
+
+_file_digests = {}
+_file_digests_lock = threading.Lock()
+
+
+def _encode(value):
+    # Bytes (e.g. images) by their digest, other objects by str()
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(value).hexdigest()
+
+    return str(value)
+
+
+def digest(*parts):
+    '''
+    Digest of JSON serialisable inputs, dict key order is ignored, bytes
+    are included by their digest and other objects by str()
+
+    Returns:
+        SHA-256 hex digest (str)
+    '''
+    content = json.dumps([ FORMAT_VERSION, parts ], sort_keys=True,
+                         separators=(',', ':'), default=_encode)
+
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def file_digest(filename):
+    '''
+    Digest of a file's content, remembered per process until the file
+    changes (by modification time and size)
+
+    Returns:
+        SHA-256 hex digest (str)
+    '''
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    with _file_digests_lock:
+        known = _file_digests.get(path)
+    if known and known[0] == key:
+        return known[1]
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    with _file_digests_lock:
+        _file_digests[path] = (key, sha.hexdigest())
+
+    return sha.hexdigest()
+
+
+class ArtifactStore:
+    '''
+    Directory of artifacts named by digest, safe for concurrent use by
+    threads and processes
+    '''
+    def __init__(self, directory, max_size=1024 * 1024 * 1024):
+        '''
+        Parameters:
+            directory (str): Store directory, created if required
+            max_size (int): Bytes kept, least recently used artifacts
+                            are removed beyond this
+        '''
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        return
+
+
+    def path(self, key, suffix=''):
+        '''
+        File path of artifact
+        '''
+        return os.path.join(self.directory, key[:2], key + suffix)
+
+
+    def get(self, key, suffix=''):
+        '''
+        Retrieve artifact
+
+        Parameters:
+            key (str): Digest from digest()
+            suffix (str): File suffix, e.g. '.png'
+
+        Returns:
+            bytes or None
+        '''
+        path = self.path(key, suffix)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Mark as recently used
+            os.utime(path)
+        except OSError:
+            data = None
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return data
+
+
+    def put(self, key, data, suffix=''):
+        '''
+        Store artifact, replaced atomically
+
+        Parameters:
+            key (str): Digest from digest()
+            data (bytes): Content
+            suffix (str): File suffix, e.g. '.png'
+        '''
+        path = self.path(key, suffix)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as err:
+            logging.warning(f'Failed to store artifact {key}: {err}')
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        else:
+            self._evict()
+
+        return
+
+
+    def _evict(self):
+        # Remove least recently used artifacts beyond max_size
+        if not self.max_size:
+            return
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith('.tmp'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+        total = sum([ f[1] for f in files ])
+        for _, size, path in sorted(files):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+        return
+
+# End of class
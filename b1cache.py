@@ -0,0 +1,240 @@
+#!/usr/local/bin/python3
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+'''
+------------------------------------------------------------------------
+
+ Description:
+
+ Persistent on-disk response cache for the b1reporting class
+
+ Date Last Updated: 20261017
+
+ Todo:
+
+ Copyright (c) 2022 Chris Marrison / Infoblox
+
+ Redistribution and use in source and binary forms,
+ with or without modification, are permitted provided
+ that the following conditions are met:
+
+ 1. Redistributions of source code must retain the above copyright
+ notice, this list of conditions and the following disclaimer.
+
+ 2. Redistributions in binary form must reproduce the above copyright
+ notice, this list of conditions and the following disclaimer in the
+ documentation and/or other materials provided with the distribution.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+ "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+ LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+ FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+ COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+ INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+ BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+ LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+ CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+ LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+ ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ POSSIBILITY OF SUCH DAMAGE.
+
+------------------------------------------------------------------------
+'''
+import logging
+import hashlib
+import sqlite3
+import threading
+import time
+import requests
+
+__version__ = '0.0.1'
+__author__ = 'Chris Marrison'
+__author_email__ = 'chris@infoblox.com'
+
+
+class ResponseCache:
+    '''
+    SQLite backed cache of successful API responses
+
+    Entries are keyed by API key, method, URL and body. Callers snap the
+    query time window to the cache granularity so that repeated runs of
+    the same report produce identical keys.
+    '''
+    def __init__(self, filename='b1td_cache.db', ttl=86400,
+                 max_size=256 * 1024 * 1024, granularity=300,
+                 refresh=False):
+        '''
+        Open (or create) cache database
+
+        Parameters:
+            filename (str): SQLite database file
+            ttl (int): Seconds before an entry expires
+            max_size (int): Maximum total size of cached bodies in bytes,
+                            least recently used entries are evicted
+            granularity (int): Seconds to snap query time windows to,
+                               the most recent part of a window is left
+                               out, so keep this short
+            refresh (bool): Ignore cached entries, responses are still
+                            stored
+        '''
+        self.filename = filename
+        self.ttl = ttl
+        self.max_size = max_size
+        self.granularity = granularity
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, timeout=30,
+                                   check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS responses ('
+                             'key TEXT PRIMARY KEY, url TEXT, '
+                             'status INTEGER, content BLOB, '
+                             'created REAL, accessed REAL, size INTEGER)')
+        logging.debug(f'Response cache {filename} opened')
+
+        return
+
+
+    def make_key(self, api_key, method, url, body=''):
+        '''
+        Generate cache key
+
+        Parameters:
+            api_key (str): API key, keeps tenants separate
+            method (str): HTTP method
+            url (str): Full URL including query parameters
+            body (str): Request body
+
+        Returns:
+            key (str): hex digest
+        '''
+        if isinstance(body, bytes):
+            body = body.decode()
+        h = hashlib.sha256()
+        for part in [ api_key, method.upper(), url, body or '' ]:
+            h.update(part.encode())
+            h.update(b'\0')
+
+        return h.hexdigest()
+
+
+    def get(self, key, refresh=False):
+        '''
+        Retrieve cached response
+
+        Parameters:
+            key (str): Cache key from make_key()
+            refresh (bool): Ignore the cached entry for this call, e.g.
+                            for one report of several sharing the cache
+
+        Returns:
+            requests response object or None
+        '''
+        response = None
+        if refresh or self.refresh:
+            return None
+
+        now = time.time()
+        with self._lock, self._db:
+            row = self._db.execute('SELECT url, status, content, created '
+                                   'FROM responses WHERE key = ?',
+                                   (key,)).fetchone()
+            if row and now - row[3] <= self.ttl:
+                self._db.execute('UPDATE responses SET accessed = ? '
+                                 'WHERE key = ?', (now, key))
+                response = self._build_response(*row[:3])
+            elif row:
+                self._db.execute('DELETE FROM responses WHERE key = ?',
+                                 (key,))
+        if response is not None:
+            self.hits += 1
+            logging.debug(f'Cache hit: {response.url}')
+        else:
+            self.misses += 1
+
+        return response
+
+
+    def put(self, key, response):
+        '''
+        Store successful response and enforce size limit
+
+        Parameters:
+            key (str): Cache key from make_key()
+            response (obj): requests response object
+        '''
+        if not 200 <= response.status_code < 300:
+            return
+        content = response.content
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO responses '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (key, response.url, response.status_code,
+                              content, now, now, len(content)))
+            self._evict()
+
+        return
+
+
+    def _evict(self):
+        # Remove expired then least recently used entries (lock held)
+        self._db.execute('DELETE FROM responses WHERE created < ?',
+                         (time.time() - self.ttl,))
+        total = self._db.execute('SELECT COALESCE(SUM(size), 0) '
+                                 'FROM responses').fetchone()[0]
+        if total > self.max_size:
+            excess = total - self.max_size
+            stale = []
+            for key, size in self._db.execute('SELECT key, size FROM '
+                                              'responses ORDER BY accessed'):
+                stale.append((key,))
+                excess -= size
+                if excess <= 0:
+                    break
+            self._db.executemany('DELETE FROM responses WHERE key = ?',
+                                 stale)
+            logging.debug(f'Cache evicted {len(stale)} entries')
+
+        return
+
+
+    def clear(self):
+        '''
+        Remove all entries
+        '''
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM responses')
+
+        return
+
+
+    def close(self):
+        '''
+        Close cache database
+        '''
+        with self._lock:
+            self._db.close()
+
+        return
+
+
+    def _build_response(self, url, status, content):
+        '''
+        Generate a response object without an API call
+
+        The body is marked as read, so iter_content(), e.g. for a streamed
+        request answered from the cache, iterates over the content.
+        '''
+        response = requests.Response()
+        response.status_code = status
+        response._content = content
+        response._content_consumed = True
+        response.url = url
+        response.encoding = 'utf-8'
+        response.headers['Content-Type'] = 'application/json'
+
+        return response
+
+# End of class
@@ -0,0 +1,228 @@
+#!/usr/local/bin/python3
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+'''
+------------------------------------------------------------------------
+
+ Description:
+
+ Thread safe chart rendering for B1TD reports
+
+ Charts are drawn with the object oriented Figure/Agg API rather than
+ pyplot, so no figure state is shared and each figure is released once
+ rendered. Parts of matplotlib (e.g. the mathtext parser used for log
+ axis labels) are not thread safe so drawing is serialised within a
+ process, render_charts() renders several charts in parallel in a pool
+ of worker processes.
+
+ Requirements:
+  matplotlib
+
+ Date Last Updated: 20261017
+
+ Todo:
+
+ Copyright (c) 2022 Chris Marrison / Infoblox
+
+ Redistribution and use in source and binary forms,
+ with or without modification, are permitted provided
+ that the following conditions are met:
+
+ 1. Redistributions of source code must retain the above copyright
+ notice, this list of conditions and the following disclaimer.
+
+ 2. Redistributions in binary form must reproduce the above copyright
+ notice, this list of conditions and the following disclaimer in the
+ documentation and/or other materials provided with the distribution.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+ "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+ LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+ FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+ COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+ INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+ BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+ LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+ CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+ LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+ ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ POSSIBILITY OF SUCH DAMAGE.
+
+------------------------------------------------------------------------
+'''
+import logging
+import concurrent.futures
+import io
+import multiprocessing
+import os
+import threading
+import time
+import matplotlib
+# Headless backend, avoids probing for a GUI toolkit
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+__version__ = '0.0.1'
+__author__ = 'Chris Marrison'
+__author_email__ = 'chris@infoblox.com'
+
+DEFAULT_COLOURS = [ 'red', 'orange', 'cyan', 'blue', 'green' ]
+
+_render_lock = threading.Lock()
+_pool = None
+_pool_size = 0
+_pool_lock = threading.Lock()
+
+
+def barh_chart(keys, counts, title='', xlabel='', ylabel='',
+               colours=DEFAULT_COLOURS, log=False, figsize=(6.4, 4.8),
+               dpi=100, filename=''):
+    '''
+    Render horizontal bar chart as PNG
+
+    Parameters:
+        keys (list): Bar labels
+        counts (list): Bar values
+        title (str): Chart title
+        xlabel (str): X axis label
+        ylabel (str): Y axis label
+        colours (list): Bar colours
+        log (bool): Use log scale for values
+        figsize (tuple): Figure size in inches
+        dpi (int): Resolution
+        filename (str): Also write PNG to file if specified
+
+    Returns:
+        io.BytesIO containing the PNG, positioned at the start
+    '''
+    image = io.BytesIO()
+    with _render_lock:
+        fig = Figure(figsize=figsize, dpi=dpi)
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+        hbar = ax.barh(range(len(counts)), counts, align='center',
+                       color=colours)
+        ax.set_title(title)
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel(ylabel)
+        if log:
+            ax.set_xscale('log')
+        ax.set_yticks(range(len(counts)), keys)
+        ax.bar_label(hbar)
+        fig.tight_layout()
+        fig.savefig(image, format='png')
+        # Release figure explicitly
+        fig.clear()
+        del fig
+
+    if filename:
+        with open(filename, 'wb') as png:
+            png.write(image.getbuffer())
+        logging.info(f'- Graph saved as {filename}')
+    image.seek(0)
+
+    return image
+
+
+# Chart spec kinds, see render_chart()
+CHART_TYPES = { 'barh': barh_chart }
+
+
+def render_chart(spec):
+    '''
+    Render a chart spec in this process
+
+    Parameters:
+        spec (dict): 'name', optional 'kind' (default 'barh') and the
+                     keyword arguments of the chart function, e.g.
+                     keys and counts for barh_chart()
+
+    Returns:
+        Tuple of (name, PNG (bytes), render seconds)
+    '''
+    start = time.perf_counter()
+    options = dict(spec)
+    name = options.pop('name', '')
+    kind = options.pop('kind', 'barh')
+    image = CHART_TYPES[kind](**options)
+
+    return name, image.getvalue(), time.perf_counter() - start
+
+
+def _get_pool(processes):
+    '''
+    Process pool shared by all reports in the process
+
+    Workers are forked from a clean forkserver process with this module
+    (and so matplotlib) already imported, so starting them is cheap and
+    safe from a threaded parent. Spawn is used where forkserver is not
+    available. The pool is only replaced to grow it, so its warm workers
+    are kept for later reports whatever their number of charts.
+    '''
+    global _pool, _pool_size
+    with _pool_lock:
+        if _pool is None or _pool_size < processes:
+            if _pool:
+                _pool.shutdown(wait=False)
+            methods = multiprocessing.get_all_start_methods()
+            if 'forkserver' in methods:
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload([ __name__ ])
+            else:
+                context = multiprocessing.get_context('spawn')
+            _pool = concurrent.futures.ProcessPoolExecutor(
+                        max_workers=processes, mp_context=context)
+            _pool_size = processes
+
+    return _pool
+
+
+def _map_limited(pool, specs, limit):
+    '''
+    Render specs in pool with at most limit charts in progress, the
+    pool may be larger
+    '''
+    specs = iter(specs)
+    jobs = []
+    pending = set()
+    for spec in specs:
+        if len(pending) >= limit:
+            _, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        job = pool.submit(render_chart, spec)
+        jobs.append(job)
+        pending.add(job)
+
+    return [ job.result() for job in jobs ]
+
+
+def render_charts(specs, processes=None):
+    '''
+    Render chart specs in parallel worker processes
+
+    Parameters:
+        specs (list): Chart specs, see render_chart()
+        processes (int): Worker processes, default one per CPU, 0
+                         renders in this process. At most one process
+                         per chart is used.
+
+    Returns:
+        dict of name: (io.BytesIO PNG, render seconds) in spec order
+    '''
+    results = None
+    if processes is None:
+        processes = os.cpu_count() or 1
+    limit = min(processes, len(specs))
+    if limit > 1:
+        try:
+            results = _map_limited(_get_pool(processes), specs, limit)
+        except concurrent.futures.process.BrokenProcessPool as err:
+            logging.warning(f'Chart pool failed, rendering in process: {err}')
+            with _pool_lock:
+                global _pool
+                _pool = None
+    if results is None:
+        results = [ render_chart(spec) for spec in specs ]
+
+    return { name: (io.BytesIO(png), seconds)
+             for name, png, seconds in results }
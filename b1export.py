@@ -0,0 +1,358 @@
+#!/usr/local/bin/python3
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+'''
+------------------------------------------------------------------------
+
+ Description:
+
+ Streaming export of security hits and DNS events
+
+ Records are paged from the API and written as they arrive so memory
+ use is independent of the size of the period exported. DNS events for
+ several sources are fetched concurrently in time shards and written in
+ time order, filters and field selection are passed to the API.
+
+ Usage:
+    b1export.py -c bloxone.ini -p 30d -o hits.ndjson.gz
+    b1export.py -c bloxone.ini -p 7d -t dns -s rpz -o rpz.csv.gz
+    b1export.py -c bloxone.ini -p 7d -o hits.parquet
+    b1export.py -c bloxone.ini -p 7d -t dns -s all --shard 1h \
+        --fields event_time,qname,device,feed_name -o dns.parquet
+
+ Requirements:
+  bloxone module
+  pyarrow (parquet output only)
+
+ Date Last Updated: 20261017
+
+ Todo:
+
+ Copyright (c) 2022 Chris Marrison / Infoblox
+
+ Redistribution and use in source and binary forms,
+ with or without modification, are permitted provided
+ that the following conditions are met:
+
+ 1. Redistributions of source code must retain the above copyright
+ notice, this list of conditions and the following disclaimer.
+
+ 2. Redistributions in binary form must reproduce the above copyright
+ notice, this list of conditions and the following disclaimer in the
+ documentation and/or other materials provided with the distribution.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+ "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+ LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+ FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+ COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+ INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+ BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+ LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+ CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+ LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+ ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ POSSIBILITY OF SUCH DAMAGE.
+
+------------------------------------------------------------------------
+'''
+import logging
+import argparse
+import b1td_summary_report
+import csv
+import gzip
+import json
+
+__version__ = '0.0.1'
+__author__ = 'Chris Marrison'
+__author_email__ = 'chris@infoblox.com'
+
+
+# gzip level for .gz output, the default (9) is several times slower
+# for little gain on large exports
+GZIP_LEVEL = 6
+
+
+def _open_text(filename):
+    '''
+    Open text output, gzip compressed if filename ends .gz
+    '''
+    if filename.endswith('.gz'):
+        handler = gzip.open(filename, mode='wt', encoding='utf-8', newline='',
+                            compresslevel=GZIP_LEVEL)
+    else:
+        handler = open(filename, mode='w', encoding='utf-8', newline='')
+
+    return handler
+
+
+class NDJSONWriter:
+    '''
+    Write records as newline delimited JSON
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.count = 0
+        self._file = _open_text(filename)
+
+        return
+
+
+    def write(self, record):
+        self._file.write(json.dumps(record, separators=(',', ':')))
+        self._file.write('\n')
+        self.count += 1
+
+        return
+
+
+    def close(self):
+        self._file.close()
+
+        return
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+        return False
+
+
+class CSVWriter(NDJSONWriter):
+    '''
+    Write records as CSV
+
+    Columns are taken from the first record unless specified, nested
+    values are written as JSON and unknown fields are ignored.
+    '''
+    def __init__(self, filename, fields=None):
+        super().__init__(filename)
+        self.fields = fields
+        self._writer = None
+
+        return
+
+
+    def write(self, record):
+        if self._writer is None:
+            if not self.fields:
+                self.fields = list(record.keys())
+            self._writer = csv.DictWriter(self._file, fieldnames=self.fields,
+                                          extrasaction='ignore')
+            self._writer.writeheader()
+        row = { k: json.dumps(v) if isinstance(v, (dict, list)) else v
+                for k, v in record.items() }
+        self._writer.writerow(row)
+        self.count += 1
+
+        return
+
+
+class ParquetWriter(NDJSONWriter):
+    '''
+    Write records as compressed Parquet in row groups of batch_size
+
+    The schema is inferred from the first batch, requires pyarrow.
+    '''
+    def __init__(self, filename, batch_size=50000, compression='zstd'):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            logging.error('pyarrow module required for parquet output')
+            raise
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self.filename = filename
+        self.batch_size = batch_size
+        self.compression = compression
+        self.count = 0
+        self._batch = []
+        self._writer = None
+
+        return
+
+
+    def write(self, record):
+        self._batch.append(record)
+        self.count += 1
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+
+        return
+
+
+    def _flush(self):
+        if not self._batch:
+            return
+        if self._writer is None:
+            table = self._pa.Table.from_pylist(self._batch)
+            self._writer = self._pq.ParquetWriter(self.filename, table.schema,
+                                               compression=self.compression)
+        else:
+            table = self._pa.Table.from_pylist(self._batch,
+                                               schema=self._writer.schema)
+        self._writer.write_table(table)
+        self._batch = []
+
+        return
+
+
+    def close(self):
+        self._flush()
+        if self._writer:
+            self._writer.close()
+
+        return
+
+
+def open_writer(filename, format='', fields=None):
+    '''
+    Create writer for filename, format determined from the extension
+    if not specified
+
+    Parameters:
+        filename (str): Output file, .gz suffix compresses ndjson/csv
+        format (str): One of ndjson, csv, parquet
+        fields (list): CSV columns, default fields of the first record
+
+    Returns:
+        writer instance
+    '''
+    if not format:
+        name = filename[:-3] if filename.endswith('.gz') else filename
+        format = name.rsplit('.', 1)[-1].lower()
+    if format in [ 'csv' ]:
+        writer = CSVWriter(filename, fields=fields)
+    elif format in [ 'parquet', 'pq' ]:
+        writer = ParquetWriter(filename)
+    else:
+        writer = NDJSONWriter(filename)
+
+    return writer
+
+
+def export(records, writer, progress=100000):
+    '''
+    Stream records to writer
+
+    Parameters:
+        records (iterable): Records, e.g. b1reporting.iter_security_activity()
+        writer (obj): Writer from open_writer()
+        progress (int): Log progress every n records
+
+    Returns:
+        Number of records written
+    '''
+    with writer:
+        for record in records:
+            writer.write(record)
+            if progress and writer.count % progress == 0:
+                logging.info(f' - {writer.count:,} records written')
+
+    return writer.count
+
+
+def parseargs():
+    '''
+    Parse Arguments Using argparse
+
+    Parameters:
+        None
+
+    Returns:
+        Returns parsed arguments
+    '''
+    parse = argparse.ArgumentParser(description='B1TD Activity Export')
+    parse.add_argument('-c', '--config', type=str, default='bloxone.ini',
+                       help="bloxone inifile with API key")
+    parse.add_argument('-p', '--period', type=str, default='1d',
+                       help="Period in form of 3d, 2w, 1d")
+    parse.add_argument('-t', '--type', choices=[ 'hits', 'dns' ],
+                       default='hits', help="Security hits or DNS events")
+    parse.add_argument('-s', '--source', type=str, default='',
+                       help="DNS event sources: rpz, category, analytics, "
+                            "a comma separated list or all")
+    parse.add_argument('-o', '--output', type=str, required=True,
+                       help="Output file (.ndjson, .csv, .parquet, "
+                            "optionally .gz)")
+    parse.add_argument('-f', '--format', type=str, default='',
+                       help="Override output format")
+    parse.add_argument('--page-size', type=int, default=1000,
+                       help="Records per API request (default 1000)")
+    parse.add_argument('--shard', type=b1td_summary_report.shard_arg,
+                       default='',
+                       help="Fetch DNS events in time shards of this "
+                            "length concurrently (default 1h)")
+    parse.add_argument('-w', '--workers', type=int, default=8,
+                       help="Concurrent API requests (default 8)")
+    parse.add_argument('--filter', type=str, default='',
+                       help="API _filter expression")
+    parse.add_argument('--fields', type=str, default='',
+                       help="Comma separated fields to request and write")
+    parse.add_argument('-d', '--debug', action='store_true',
+                       help="Enable debug messages")
+
+    return parse.parse_args()
+
+
+def main():
+    '''
+    Core Logic
+    '''
+    import b1reporting
+
+    exitcode = 0
+    args = parseargs()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+                        format='%(levelname)s: %(message)s')
+
+    b1r = b1reporting.b1reporting(args.config)
+    b1r.max_workers = args.workers
+    params = {}
+    if args.filter:
+        params['_filter'] = args.filter
+    fields = [ f.strip() for f in args.fields.split(',') if f.strip() ]
+
+    if args.type == 'dns':
+        if args.source == 'all':
+            sources = list(b1reporting.SOURCE_TYPES.keys())
+        else:
+            sources = [ s.strip() for s in args.source.split(',')
+                        if s.strip() ]
+        if len(sources) > 1 or args.shard:
+            records = b1r.iter_dns_events_merged(args.period, sources=sources,
+                                                 shard=args.shard,
+                                                 page_size=args.page_size,
+                                                 fields=fields, **params)
+        else:
+            if fields:
+                params['_fields'] = ','.join(fields)
+            records = b1r.iter_dns_events(args.period,
+                                          source=''.join(sources),
+                                          page_size=args.page_size, **params)
+    else:
+        if fields:
+            params['_fields'] = ','.join(fields)
+        records = b1r.iter_security_activity(args.period,
+                                             page_size=args.page_size,
+                                             **params)
+    try:
+        count = export(records, open_writer(args.output, args.format,
+                                            fields=fields))
+        logging.info(f'{count:,} records written to {args.output}')
+    except Exception as err:
+        logging.error(f'Export failed: {err}')
+        exitcode = 1
+
+    return exitcode
+
+
+### Main ###
+if __name__ == '__main__':
+    exitcode = main()
+    exit(exitcode)
+## End Main ###
@@ -0,0 +1,464 @@
+#!/usr/local/bin/python3
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+'''
+------------------------------------------------------------------------
+
+ Description:
+
+ Instrumentation for b1reporting API calls and report stages
+
+ Records latency, status, retries, response size and JSON decode time
+ of every API call, labelled with the insight requested, and the
+ duration of each report stage. The results are available as a JSON run
+ summary and as a Prometheus textfile (node_exporter textfile collector)
+ e.g.
+
+    metrics = b1metrics.Metrics()
+    b1r.metrics = metrics
+    with metrics.stage('fetch'):
+        b1r.get_insights([ 'dex', 'malware' ], '7d')
+    metrics.write_json('report.metrics.json')
+    metrics.write_prometheus('b1td_report.prom', { 'customer': 'acme' })
+
+ Date Last Updated: 20261017
+
+ Todo:
+
+ Copyright (c) 2022 Chris Marrison / Infoblox
+
+ Redistribution and use in source and binary forms,
+ with or without modification, are permitted provided
+ that the following conditions are met:
+
+ 1. Redistributions of source code must retain the above copyright
+ notice, this list of conditions and the following disclaimer.
+
+ 2. Redistributions in binary form must reproduce the above copyright
+ notice, this list of conditions and the following disclaimer in the
+ documentation and/or other materials provided with the distribution.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+ "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+ LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+ FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+ COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+ INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+ BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+ LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+ CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+ LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+ ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ POSSIBILITY OF SUCH DAMAGE.
+
+------------------------------------------------------------------------
+'''
+import logging
+import contextlib
+import datetime
+import functools
+import json
+import math
+import os
+import threading
+import time
+import urllib.parse
+
+__version__ = '0.0.1'
+__author__ = 'Chris Marrison'
+__author_email__ = 'chris@infoblox.com'
+
+PROMETHEUS_PREFIX = 'b1td_report'
+
+
+def percentile(values, pct):
+    '''
+    Nearest rank percentile of a list of numbers, 0 if empty
+    '''
+    if not values:
+        return 0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1,
+                      math.ceil(pct / 100 * len(ordered)) - 1))
+
+    return ordered[rank]
+
+
+def stage(metrics, name):
+    '''
+    Time a stage if metrics are enabled
+
+    Parameters:
+        metrics (obj): Metrics instance or None
+        name (str): Stage name
+
+    Returns:
+        context manager
+    '''
+    return metrics.stage(name) if metrics else contextlib.nullcontext()
+
+
+def label(metrics, name):
+    '''
+    Label API calls made in this context if metrics are enabled
+
+    Parameters:
+        metrics (obj): Metrics instance or None
+        name (str): Label, e.g. insight name
+
+    Returns:
+        context manager
+    '''
+    return metrics.label(name) if metrics else contextlib.nullcontext()
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return ('{' + ','.join([ f'{k}="{_escape(v)}"'
+                             for k, v in labels.items() ]) + '}')
+
+
+class Metrics:
+    '''
+    Thread safe recorder of API call and stage metrics for one run
+    '''
+    def __init__(self):
+        self.started = time.time()
+        self.calls = []
+        self.stages = {}
+        # Requests answered by an identical in flight or earlier request
+        self.shared = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        return
+
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''
+        Context manager recording the duration of a stage, repeated
+        stages are summed
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(name, time.perf_counter() - start)
+
+
+    def record_stage(self, name, seconds):
+        '''
+        Add stage duration
+
+        Parameters:
+            name (str): Stage name
+            seconds (float): Duration
+        '''
+        with self._lock:
+            entry = self.stages.setdefault(name, { 'seconds': 0.0,
+                                                   'count': 0 })
+            entry['seconds'] += seconds
+            entry['count'] += 1
+
+        return
+
+
+    @contextlib.contextmanager
+    def label(self, name):
+        '''
+        Context manager labelling API calls made by this thread
+        '''
+        previous = getattr(self._local, 'label', None)
+        self._local.label = name
+        try:
+            yield
+        finally:
+            self._local.label = previous
+
+
+    def current_label(self):
+        '''
+        Label for API calls made by this thread, or None
+        '''
+        return getattr(self._local, 'label', None)
+
+
+    def bind(self, func):
+        '''
+        Wrap func to run with the current label, for use with a thread
+        pool
+        '''
+        name = self.current_label()
+        if name is None:
+            return func
+
+        @functools.wraps(func)
+        def labelled(*args, **kwargs):
+            with self.label(name):
+                return func(*args, **kwargs)
+
+        return labelled
+
+
+    def record_call(self, method, url, status, seconds, retries=0, nbytes=0,
+                    cached=False):
+        '''
+        Add an API call
+
+        Parameters:
+            method (str): HTTP method
+            url (str): Full URL
+            status (int): HTTP status code
+            seconds (float): Time to response, including retries
+            retries (int): Retries made
+            nbytes (int): Response body size
+            cached (bool): Answered from the response cache
+
+        Returns:
+            call record (dict)
+        '''
+        path = urllib.parse.urlsplit(url).path
+        call = { 'method': method,
+                 'path': path,
+                 'label': self.current_label() or path.rsplit('/', 1)[-1],
+                 'status': status,
+                 'seconds': round(seconds, 6),
+                 'retries': retries,
+                 'bytes': nbytes,
+                 'cached': cached,
+                 'decodes': 0,
+                 'decode_seconds': 0.0 }
+        with self._lock:
+            self.calls.append(call)
+
+        return call
+
+
+    def record_shared(self):
+        '''
+        Count a request that shared the response of an identical request
+        rather than making an API call
+        '''
+        with self._lock:
+            self.shared += 1
+
+        return
+
+
+    def instrument(self, response, call):
+        '''
+        Time JSON decoding of a response against its call record
+
+        Only actual decodes are counted, b1response.B1Response objects
+        report their decodes through on_decode, cached data returned by
+        later json() calls is not counted.
+
+        Parameters:
+            response (obj): requests or b1response.B1Response object
+            call (dict): Record from record_call()
+
+        Returns:
+            response
+        '''
+        def decoded(seconds):
+            with self._lock:
+                call['decodes'] += 1
+                call['decode_seconds'] += seconds
+
+        if hasattr(response, 'on_decode'):
+            response.on_decode = decoded
+            return response
+
+        decode = response.json
+
+        @functools.wraps(decode)
+        def timed_json(**kwargs):
+            start = time.perf_counter()
+            try:
+                return decode(**kwargs)
+            finally:
+                decoded(time.perf_counter() - start)
+
+        response.json = timed_json
+
+        return response
+
+
+    def summary(self):
+        '''
+        Run summary
+
+        Returns:
+            dict with stages, API totals and per label (insight) totals
+        '''
+        with self._lock:
+            calls = [ dict(c) for c in self.calls ]
+            shared = self.shared
+            stages = { k: { 'seconds': round(v['seconds'], 6),
+                            'count': v['count'] }
+                       for k, v in self.stages.items() }
+
+        labels = {}
+        for call in calls:
+            entry = labels.setdefault(call['label'], {
+                        'calls': 0, 'cached': 0, 'seconds': 0.0,
+                        'max_seconds': 0.0, 'retries': 0, 'bytes': 0,
+                        'decodes': 0, 'decode_seconds': 0.0, 'status': {} })
+            entry['calls'] += 1
+            entry['cached'] += call['cached']
+            entry['seconds'] += call['seconds']
+            entry['max_seconds'] = max(entry['max_seconds'], call['seconds'])
+            entry['retries'] += call['retries']
+            entry['bytes'] += call['bytes']
+            entry['decodes'] += call['decodes']
+            entry['decode_seconds'] += call['decode_seconds']
+            status = str(call['status'])
+            entry['status'][status] = entry['status'].get(status, 0) + 1
+
+        latencies = [ c['seconds'] for c in calls if not c['cached'] ]
+        api = { 'calls': len(calls),
+                'cached': sum([ c['cached'] for c in calls ]),
+                'shared': shared,
+                'errors': len([ c for c in calls if c['status'] >= 400 ]),
+                'retries': sum([ c['retries'] for c in calls ]),
+                'bytes': sum([ c['bytes'] for c in calls ]),
+                'seconds': round(sum(latencies), 6),
+                'latency_p50': percentile(latencies, 50),
+                'latency_p95': percentile(latencies, 95),
+                'latency_max': max(latencies or [ 0 ]),
+                'decodes': sum([ c['decodes'] for c in calls ]),
+                'decode_seconds': round(sum([ c['decode_seconds']
+                                              for c in calls ]), 6) }
+
+        return { 'started': datetime.datetime.fromtimestamp(
+                                self.started).isoformat(timespec='seconds'),
+                 'stages': stages,
+                 'api': api,
+                 'insights': labels,
+                 'calls': calls }
+
+
+    def log_summary(self):
+        '''
+        Log one line summary of the run
+        '''
+        summary = self.summary()
+        api = summary['api']
+        total = summary['stages'].get('total', {}).get('seconds')
+        line = f'{api["calls"]} API calls'
+        if total is not None:
+            line = f'Completed in {total:.1f}s, ' + line
+        line += (f' ({api["cached"]} cached, {api["shared"]} shared, '
+                 f'{api["retries"]} retries, '
+                 f'{api["bytes"]:,} bytes)')
+        if summary['insights']:
+            name, slowest = max(summary['insights'].items(),
+                                key=lambda i: i[1]['max_seconds'])
+            line += f', slowest {name} {slowest["max_seconds"]:.2f}s'
+        logging.info(line)
+
+        return
+
+
+    def write_json(self, filename, **extra):
+        '''
+        Write run summary as JSON
+
+        Parameters:
+            filename (str): Output file
+            extra: Additional top level fields, e.g. customer
+        '''
+        data = dict(extra)
+        data.update(self.summary())
+        _write_atomic(filename, json.dumps(data, indent=2))
+
+        return
+
+
+    def prometheus(self, labels=None, success=None):
+        '''
+        Run summary in Prometheus text exposition format
+
+        Parameters:
+            labels (dict): Labels added to every sample, e.g. customer
+            success (bool): Also output a success gauge
+
+        Returns:
+            str
+        '''
+        labels = labels or {}
+        summary = self.summary()
+        lines = []
+
+        def metric(name, help, samples):
+            name = f'{PROMETHEUS_PREFIX}_{name}'
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} gauge')
+            for sample_labels, value in samples:
+                sample_labels = dict(labels, **sample_labels)
+                lines.append(f'{name}{_labels(sample_labels)} {value}')
+
+        metric('last_run_timestamp_seconds', 'Start time of the last run',
+               [ ({}, round(self.started, 3)) ])
+        if success is not None:
+            metric('success', 'Whether the last run succeeded',
+                   [ ({}, int(bool(success))) ])
+        metric('stage_seconds', 'Duration of report stages',
+               [ ({ 'stage': k }, round(v['seconds'], 6))
+                 for k, v in summary['stages'].items() ])
+        insights = summary['insights']
+        metric('api_calls', 'API calls by insight and status',
+               [ ({ 'insight': k, 'status': s }, n)
+                 for k, v in insights.items()
+                 for s, n in v['status'].items() ])
+        metric('api_seconds', 'Total API call time by insight',
+               [ ({ 'insight': k }, round(v['seconds'], 6))
+                 for k, v in insights.items() ])
+        metric('api_max_seconds', 'Slowest API call by insight',
+               [ ({ 'insight': k }, round(v['max_seconds'], 6))
+                 for k, v in insights.items() ])
+        metric('api_retries', 'API call retries by insight',
+               [ ({ 'insight': k }, v['retries'])
+                 for k, v in insights.items() ])
+        metric('api_response_bytes', 'API response bytes by insight',
+               [ ({ 'insight': k }, v['bytes'])
+                 for k, v in insights.items() ])
+        metric('api_decode_seconds', 'JSON decode time by insight',
+               [ ({ 'insight': k }, round(v['decode_seconds'], 6))
+                 for k, v in insights.items() ])
+        metric('api_shared', 'Requests sharing an identical request',
+               [ ({}, summary['api']['shared']) ])
+
+        return '\n'.join(lines) + '\n'
+
+
+    def write_prometheus(self, filename, labels=None, success=None):
+        '''
+        Write Prometheus textfile, replaced atomically so the collector
+        never reads a partial file
+
+        Parameters:
+            filename (str): Output file, normally ending .prom
+            labels (dict): Labels added to every sample
+            success (bool): Also output a success gauge
+        '''
+        _write_atomic(filename, self.prometheus(labels, success))
+
+        return
+
+# End of class
+
+
+def _write_atomic(filename, text):
+    tmp = f'{filename}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, filename)
+
+    return
@@ -0,0 +1,612 @@
+#!/usr/local/bin/python3
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+'''
+------------------------------------------------------------------------
+
+ Description:
+
+ Record and replay of B1TD API traffic
+
+ In record mode every request made through a b1transport.Transport, and
+ its response, is captured to a gzip compressed JSON bundle. In replay
+ mode the bundle answers the same requests with no network access,
+ either through a transport adapter or a local stand in HTTP server,
+ optionally adding latency and injecting errors so that the retry and
+ rate limit logic is exercised.
+
+ Requests are matched on method, path, query and body. Recording fixes
+ the client clock, which is saved in the bundle and restored on replay,
+ so the time windows requested are identical. Requests made at another
+ time (e.g. to the stand in server) fall back to matching without t0/t1.
+
+ Usage:
+    b1td_summary_report.py -c report.ini --record customer.b1replay.gz
+    b1td_summary_report.py -c report.ini --replay customer.b1replay.gz
+    b1replay.py info customer.b1replay.gz
+    b1replay.py serve customer.b1replay.gz -p 8080 --latency 0.2
+
+ Date Last Updated: 20261017
+
+ Todo:
+
+ Copyright (c) 2022 Chris Marrison / Infoblox
+
+ Redistribution and use in source and binary forms,
+ with or without modification, are permitted provided
+ that the following conditions are met:
+
+ 1. Redistributions of source code must retain the above copyright
+ notice, this list of conditions and the following disclaimer.
+
+ 2. Redistributions in binary form must reproduce the above copyright
+ notice, this list of conditions and the following disclaimer in the
+ documentation and/or other materials provided with the distribution.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+ "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+ LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+ FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+ COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+ INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+ BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+ LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+ CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+ LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+ ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ POSSIBILITY OF SUCH DAMAGE.
+
+------------------------------------------------------------------------
+'''
+import logging
+import argparse
+import datetime
+import gzip
+import http.server
+import io
+import json
+import os
+import random
+import threading
+import time
+import urllib.parse
+import requests
+import requests.adapters
+import requests.structures
+
+__version__ = '0.0.1'
+__author__ = 'Chris Marrison'
+__author_email__ = 'chris@infoblox.com'
+
+BUNDLE_FORMAT = 'b1replay'
+BUNDLE_VERSION = 1
+# Query and body fields ignored by the fallback match
+TIME_FIELDS = [ 't0', 't1' ]
+# Response headers kept in the bundle
+KEEP_HEADERS = [ 'Content-Type', 'Retry-After' ]
+
+
+def _body_text(body):
+    '''
+    Request body as str
+    '''
+    if body is None:
+        text = ''
+    elif isinstance(body, bytes):
+        text = body.decode('utf-8', errors='replace')
+    else:
+        text = str(body)
+
+    return text
+
+
+def request_key(method, url, body=None, loose=False):
+    '''
+    Generate match key for a request, independent of host
+
+    Parameters:
+        method (str): HTTP method
+        url (str): Full URL or path with query
+        body (str/bytes): Request body
+        loose (bool): Ignore TIME_FIELDS in query and JSON body
+
+    Returns:
+        key (str)
+    '''
+    parts = urllib.parse.urlsplit(url)
+    query = urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+    text = _body_text(body)
+    if loose:
+        query = [ (k, v) for k, v in query if k not in TIME_FIELDS ]
+    try:
+        data = json.loads(text) if text else None
+    except ValueError:
+        data = None
+    if isinstance(data, dict):
+        if loose:
+            data = { k: v for k, v in data.items() if k not in TIME_FIELDS }
+        text = json.dumps(data, sort_keys=True, separators=(',', ':'))
+
+    return (f'{method.upper()} {parts.path}?' +
+            urllib.parse.urlencode(sorted(query)) + f' {text}')
+
+
+class Bundle:
+    '''
+    Recorded requests and responses
+    '''
+    def __init__(self, clock=None):
+        '''
+        Parameters:
+            clock (float): Client time for the recording, defaults to now
+        '''
+        self.clock = clock or time.time()
+        self.created = datetime.datetime.now().isoformat(timespec='seconds')
+        self.entries = []
+        self._index = {}
+        self._loose = {}
+        self._served = {}
+        self._lock = threading.Lock()
+
+        return
+
+
+    def now(self):
+        '''
+        Recorded client time, use as b1reporting clock
+        '''
+        return self.clock
+
+
+    def add(self, method, url, body, status, headers, content, elapsed=0.0):
+        '''
+        Add a request and its response
+
+        Parameters:
+            method (str): HTTP method
+            url (str): Full URL
+            body (str/bytes): Request body
+            status (int): HTTP status code
+            headers (dict): Response headers
+            content (bytes): Response body
+            elapsed (float): Response time in seconds
+        '''
+        parts = urllib.parse.urlsplit(url)
+        entry = { 'method': method.upper(),
+                  'url': urllib.parse.urlunsplit(('', '', parts.path,
+                                                  parts.query, '')),
+                  'body': _body_text(body),
+                  'status': status,
+                  'headers': { k: headers[k] for k in KEEP_HEADERS
+                               if k in headers },
+                  'content': content.decode('utf-8', errors='replace'),
+                  'elapsed': round(elapsed, 4) }
+        with self._lock:
+            self._add(entry)
+
+        return
+
+
+    def _add(self, entry):
+        position = len(self.entries)
+        self.entries.append(entry)
+        args = (entry['method'], entry['url'], entry['body'])
+        self._index.setdefault(request_key(*args), []).append(position)
+        self._loose.setdefault(request_key(*args, loose=True),
+                               []).append(position)
+
+        return
+
+
+    def lookup(self, method, url, body=None):
+        '''
+        Find the recorded response for a request
+
+        Repeated identical requests are answered with the recorded
+        responses in turn, cycling when exhausted.
+
+        Returns:
+            entry (dict) or None
+        '''
+        entry = None
+        for loose, index in [ (False, self._index), (True, self._loose) ]:
+            key = request_key(method, url, body, loose=loose)
+            positions = index.get(key)
+            if positions:
+                with self._lock:
+                    served = self._served.get(key, 0)
+                    self._served[key] = served + 1
+                entry = self.entries[positions[served % len(positions)]]
+                break
+
+        return entry
+
+
+    def save(self, filename):
+        '''
+        Write bundle as gzip compressed JSON
+        '''
+        data = { 'format': BUNDLE_FORMAT,
+                 'version': BUNDLE_VERSION,
+                 'created': self.created,
+                 'clock': self.clock,
+                 'entries': self.entries }
+        tmp = f'{filename}.tmp'
+        with gzip.open(tmp, 'wt', encoding='utf-8') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp, filename)
+        logging.info(f'{len(self.entries)} API calls recorded to {filename}')
+
+        return
+
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        Read bundle from file
+
+        Returns:
+            Bundle instance
+
+        Raises:
+            ValueError if the file is not a replay bundle
+        '''
+        with gzip.open(filename, 'rt', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('format') != BUNDLE_FORMAT:
+            raise ValueError(f'{filename} is not a replay bundle')
+        bundle = cls(clock=data.get('clock'))
+        bundle.created = data.get('created', '')
+        for entry in data.get('entries', []):
+            bundle._add(entry)
+        logging.info(f'{len(bundle.entries)} API calls loaded from '
+                     f'{filename}')
+
+        return bundle
+
+# End of class
+
+
+class Replayer:
+    '''
+    Answer requests from a bundle with optional latency and errors
+    '''
+    def __init__(self, bundle, latency=0.0, jitter=0.0, recorded=False,
+                 error_rate=0.0, error_codes=(503,), seed=None):
+        '''
+        Parameters:
+            bundle (obj): Bundle instance
+            latency (float): Seconds added to every response
+            jitter (float): Maximum random seconds added
+            recorded (bool): Also add the recorded response time
+            error_rate (float): Fraction of requests failed, 0 to 1
+            error_codes (list): Status codes for failed requests, 0
+                                fails the connection
+            seed (int): Random seed for repeatable error injection
+        '''
+        self.bundle = bundle
+        self.latency = latency
+        self.jitter = jitter
+        self.recorded = recorded
+        self.error_rate = error_rate
+        self.error_codes = list(error_codes) or [ 503 ]
+        self.calls = 0
+        self.errors = 0
+        self.missing = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+        return
+
+
+    def respond(self, method, url, body=None):
+        '''
+        Get the response for a request
+
+        Returns:
+            Tuple of (status (int), headers (dict), content (bytes)),
+            status 0 if the connection should fail
+        '''
+        with self._lock:
+            self.calls += 1
+            failed = self._random.random() < self.error_rate
+            code = self._random.choice(self.error_codes)
+            jitter = self._random.uniform(0, self.jitter)
+
+        entry = self.bundle.lookup(method, url, body)
+        delay = self.latency + jitter
+        if entry and self.recorded:
+            delay += entry.get('elapsed', 0)
+        if delay:
+            time.sleep(delay)
+
+        if failed:
+            with self._lock:
+                self.errors += 1
+            status = code
+            headers = { 'Content-Type': 'application/json' }
+            content = json.dumps({ 'error': [ { 'message':
+                                   'Injected error' } ] }).encode()
+        elif entry:
+            status = entry['status']
+            headers = entry['headers']
+            content = entry['content'].encode('utf-8')
+        else:
+            with self._lock:
+                self.missing += 1
+            logging.warning(f'No recorded response for {method} {url}')
+            status = 404
+            headers = { 'Content-Type': 'application/json' }
+            content = json.dumps({ 'error': [ { 'message':
+                                   'Not recorded' } ] }).encode()
+
+        return status, headers, content
+
+# End of class
+
+
+class RecordingAdapter(requests.adapters.HTTPAdapter):
+    '''
+    Transport adapter adding every response to a bundle
+    '''
+    def __init__(self, bundle, **kwargs):
+        self.bundle = bundle
+        super().__init__(**kwargs)
+
+        return
+
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        self.bundle.add(request.method, request.url, request.body,
+                        response.status_code, response.headers,
+                        response.content,
+                        response.elapsed.total_seconds())
+
+        return response
+
+
+class ReplayAdapter(requests.adapters.BaseAdapter):
+    '''
+    Transport adapter answering requests from a Replayer
+    '''
+    def __init__(self, replayer):
+        super().__init__()
+        self.replayer = replayer
+
+        return
+
+
+    def send(self, request, stream=False, timeout=None, verify=True,
+             cert=None, proxies=None):
+        start = time.perf_counter()
+        status, headers, content = self.replayer.respond(request.method,
+                                                         request.url,
+                                                         request.body)
+        if not status:
+            raise requests.exceptions.ConnectionError(
+                    'Injected connection failure', request=request)
+
+        response = requests.Response()
+        response.status_code = status
+        response.reason = http.server.BaseHTTPRequestHandler.responses.get(
+                            status, ('',))[0]
+        response.headers = requests.structures.CaseInsensitiveDict(headers)
+        response.headers['Content-Length'] = str(len(content))
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        response.raw = io.BytesIO(content)
+        response._content = content
+        response._content_consumed = True
+        response.elapsed = datetime.timedelta(
+                                seconds=time.perf_counter() - start)
+        response.connection = self
+
+        return response
+
+
+    def close(self):
+        return
+
+# End of class
+
+
+def record(transport, bundle):
+    '''
+    Record all requests made through a b1transport.Transport
+
+    Parameters:
+        transport (obj): b1transport.Transport instance
+        bundle (obj): Bundle to add requests to
+    '''
+    transport.mount(RecordingAdapter(bundle,
+                                     pool_connections=transport.pool_size,
+                                     pool_maxsize=transport.pool_size))
+
+    return
+
+
+def replay(transport, replayer):
+    '''
+    Answer all requests made through a b1transport.Transport from a
+    Replayer, retries and rate limits still apply
+
+    Parameters:
+        transport (obj): b1transport.Transport instance
+        replayer (obj): Replayer instance
+    '''
+    transport.mount(ReplayAdapter(replayer))
+
+    return
+
+
+def make_handler(replayer):
+    '''
+    HTTP request handler class for the stand in server
+    '''
+    class ReplayHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+        def _reply(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else None
+            status, headers, content = replayer.respond(self.command,
+                                                        self.path, body)
+            if not status:
+                self.close_connection = True
+                return
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+            return
+
+        do_GET = _reply
+        do_POST = _reply
+        do_DELETE = _reply
+        do_PATCH = _reply
+        do_PUT = _reply
+
+    return ReplayHandler
+
+
+def serve(replayer, host='127.0.0.1', port=8080):
+    '''
+    Run stand in HTTP server until interrupted, point the url in the
+    bloxone inifile at http://host:port
+
+    Parameters:
+        replayer (obj): Replayer instance
+        host (str): Listen address
+        port (int): Listen port
+    '''
+    server = http.server.ThreadingHTTPServer((host, port),
+                                             make_handler(replayer))
+    server.daemon_threads = True
+    logging.info(f'Replaying on http://{host}:{server.server_port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logging.info(f'{replayer.calls} requests, {replayer.errors} errors '
+                     f'injected, {replayer.missing} not recorded')
+
+    return
+
+
+def summary(bundle):
+    '''
+    Count recorded requests by method and path
+
+    Returns:
+        dict of { 'METHOD path': count }
+    '''
+    counts = {}
+    for entry in bundle.entries:
+        path = urllib.parse.urlsplit(entry['url']).path
+        key = f"{entry['method']} {path}"
+        counts[key] = counts.get(key, 0) + 1
+
+    return counts
+
+
+def parseargs():
+    '''
+    Parse Arguments Using argparse
+
+    Parameters:
+        None
+
+    Returns:
+        Returns parsed arguments
+    '''
+    parse = argparse.ArgumentParser(description='B1TD API Record/Replay')
+    parse.add_argument('command', choices=[ 'info', 'serve' ],
+                       help="Show bundle contents or serve it over HTTP")
+    parse.add_argument('bundle', type=str, help="Replay bundle file")
+    parse.add_argument('--host', type=str, default='127.0.0.1',
+                       help="Listen address (default 127.0.0.1)")
+    parse.add_argument('-p', '--port', type=int, default=8080,
+                       help="Listen port (default 8080)")
+    add_replay_args(parse)
+    parse.add_argument('-d', '--debug', action='store_true',
+                       help="Enable debug messages")
+
+    return parse.parse_args()
+
+
+def add_replay_args(parse):
+    '''
+    Add latency and error injection options to an argument parser
+    '''
+    parse.add_argument('--latency', type=str, default='0',
+                       help="Seconds added per response, or 'recorded'")
+    parse.add_argument('--jitter', type=float, default=0,
+                       help="Maximum random seconds added per response")
+    parse.add_argument('--error-rate', type=float, default=0,
+                       help="Fraction of replayed requests failed")
+    parse.add_argument('--error-codes', type=str, default='503',
+                       help="Comma separated status codes for failed "
+                            "requests, 0 drops the connection")
+    parse.add_argument('--seed', type=int, default=None,
+                       help="Random seed for repeatable injection")
+
+    return
+
+
+def replayer_from_args(bundle, args):
+    '''
+    Create Replayer from add_replay_args() options
+    '''
+    recorded = args.latency == 'recorded'
+    return Replayer(bundle,
+                    latency=0.0 if recorded else float(args.latency),
+                    jitter=args.jitter,
+                    recorded=recorded,
+                    error_rate=args.error_rate,
+                    error_codes=[ int(c) for c in args.error_codes.split(',')
+                                  if c.strip() ],
+                    seed=args.seed)
+
+
+def main():
+    '''
+    Core Logic
+    '''
+    exitcode = 0
+    args = parseargs()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+                        format='%(levelname)s: %(message)s')
+
+    try:
+        bundle = Bundle.load(args.bundle)
+    except (OSError, ValueError) as err:
+        logging.error(f'Unable to load {args.bundle}: {err}')
+        return 1
+
+    if args.command == 'info':
+        print(f'Created: {bundle.created}')
+        print('Clock:   ' + datetime.datetime.fromtimestamp(
+                                bundle.clock).isoformat(timespec='seconds'))
+        print(f'Calls:   {len(bundle.entries)}')
+        for key, count in sorted(summary(bundle).items()):
+            print(f'{count:>6}  {key}')
+    else:
+        serve(replayer_from_args(bundle, args), args.host, args.port)
+
+    return exitcode
+
+
+### Main ###
+if __name__ == '__main__':
+    exitcode = main()
+    exit(exitcode)
+## End Main ###
@@ -7,7 +7,7 @@
 
  Experimental b1reporting class
 
- Date Last Updated: 20220331
+ Date Last Updated: 20261017
 
  Todo:
 
@@ -40,14 +40,445 @@
 ------------------------------------------------------------------------
 '''
 import logging
+import b1aggregate
+import b1metrics
+import b1response
+import b1rollup
+import b1transport
 import bloxone
+import concurrent.futures
+import configparser
+import collections
+import contextlib
+import copy
 import datetime
+import heapq
 import json
+import requests
+import threading
+import time
 
-__version__ = '0.0.4'
+__version__ = '0.0.5'
 __author__ = 'Chris Marrison'
 __author_email__ = 'chris@infoblox.com'
 
+DAY = 86400
+
+# Default shard length and records held ahead, see iter_dns_events_merged()
+MERGE_SHARD = '1h'
+MERGE_AHEAD = 200000
+
+# Security hit types, see count_events()
+SECURITY_HITS_FILTER = "type in ['2','3','4']"
+SOURCE_TYPES = { 'rpz': '2', 'category': '3', 'analytics': '4' }
+
+# Insights retrieved for the summary report, see get_insights()
+REPORT_INSIGHTS = [ 'dex', 'doh', 'malware', 'category', 'tclass',
+                    'tproperty', 'hit_count' ]
+
+# Insight registry
+#   endpoint: 'insights' or 'aggregations'
+#   filter: _filter expression
+#   aggs: aggregation keys, one result per entry
+#   size: top-N buckets
+#   options: additional body fields
+INSIGHTS = {
+  'activity': { 'endpoint': 'insights',
+                'filter': "type in ['2', '3'] and severity != 'Info'",
+                'aggs': [ { "key": "severity" } ],
+                'size': 3,
+                'options': { "include_count": True } },
+
+  'total_queries': { 'endpoint': 'insights',
+                     'filter': "type in ['1']",
+                     'aggs': [ { "key": "type", 
+                                 "sub_key": [ { "key": "policy_action" } ] } ],
+                     'size': 1,
+                     'options': { "include_count": True } },
+
+  'doh': { 'endpoint': 'insights',
+           'filter': ( "type in ['2'] and category == null and " +
+                       "severity != 'Low' and severity != 'Info' and " +
+                       "feed_name == 'Public_DOH' or " +
+                       "feed_name == 'public-doh' or " +
+                       "feed_name == 'Public_DOH_IP' or " +
+                       "feed_name == 'public-doh-ip'" ),
+           'aggs': [ { "key": "threat_indicator",
+                       "sub_key": [ { "key": "feed_name" },
+                                    { "key": "user" },
+                                    { "key": "device_name" } ] } ],
+           'size': 10,
+           'options': { "include_count": True } },
+
+  'malware': { 'endpoint': 'insights',
+               'filter': "type in ['2'] and tclass == 'Malware*'",
+               'aggs': [ { "key": "tproperty", 
+                           "sub_key": [ { "key": "device_name" },
+                                        { "key": "user" } ] } ],
+               'size': 10,
+               'options': { "include_count": True } },
+
+  'category': { 'endpoint': 'insights',
+                'filter': ( "type in ['3'] and feed_name=='CAT_Mal*' or " +
+                            "feed_name=='CAT_Phi*' or " +
+                            "feed_name=='CAT_Spam*'" ),
+                'aggs': [ { "key": "feed_name",
+                            "sub_key": [ { "key": "device_name" },
+                                         { "key": "user" } ] } ],
+                'size': 20,
+                'options': { "include_count": True } },
+
+  'tclass': { 'endpoint': 'insights',
+              'filter': SECURITY_HITS_FILTER,
+              'aggs': [ { "key": "tclass" } ],
+              'size': 20,
+              'options': { "count": False } },
+
+  'tproperty': { 'endpoint': 'insights',
+                 'filter': "type in ['2']",
+                 'aggs': [ { "key": "tproperty" } ],
+                 'size': 5,
+                 'options': { "include_count": True } },
+
+  'dex': { 'endpoint': 'aggregations',
+           'filter': "type in ['4']",
+           'aggs': [ { "key": "tproperty" },
+                     { "key": "user" },
+                     { "key": "network" } ],
+           'size': 10000,
+           'options': {} },
+
+  'indicator_client_count': { 'endpoint': 'insights',
+                              'filter': ( "type in ['2'] and " +
+                                          "category == null and " +
+                                          "severity != 'Low' and " +
+                                          "severity != 'Info'" ),
+                              'aggs': [ { "key": "threat_indicator",
+                                          "sub_key": [ { "key": "feed_name" },
+                                                       { "key": "user" },
+                                                       { "key": "device_name" } ]
+                                        } ],
+                              'size': 10,
+                              'options': { "include_count": True } },
+
+  # Total security hits, see count_query()
+  'hit_count': { 'endpoint': 'insights',
+                 'filter': SECURITY_HITS_FILTER,
+                 'aggs': [ { "key": "type" } ],
+                 'size': 10,
+                 'options': { "include_count": True } },
+}
+
+
+def insight_spec(name, spec):
+  '''
+  Validate an insight spec and fill in defaults
+
+  Parameters:
+    name(str): Insight name
+    spec(dict): { 'endpoint': 'insights' or 'aggregations',
+                  'filter': str, 'aggs': list, 'size': int,
+                  'options': dict of additional body fields }
+
+  Returns:
+    spec (dict), a copy
+
+  Raises:
+    ValueError if aggs are missing
+  '''
+  spec = dict(spec)
+  spec.setdefault('endpoint', 'insights')
+  spec.setdefault('filter', '')
+  spec.setdefault('size', 10)
+  spec.setdefault('options', {})
+  if not spec.get('aggs'):
+    raise ValueError(f'Insight {name} requires aggs')
+
+  return spec
+
+
+def read_insights(ini_filename):
+  '''
+  Read insights from [Insight <name>] sections of an inifile
+
+  Example::
+
+    [Insight top_networks]
+    endpoint = insights
+    filter = type in ['2']
+    aggs = [ { "key": "network" } ]
+    size = 10
+    options = { "include_count": true }
+
+  Parameters:
+    ini_filename(str): inifile, e.g. the report inifile
+
+  Returns:
+    dict of insight name: spec
+  '''
+  insights = {}
+  cfg = configparser.ConfigParser(interpolation=None)
+  try:
+    cfg.read(ini_filename)
+  except configparser.Error as err:
+    logging.error(err)
+
+  for section in cfg.sections():
+    if section.startswith('Insight '):
+      name = section[len('Insight '):].strip()
+      options = cfg[section]
+      try:
+        insights[name] = insight_spec(name, {
+          'endpoint': options.get('endpoint', 'insights').strip("'\""),
+          'filter': options.get('filter', '').strip("'\""),
+          'aggs': json.loads(options.get('aggs', '[]')),
+          'size': int(options.get('size', '10')),
+          'options': json.loads(options.get('options', '{}')) })
+      except ValueError as err:
+        logging.error(f'Invalid insight {name} in {ini_filename}: {err}')
+
+  return insights
+
+
+def insight_registry(ini_filename=''):
+  '''
+  Build an insight registry for a single report, the built in INSIGHTS
+  and any [Insight <name>] sections of the report inifile
+
+  Passed to get_insights() so that the insights of one report do not
+  affect other reports using the same b1reporting instance.
+
+  Parameters:
+    ini_filename(str): Optional report inifile
+
+  Returns:
+    dict of insight name: spec
+  '''
+  registry = copy.deepcopy(INSIGHTS)
+  if ini_filename:
+    registry.update(read_insights(ini_filename))
+
+  return registry
+
+
+def split_days(t0, t1, now=None):
+  '''
+  Split time window on UTC day boundaries
+
+  Parameters:
+    t0(int): Start of window, epoch seconds
+    t1(int): End of window, epoch seconds
+    now(int): Current time, days ending after this are incomplete
+
+  Returns:
+    List of (t0, t1, complete) tuples, complete is True for whole days
+  '''
+  windows = []
+  if now is None:
+    now = int(datetime.datetime.now().timestamp())
+  start = t0
+  while start < t1:
+    day_end = start - (start % DAY) + DAY
+    end = min(day_end, t1)
+    complete = (start % DAY == 0 and end == day_end and end <= now)
+    windows.append((start, end, complete))
+    start = end
+
+  return windows
+
+
+def previous_period(period):
+  '''
+  Period immediately before period, e.g. 1w becomes 1w@1w, the week
+  ending one week ago. Accepted by all methods taking a period.
+
+  Parameters:
+    period(str): Period in form of 3d, 2w, 1d
+
+  Returns:
+    period (str)
+  '''
+  return f'{period}@{period}'
+
+
+def json_response(data, status_code=200):
+  '''
+  Generate a response object without an API call
+
+  Parameters:
+    data(dict): JSON serialisable body
+    status_code(int): HTTP status code
+  
+  Returns:
+    b1response.B1Response object, already decoded
+  '''
+  response = requests.Response()
+  response.status_code = status_code
+  response._content = json.dumps(data).encode()
+  response._content_consumed = True
+  response.encoding = 'utf-8'
+  response.headers['Content-Type'] = 'application/json'
+
+  return b1response.B1Response(response, data=data)
+
+
+def _add_counts(a, b):
+  # Sum counts keeping string form if the API returned strings
+  total = int(a or 0) + int(b or 0)
+  if isinstance(a, str) or isinstance(b, str):
+    total = str(total)
+  
+  return total
+
+
+def _merge_buckets(bucket_lists):
+  '''
+  Merge lists of {key, count, sub_bucket} dicts by key
+  '''
+  merged = {}
+  for buckets in bucket_lists:
+    for bucket in buckets or []:
+      key = bucket.get('key')
+      if key not in merged:
+        merged[key] = { k: v for k, v in bucket.items() if k != 'sub_bucket' }
+        merged[key]['_subs'] = []
+      else:
+        target = merged[key]
+        if 'count' in bucket:
+          target['count'] = _add_counts(target.get('count'), bucket['count'])
+      if 'sub_bucket' in bucket:
+        merged[key]['_subs'].append(bucket['sub_bucket'])
+
+  results = []
+  for bucket in merged.values():
+    subs = bucket.pop('_subs')
+    if subs:
+      bucket['sub_bucket'] = _merge_buckets(subs)
+    results.append(bucket)
+
+  return results
+
+
+def page_records(data):
+  '''
+  Locate the list of records in an activity response page
+
+  Parameters:
+    data(dict): Decoded JSON response
+
+  Returns:
+    list of records, empty if none found
+  '''
+  for container in [ data, data.get('success') ]:
+    if isinstance(container, dict):
+      for key in [ 'result', 'results', 'hits', 'records' ]:
+        if isinstance(container.get(key), list):
+          return container[key]
+
+  return []
+
+
+def merge_records(datas):
+  '''
+  Merge activity responses for adjacent time windows
+
+  Integers are summed, lists concatenated and nested dicts merged
+  recursively, e.g. success.size is the total across all windows.
+
+  Parameters:
+    datas(list): Decoded JSON responses
+
+  Returns:
+    dict in the same form as a single response
+  '''
+  merged = {}
+  for data in datas:
+    for key, value in data.items():
+      if key not in merged:
+        merged[key] = value
+      elif isinstance(value, dict) and isinstance(merged[key], dict):
+        merged[key] = merge_records([ merged[key], value ])
+      elif isinstance(value, list) and isinstance(merged[key], list):
+        merged[key] = merged[key] + value
+      elif (isinstance(value, int) and not isinstance(value, bool) and
+            isinstance(merged[key], int)):
+        merged[key] += value
+
+  return merged
+
+
+def split_aggregations(data, indexes, size=0):
+  '''
+  Extract the results for a subset of aggs from a combined response
+
+  Parameters:
+    data(dict): Decoded JSON aggregation response
+    indexes(list): Positions in results to extract, in order
+    size(int): Top-N to keep for each result, 0 keeps all
+
+  Returns:
+    dict in the same form as a response for those aggs alone
+  '''
+  split = { k: v for k, v in data.items() if k != 'results' }
+  results = data.get('results') or []
+  split['results'] = []
+  for index in indexes:
+    if index < len(results):
+      result = dict(results[index])
+      buckets = result.get('sub_bucket')
+      if size and isinstance(buckets, list) and len(buckets) > size:
+        buckets = sorted(buckets, key=lambda b: int(b.get('count', 0)),
+                         reverse=True)
+        result['sub_bucket'] = buckets[:size]
+      split['results'].append(result)
+
+  return split
+
+
+def merge_aggregations(datas, size=0):
+  '''
+  Merge aggregation responses for adjacent time windows
+
+  Buckets are matched on key at every level of the nested
+  results[].sub_bucket tree and counts summed. The top level buckets of
+  each result are re-ranked by count and truncated to size.
+
+  Parameters:
+    datas(list): Decoded JSON aggregation responses
+    size(int): Top-N to keep for each result, 0 keeps all
+
+  Returns:
+    dict in the same form as a single response
+  '''
+  merged = {}
+  for data in datas:
+    for key, value in data.items():
+      if key == 'results':
+        continue
+      if key not in merged:
+        merged[key] = value
+      elif (isinstance(value, int) and not isinstance(value, bool) and
+            isinstance(merged[key], int)):
+        merged[key] += value
+
+  # Results are positional, one per aggregation key
+  results = []
+  result_lists = [ data.get('results') or [] for data in datas ]
+  for index in range(max([ len(r) for r in result_lists ] or [0])):
+    entries = [ r[index] for r in result_lists if len(r) > index ]
+    result = _merge_buckets([ entries ])[0]
+    buckets = result.get('sub_bucket', [])
+    if buckets and all('count' in b for b in buckets):
+      buckets.sort(key=lambda b: int(b['count']), reverse=True)
+      if size:
+        del buckets[size:]
+    results.append(result)
+  if any('results' in data for data in datas):
+    merged['results'] = results
+
+  return merged
+
+
 class b1reporting(bloxone.b1):
   '''
   Experimental Reporting Class
@@ -56,11 +487,41 @@ class b1reporting(bloxone.b1):
     This class uses undocumented API calls that may change without notice
   
   '''
-  def __init__(self, cfg_file='config.ini'):
+  def __init__(self, cfg_file='config.ini', cache=None, rollups=None,
+               transport=None, metrics=None):
     '''
     Call base __init__ and extend
+
+    Parameters:
+      cfg_file (str): bloxone inifile
+      cache (obj): Optional b1cache.ResponseCache instance
+      rollups (obj): Optional b1rollup.RollupStore instance
+      transport (obj): Optional b1transport.Transport instance, may be
+                       shared between instances
+      metrics (obj): Optional b1metrics.Metrics instance
     '''
     super().__init__(cfg_file)
+    self.cache = cache
+    # Bypass (and update) cached responses
+    self.refresh = False
+    self.rollups = rollups
+    self.metrics = metrics
+    # Size multiplier for per day/shard top-N queries that are merged
+    self.oversample = 5
+    # Default shard length for get_insight()/security_activity(), e.g. '1d'
+    self.shard = ''
+    self.max_workers = 8
+    # Requests in flight, at most max_workers however they are fanned out
+    self._slots = None
+    self._slots_lock = threading.Lock()
+    # Current time source, epoch seconds, fixed when replaying
+    self.clock = None
+    # In flight and completed requests shared within a snapshot()
+    self._flights = None
+    self._flights_lock = threading.Lock()
+    self.insights = copy.deepcopy(INSIGHTS)
+    self.transport = transport or b1transport.Transport(
+                                    pool_size=self.max_workers)
     self.dns_events_url = self.base_url + '/api/dnsdata/v2'
     self.ti_reports_url = self.base_url + '/api/ti-reports/' + self.cfg['api_version']
     self.aggr_reports_url  = self.ti_reports_url + '/activity/aggregations'
@@ -70,12 +531,61 @@ class b1reporting(bloxone.b1):
     return
 
 
+  def now(self):
+    '''
+    Current time used for query windows
+
+    Returns:
+      epoch seconds (int), from self.clock if set
+    '''
+    if self.clock:
+      now = int(self.clock())
+    else:
+      now = int(datetime.datetime.now().timestamp())
+
+    return now
+
+
+  @contextlib.contextmanager
+  def snapshot(self, now=None):
+    '''
+    Fix the current time for all queries made within the block, so that
+    every call of a report covers the same time windows, and share
+    identical requests
+
+    Within the block concurrent or repeated identical requests (method,
+    URL and body) make a single API call and share one response, and so
+    one decoded body. Nested blocks use the outer snapshot.
+
+    Parameters:
+      now(int): Time to use, epoch seconds, default self.now()
+
+    Yields:
+      now (int)
+    '''
+    if self._flights is not None:
+      yield self.now()
+      return
+
+    now = int(now if now is not None else self.now())
+    clock = self.clock
+    self.clock = lambda: now
+    self._flights = {}
+    try:
+      yield now
+    finally:
+      self.clock = clock
+      self._flights = None
+
+    return
+
+
   def convert_time_delta(self, delta):
     '''
     Convert digit/unit e.g. 1d to dict
 
     Parameters:
-      delta (str): period 3d, 2w, 1m, i.e. \d*[dwm]
+      delta (str): period 6h, 3d, 2w, 1m, i.e. \d*[hdwm]
     
     Returns:
       dict in form to pass to datetime
@@ -85,8 +595,10 @@ class b1reporting(bloxone.b1):
       no_of = int(delta[:-1])
       unit = delta[-1:].lower()
 
-      if unit in ['d', 'w', 'm']:
-        if unit == 'd':
+      if unit in ['h', 'd', 'w', 'm']:
+        if unit == 'h':
+          result.update({ 'hours': no_of })
+        elif unit == 'd':
           result.update({ 'days': no_of })
         elif unit == 'w':
           result.update({ 'weeks': no_of })
@@ -94,7 +606,8 @@ class b1reporting(bloxone.b1):
           no_of = 4 * no_of
           result.update({ 'weeks': no_of })
       else:
-        logging.error(f'Unit must be one of d:days, w:weeks, m:months not {unit}')
+        logging.error(f'Unit must be one of h:hours, d:days, w:weeks, '
+                      f'm:months not {unit}')
         result.update({ 'days': 1 })
     else:
       raise(TypeError)
@@ -102,28 +615,300 @@ class b1reporting(bloxone.b1):
     return result
 
 
-  def security_activity(self, period="1d", **params):
+  def _time_window(self, period):
+    '''
+    Calculate query time window for period ending now, or ending an
+    offset before now for periods in the form 1w@1w, see
+    previous_period()
+
+    When a cache is in use the end of the window is snapped down to the
+    cache granularity so that repeated queries generate the same key.
+    An offset window ends exactly where the window of the same period
+    without offset starts, so the two periods are contiguous.
+
+    Parameters:
+      period(str): Period in form of 3d, 2w, 1d, optionally @offset
+
+    Returns:
+      Tuple of (t0, t1) as epoch seconds
+    '''
+    period, _, offset = str(period).partition('@')
+    delta = self.convert_time_delta(period)
+    t1 = self.now()
+    if self.cache and self.cache.granularity:
+      t1 -= t1 % self.cache.granularity
+    if offset:
+      t1 -= int(datetime.timedelta(
+                  **self.convert_time_delta(offset)).total_seconds())
+    t0 = t1 - int(datetime.timedelta(**delta).total_seconds())
+
+    return t0, t1
+
+
+  def split_window(self, t0, t1, shard):
+    '''
+    Split time window into shards
+
+    Parameters:
+      t0(int): Start of window, epoch seconds
+      t1(int): End of window, epoch seconds
+      shard(str/int): Shard length in form of 1d, 1w or number of shards,
+                      as an int or digit string, e.g. from an inifile
+
+    Returns:
+      List of (t0, t1) tuples
+
+    Raises:
+      ValueError for a shard length of 0 or a shard count below 1
+    '''
+    if isinstance(shard, int) or str(shard).strip().isdigit():
+      if int(shard) < 1:
+        raise ValueError(f'Shard count must be at least 1, not {shard}')
+      length = -(-(t1 - t0) // int(shard))
+    else:
+      delta = self.convert_time_delta(str(shard).strip())
+      length = int(datetime.timedelta(**delta).total_seconds())
+      if length <= 0:
+        raise ValueError(f'Shard length must be positive, not {shard}')
+    windows = []
+    start = t0
+    while start < t1:
+      windows.append((start, min(start + length, t1)))
+      start += length
+
+    return windows
+
+
+  def _request_slot(self):
+    '''
+    Semaphore bounding the requests in flight to self.max_workers
+
+    Concurrent fetches can be nested, e.g. sharded insights within
+    get_insights(), each with its own threads. All requests of the
+    instance take a slot, so the --workers limit and the transport
+    connection pool hold however the calls are fanned out.
+
+    Returns:
+      threading.BoundedSemaphore
+    '''
+    with self._slots_lock:
+      size = max(1, self.max_workers)
+      if self._slots is None or self._slots[0] != size:
+        self._slots = (size, threading.BoundedSemaphore(size))
+
+    return self._slots[1]
+
+
+  def _fetch_concurrent(self, func, arg_list):
+    '''
+    Call func(*args) for each args tuple concurrently
+
+    Requests made by func are bounded by _request_slot(), not by the
+    number of threads.
+
+    Parameters:
+      func(callable): e.g. func(t0, t1) returning a response object
+      arg_list(list): Argument tuples, e.g. (t0, t1) windows
+
+    Returns:
+      List of results in arg_list order
+    '''
+    if len(arg_list) == 1:
+      return [ func(*arg_list[0]) ]
+    workers = max(1, min(self.max_workers, len(arg_list)))
+    if self.metrics:
+      # Keep the API call label in the worker threads
+      func = self.metrics.bind(func)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+      jobs = [ pool.submit(func, *args) for args in arg_list ]
+      results = [ job.result() for job in jobs ]
+
+    return results
+
+
+  def _request(self, method, url, body='', headers='', stream=False):
+    '''
+    Make API call, within a snapshot() identical requests share a
+    single call and response
+
+    Parameters:
+      method (str): 'GET' or 'POST'
+      url (str): Full URL
+      body (str): JSON body for POST
+      headers (dict): Optional headers
+      stream (bool): Leave the body unread, see _send(), never shared
+    
+    Returns:
+        b1response.B1Response object
+    '''
+    flights = self._flights
+    if flights is None or stream:
+      return self._send(method, url, body, headers, stream)
+
+    key = (method, url, body)
+    with self._flights_lock:
+      flight = flights.get(key)
+      owner = flight is None
+      if owner:
+        flight = flights[key] = concurrent.futures.Future()
+    if not owner:
+      logging.debug(f'Sharing response for {method} {url}')
+      if self.metrics:
+        self.metrics.record_shared()
+      return flight.result()
+
+    try:
+      response = self._send(method, url, body, headers)
+    except BaseException as err:
+      # Do not share failures, a later request may succeed
+      with self._flights_lock:
+        flights.pop(key, None)
+      flight.set_exception(err)
+      raise
+    flight.set_result(response)
+
+    return response
+
+
+  def _send(self, method, url, body='', headers='', stream=False):
+    '''
+    Make API call through the transport, using the response cache
+    when configured, and record it in self.metrics if set
+
+    Responses are returned as b1response.B1Response objects so that the
+    body is decoded at most once however many callers use it.
+
+    Parameters:
+      method (str): 'GET' or 'POST'
+      url (str): Full URL
+      body (str): JSON body for POST
+      headers (dict): Optional headers
+      stream (bool): Leave the body unread, to be parsed incrementally
+                     with iter_records() or iter_buckets(). Streamed
+                     responses are not added to the cache
+    
+    Returns:
+        b1response.B1Response object
+    '''
+    key = None
+    start = time.perf_counter()
+    if self.cache:
+      key = self.cache.make_key(self.api_key, method, url, body)
+      response = self.cache.get(key, refresh=self.refresh)
+      if response is not None:
+        return self._record_call(method, url, 
+                                 b1response.B1Response(response), start,
+                                 cached=True)
+
+    try:
+      with self._request_slot():
+        # Time the call itself, not the wait for a slot
+        start = time.perf_counter()
+        response = self.transport.request(method, url, 
+                                          headers=headers or self.headers,
+                                          data=body or None, stream=stream)
+    # Catch exceptions
+    except requests.exceptions.RequestException as e:
+      logging.error(e)
+      logging.debug(f'url: {url}')
+      logging.debug(f'body: {body}')
+      raise
+
+    if key and not stream:
+      self.cache.put(key, response)
+
+    return self._record_call(method, url, b1response.B1Response(response),
+                             start, stream=stream)
+
+
+  def _record_call(self, method, url, response, start, cached=False,
+                   stream=False):
+    '''
+    Add API call to self.metrics, if set
+
+    Returns:
+      response, with JSON decoding timed
+    '''
+    if self.metrics:
+      if stream:
+        # Do not read a streamed body to size it
+        nbytes = int(response.headers.get('Content-Length') or 0)
+      else:
+        nbytes = len(response.content)
+      call = self.metrics.record_call(method, url, response.status_code,
+                                      time.perf_counter() - start,
+                                      retries=getattr(response, 'retries', 0),
+                                      nbytes=nbytes, cached=cached)
+      self.metrics.instrument(response, call)
+
+    return response
+
+
+  def _not_found_response(self, b1object='object'):
+    '''
+    Generate an error response without an API call
+
+    Returns:
+      b1response.B1Response object
+    '''
+    return b1response.B1Response(super()._not_found_response(b1object))
+
+
+  def _apiget(self, url, stream=False):
+    return self._request('GET', url, stream=stream)
+
+
+  def _apipost(self, url, body, headers='', stream=False):
+    return self._request('POST', url, body, headers=headers, stream=stream)
+
+
+  def security_activity(self, period="1d", shard=None, **params):
     '''
     Get security activity log for specified period
 
     Parameters:
       period(str): Period in form of 3d, 2w, 1d
+      shard(str/int): Optional shard length, e.g. 1d, or number of
+                      shards fetched concurrently and merged,
+                      defaults to self.shard
     
     Returns:
         requests response object
     '''
-    delta = self.convert_time_delta(period)
-    now = datetime.datetime.now()
-    dt = now - datetime.timedelta(**delta)
-    t1 = int(now.timestamp())
-    t0 = int(dt.timestamp())
+    t0, t1 = self._time_window(period)
+    if shard is None:
+      shard = self.shard
+
+    if shard:
+      windows = self.split_window(t0, t1, shard)
+      responses = self._fetch_concurrent(
+          lambda w0, w1: self.security_activity_window(w0, w1, **params),
+          windows)
+      response = self._merge_responses(responses, merge_records)
+    else:
+      response = self.security_activity_window(t0, t1, **params)
+
+    return response
+
 
+  def security_activity_window(self, t0, t1, stream=False, **params):
+    '''
+    Get security activity log for an explicit time window
+
+    Parameters:
+      t0(int): Start of window, epoch seconds
+      t1(int): End of window, epoch seconds
+      stream(bool): Leave body unread for incremental parsing
+    
+    Returns:
+        requests response object
+    '''
     # Build url
     url =  self.sec_act_url + '?t0=' + str(t0) +'&t1=' + str(t1)
-    url = self._add_params(url, **params)
+    url = self._add_params(url, first_param=False, **params)
     logging.debug("URL: {}".format(url))
 
-    response = self._apiget(url)
+    response = self._apiget(url, stream=stream)
 
     return response
 
@@ -138,13 +923,25 @@ class b1reporting(bloxone.b1):
     Returns:
         requests response object
     '''
-    sources = [ 'rpz', 'category', 'analytics' ]
-    delta = self.convert_time_delta(period)
-    now = datetime.datetime.now()
-    dt = now - datetime.timedelta(**delta)
-    t1 = int(now.timestamp())
-    t0 = int(dt.timestamp())
+    t0, t1 = self._time_window(period)
+
+    return self.dns_events_window(t0, t1, source=source, **params)
+
 
+  def dns_events_window(self, t0, t1, source='', stream=False, **params):
+    '''
+    Get DNS events log for an explicit time window
+
+    Parameters:
+      t0(int): Start of window, epoch seconds
+      t1(int): End of window, epoch seconds
+      source(str): One of ['rpz', 'category', 'analytics']
+      stream(bool): Leave body unread for incremental parsing
+    
+    Returns:
+        requests response object
+    '''
+    sources = [ 'rpz', 'category', 'analytics' ]
     url = self.dns_events_url + f'?t0={t0}&t1={t1}'
     
     if source:
@@ -155,148 +952,689 @@ class b1reporting(bloxone.b1):
     url = self._add_params(url, first_param=False, **params)
     logging.debug(f'dns_events URL: {url}')
     
-    response = self._apiget(url)
+    response = self._apiget(url, stream=stream)
 
     return response
 
 
-  def get_insight(self, insight, period="1w"):
+  def iter_security_activity(self, period='1d', page_size=1000, **params):
     '''
-    Get "insight" summaries
+    Iterate over all security hits for period, one page at a time
 
     Parameters:
-      insight(str): One of ['activity', 'total_queries', 'doh', 'malware',
-                            'category', 'tclass', 'tproperty', 'dex']
       period(str): Period in form of 3d, 2w, 1d
+      page_size(int): Records requested per page
+    
+    Yields:
+        hit records (dict)
+
+    Raises:
+        requests.HTTPError on a failed page
+    '''
+    t0, t1 = self._time_window(period)
+
+    return self.iter_pages(
+        lambda **p: self.security_activity_window(t0, t1, **p),
+        page_size=page_size, **params)
+
+
+  def iter_dns_events(self, period='1d', source='', page_size=1000, 
+                      **params):
+    '''
+    Iterate over all DNS events for period, one page at a time
+
+    Parameters:
+      period(str): Period in form of 3d, 2w, 1d
+      source(str): One of ['rpz', 'category', 'analytics']
+      page_size(int): Records requested per page
+    
+    Yields:
+        event records (dict)
+
+    Raises:
+        requests.HTTPError on a failed page
+    '''
+    t0, t1 = self._time_window(period)
+
+    return self.iter_pages(
+        lambda **p: self.dns_events_window(t0, t1, source=source, **p),
+        page_size=page_size, **params)
+
+
+  def iter_dns_events_merged(self, period='1d', sources=None, shard=None,
+                             page_size=1000, fields=None,
+                             time_field='event_time', 
+                             max_ahead=MERGE_AHEAD, **params):
+    '''
+    Iterate over DNS events for several sources in time order, fetching
+    sources and time shards concurrently
+
+    Shards are fetched up to self.max_workers at a time ahead of the one
+    being returned, while fewer than max_ahead records are held, and the
+    sources of each shard are merged on time_field. Memory use is
+    therefore bounded by the shard length and max_ahead rather than the
+    period, use shorter shards for busy networks.
+
+    Parameters:
+      period(str): Period in form of 6h, 3d, 2w, 1d
+      sources(list): DNS event sources, default all of SOURCE_TYPES
+      shard(str/int): Shard length, e.g. 1h, or number of shards,
+                      defaults to self.shard or MERGE_SHARD
+      page_size(int): Records requested per page
+      fields(list): Fields returned by the API (_fields), time_field is
+                    always included
+      time_field(str): Record field used to order the output
+      max_ahead(int): Records of fetched shards held before fetching
+                      further shards
+      **params: Additional query parameters, e.g. _filter
+    
+    Yields:
+        event records (dict), oldest first
+
+    Raises:
+        requests.HTTPError on a failed page
+    '''
+    t0, t1 = self._time_window(period)
+    sources = sources or list(SOURCE_TYPES.keys())
+    windows = self.split_window(t0, t1, shard or self.shard or MERGE_SHARD)
+    if fields:
+      fields = list(fields)
+      if time_field not in fields:
+        fields.append(time_field)
+      params['_fields'] = ','.join(fields)
+
+    def order(record):
+      return record.get(time_field) or ''
+
+    def fetch(w0, w1, source):
+      records = list(self.iter_pages(
+          lambda **p: self.dns_events_window(w0, w1, source=source, **p),
+          page_size=page_size, **params))
+      records.sort(key=order)
+      logging.debug(f'{source} {w0}-{w1}: {len(records)} events')
+      return records
+
+    def held():
+      # Records of fetched shards not yet returned
+      return sum([ len(job.result()) for job in jobs if job.done() and
+                   not job.exception() ])
+
+    if self.metrics:
+      fetch = self.metrics.bind(fetch)
+
+    tasks = iter([ (w0, w1, s) for w0, w1 in windows for s in sources ])
+    # Jobs fetched ahead of the shard being returned
+    ahead = max(self.max_workers, len(sources)) * 2
+    workers = max(1, self.max_workers)
+    jobs = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+      try:
+        while True:
+          # Always fetch the next shard, further shards while few
+          # records are held
+          while (len(jobs) < len(sources) or
+                 (len(jobs) < ahead and held() < max_ahead)):
+            task = next(tasks, None)
+            if task is None:
+              break
+            jobs.append(pool.submit(fetch, *task))
+          if not jobs:
+            break
+          shard_jobs = [ jobs.popleft() for _ in sources ]
+          yield from heapq.merge(*[ job.result() for job in shard_jobs ],
+                                 key=order)
+      finally:
+        for job in jobs:
+          job.cancel()
+
+    return
+
+
+  def aggregate_hits(self, period, columns, page_size=1000, **params):
+    '''
+    Stream all hits for period into a local aggregator
+
+    Parameters:
+      period(str): Period in form of 3d, 2w, 1d
+      columns(list): Key paths to keep, e.g. ['feed_name', 'user']
+      page_size(int): Records requested per page
     
     Returns:
-        requests response object
+        b1aggregate.HitAggregator instance
+    '''
+    aggregator = b1aggregate.HitAggregator(columns)
+    count = aggregator.extend(self.iter_security_activity(period,
+                                  page_size=page_size, **params),
+                              progress=100000)
+    logging.info(f'{count:,} hits aggregated')
+
+    return aggregator
+
+
+  def iter_pages(self, fetch, page_size=1000, stream=True, **params):
+    '''
+    Page through an activity endpoint using _offset and _limit
+
+    By default each page body is parsed incrementally as it is
+    received, so only the current record is held in memory whatever
+    the page size. Otherwise a single page is held at any time.
+
+    The API may return fewer records than page_size per page, so paging
+    ends on an empty page or on a page shorter than an earlier one.
+
+    Parameters:
+      fetch(callable): Called with query params, returns response
+      page_size(int): Records requested per page
+      stream(bool): Parse pages incrementally
+    
+    Yields:
+        records (dict)
+
+    Raises:
+        requests.HTTPError on a failed page
+    '''
+    offset = 0
+    # Largest page returned, the server limit if below page_size
+    largest = 0
+    while True:
+      response = fetch(_offset=str(offset), _limit=str(page_size), 
+                       stream=stream, **params)
+      if response.status_code not in self.return_codes_ok:
+        logging.error(f'Error retrieving page at offset {offset}')
+        logging.info(f'HTTP Code: {response.status_code}')
+        logging.info(f'Response: {response.text}')
+        response.raise_for_status()
+      count = 0
+      try:
+        if stream:
+          for record in response.iter_records():
+            count += 1
+            yield record
+        else:
+          records = page_records(response.json())
+          count = len(records)
+          yield from records
+      finally:
+        response.close()
+      logging.debug(f'Page at offset {offset}: {count} records')
+      if count == 0 or count < largest:
+        break
+      largest = max(largest, count)
+      offset += count
+
+    return
+
+
+  def insight_query(self, insight, t0, t1, spec=None):
+    '''
+    Build URL and aggregation body for an insight
 
+    Parameters:
+      insight(str): Name of an insight in the registry, see INSIGHTS
+                    and register_insight()
+      t0(int): Start of window, epoch seconds
+      t1(int): End of window, epoch seconds
+      spec(dict): Insight spec to use rather than the registry entry
+    
+    Returns:
+        Tuple of (url, body (dict)), body is empty if not registered
     '''
     body = {}
-    delta = {}
-    delta = self.convert_time_delta(period)
-    now = datetime.datetime.now()
-    dt = now - datetime.timedelta(**delta)
-    t1 = int(now.timestamp())
-    t0 = int(dt.timestamp())
     url = self.insights_url
+    spec = spec or self.insights.get(insight)
 
-    # Generate body
-    if insight == 'activity':
-      body = { "include_count": True, "t0": t0, "t1": t1,
-               "_filter": "type in ['2', '3'] and severity != 'Info'",
-               "aggs": [ { "key": "severity" } ],
-               "size": 3 }
-
-    elif insight == 'total_queries':
-      body = { "include_count": True, 
-               "t0": t0, "t1": t1,
-               "_filter": "type in ['1']",
-               "aggs": [ { "key": "type", 
-                          "sub_key": [ { "key": "policy_action" } ] } ],
-               "size": 1 }
-
-    elif insight == 'doh':
-      filter = ( "type in ['2'] and category == null and severity != 'Low' " +
-                 "and severity != 'Info' and feed_name == 'Public_DOH' or " +
-                 "feed_name == 'public-doh' or feed_name == 'Public_DOH_IP' " +
-                 "or feed_name == 'public-doh-ip'" )
-      body = { "include_count": True,
-                "t0": t0, "t1": t1,
-                "_filter": filter,
-                "aggs": [ { "key": "threat_indicator",
-                           "sub_key": [ { "key": "feed_name" },
-                                        { "key": "user" },
-                                        { "key": "device_name" } ] 
-                         } ],
-               "size": 10 } 
-
-    elif insight == 'malware':
-      body = { "include_count": True,
-               "t0": t0, "t1": t1,
-                "_filter": "type in ['2'] and tclass == 'Malware*'",
-                "aggs": [ { "key": "tproperty", 
-                            "sub_key": [ { "key": "device_name" },
-                                         { "key": "user" } ] } ],
-                "size": 10 }
-
-    elif insight == 'category':
-      filter = ( "type in ['3'] and feed_name=='CAT_Mal*' or " +
-                 "feed_name=='CAT_Phi*' or feed_name=='CAT_Spam*'" )
-      body = { "include_count": True,
-               "t0": t0, "t1": t1,
-               "_filter": filter,
-               "aggs": [ { "key": "feed_name",
-                           "sub_key": [ { "key": "device_name" },
-                                        { "key": "user" } ] } ],
-               "size": 20 }
-
-    elif insight == 'tclass':
-      body =  { "count": False, "t0": t0, "t1": t1,
-                "_filter": "type in ['2','3','4']",
-                "aggs": [ { "key": "tclass" } ],
-                "size": 20 } 
-
-    elif insight == 'tproperty':
-      body = { "include_count": True,
-                        "t0": t0, "t1": t1,
-                        "_filter": "type in ['2']",
-                        "aggs": [ { "key": "tproperty" } ],
-                        "size": 5 }
-
-    elif insight == 'dex':
-      url = self.aggr_reports_url
-      body = { "t0": t0, "t1": t1,
-               "_filter": "type in ['4']",
-               "aggs": [ { "key": "tproperty" },
-                         { "key": "user" },
-                         { "key": "network" } ],
-               "size": 10000 }
-
-    elif insight == 'indicator_client_count':
-      filter = ( "type in ['2'] and category == null and severity != 'Low' " +
-                 "and severity != 'Info'" )
-      body = { "include_count": True,
-                "t0": t0, "t1": t1,
-                "_filter": filter,
-                "aggs": [ { "key": "threat_indicator",
-                           "sub_key": [ { "key": "feed_name" },
-                                        { "key": "user" },
-                                        { "key": "device_name" } ] 
-                         } ],
-               "size": 10 } 
+    if spec:
+      if spec.get('endpoint') == 'aggregations':
+        url = self.aggr_reports_url
+      body = dict(spec.get('options', {}))
+      body.update({ "t0": t0, "t1": t1 })
+      if spec.get('filter'):
+        body['_filter'] = spec['filter']
+      body['aggs'] = copy.deepcopy(spec['aggs'])
+      body['size'] = spec['size']
     else:
       logging.error(f'{insight} report not currently supported')
-      body = {}
     
-    logging.debug(f'URL: {url}, Body: {body}')
+    return url, body
+
+
+  def register_insight(self, name, spec):
+    '''
+    Add or replace an insight in the registry
+
+    Parameters:
+      name(str): Insight name
+      spec(dict): { 'endpoint': 'insights' or 'aggregations',
+                    'filter': str, 'aggs': list, 'size': int,
+                    'options': dict of additional body fields }
+    '''
+    spec = insight_spec(name, spec)
+    self.insights[name] = spec
+    logging.debug(f'Insight {name} registered: {spec}')
+
+    return
+
+
+  def load_insights(self, ini_filename):
+    '''
+    Register insights from [Insight <name>] sections of an inifile, see
+    read_insights()
+
+    ..Note::
+      Registered insights apply to every later query of this instance,
+      use insight_registry() and the registry argument of get_insights()
+      for per report insights
+
+    Parameters:
+      ini_filename(str): inifile, e.g. the report inifile
+
+    Returns:
+      List of insight names registered
+    '''
+    insights = read_insights(ini_filename)
+    for name, spec in insights.items():
+      self.register_insight(name, spec)
+
+    return list(insights.keys())
+
+
+  def plan_insights(self, insights, registry=None):
+    '''
+    Group insights that can share a single request
+
+    Insights are compatible when they use the same endpoint and filter
+    and have no conflicting options. Each group becomes a combined
+    insight (name joined with '+') with the aggs of all members and the
+    largest size. Combined specs are returned with the plan, neither
+    registry is changed.
+
+    Parameters:
+      insights(list): Insight names
+      registry(dict): Insight specs, default self.insights, see
+                      insight_registry()
+
+    Returns:
+      List of (combined name, [ (insight, [agg indexes]) ], spec) tuples,
+      spec is None for an unknown insight
+    '''
+    if registry is None:
+      registry = self.insights
+    groups = []
+    for insight in insights:
+      spec = registry.get(insight)
+      if not spec:
+        groups.append((insight, [ (insight, []) ], None))
+        continue
+      for group in groups:
+        combined = group[2]
+        if (combined and 
+            combined['endpoint'] == spec.get('endpoint', 'insights') and
+            combined['filter'] == spec.get('filter', '') and
+            all(combined['options'].get(k, v) == v 
+                for k, v in spec.get('options', {}).items())):
+          break
+      else:
+        group = (None, [], { 'endpoint': spec.get('endpoint', 'insights'),
+                             'filter': spec.get('filter', ''),
+                             'options': {}, 'aggs': [], 'size': 0 })
+        groups.append(group)
+      combined = group[2]
+      indexes = []
+      for agg in spec['aggs']:
+        if agg not in combined['aggs']:
+          combined['aggs'].append(copy.deepcopy(agg))
+        indexes.append(combined['aggs'].index(agg))
+      combined['options'].update(spec.get('options', {}))
+      combined['size'] = max(combined['size'], spec['size'])
+      group[1].append((insight, indexes))
+
+    plan = []
+    for _, members, combined in groups:
+      name = '+'.join([ m[0] for m in members ])
+      if combined and len(members) == 1:
+        combined = registry[name]
+      plan.append((name, members, combined))
+    logging.debug(f'Insight plan: {[ p[0] for p in plan ]}')
+
+    return plan
+
+
+  def get_insights(self, insights, period="1w", registry=None):
+    '''
+    Get several insights using the fewest requests
+
+    Compatible insights are combined into multi-agg requests (see
+    plan_insights()), the requests are made concurrently and each
+    response is split back per insight.
+
+    Parameters:
+      insights(list): Insight names
+      period(str): Period in form of 3d, 2w, 1d
+      registry(dict): Insight specs, default self.insights, see
+                      insight_registry()
+
+    Returns:
+      dict of insight name: requests response object
+    '''
+    if registry is None:
+      registry = self.insights
+    results = {}
+    plan = self.plan_insights(insights, registry)
+    logging.info(f'Retrieving {len(insights)} insights in '
+                 f'{len(plan)} requests')
+    responses = self._fetch_concurrent(self._get_planned,
+                                       [ (name, period, spec) 
+                                         for name, _, spec in plan ])
+
+    for (name, members, _), response in zip(plan, responses):
+      if len(members) == 1:
+        results[members[0][0]] = response
+      elif response.status_code not in self.return_codes_ok:
+        for insight, _ in members:
+          results[insight] = response
+      else:
+        data = response.json()
+        for insight, indexes in members:
+          results[insight] = json_response(
+              split_aggregations(data, indexes,
+                                 registry[insight]['size']))
+
+    return results
+
+
+  def _get_planned(self, name, period, spec):
+    '''
+    Get a planned (possibly combined) insight
+    '''
+    if spec:
+      response = self.get_insight(name, period, spec=spec)
+    else:
+      logging.error(f'{name} report not currently supported')
+      response = self._not_found_response(f'{name} insight')
+
+    return response
+
+
+  def get_insight_window(self, insight, t0, t1, spec=None):
+    '''
+    Get "insight" summary for an explicit time window
+
+    Parameters:
+      insight(str): Insight name, see insight_query()
+      t0(int): Start of window, epoch seconds
+      t1(int): End of window, epoch seconds
+      spec(dict): Optional insight spec, see insight_query()
+    
+    Returns:
+        requests response object
+    '''
+    url, body = self.insight_query(insight, t0, t1, spec)
+    logging.debug('URL: %s, Body: %s', url, body)
+    response = self._apipost(url, json.dumps(body), headers=self.headers)
+    logging.debug('Response: %s', b1response.Lazy(response.json))
+
+    return response
+
+
+  def iter_insight_buckets(self, insight, period="1w", spec=None):
+    '''
+    Stream the top level buckets of an "insight" summary, parsing the
+    response incrementally rather than decoding it as a whole, e.g. for
+    the 10,000 bucket aggregations of 'dex'
+
+    The window is requested as a single query, the cache and rollup
+    store are not used.
+
+    Parameters:
+      insight(str): Insight name, see insight_query()
+      period(str): Period in form of 3d, 2w, 1d
+      spec(dict): Optional insight spec, see insight_query()
+    
+    Yields:
+        (aggregation key, b1response.Bucket) tuples
+
+    Raises:
+        requests.HTTPError on failure
+    '''
+    t0, t1 = self._time_window(period)
+    url, body = self.insight_query(insight, t0, t1, spec)
+    keys = [ agg.get('key') for agg in body.get('aggs', []) ]
+    logging.debug('URL: %s, Body: %s', url, body)
+
+    with b1metrics.label(self.metrics, insight):
+      response = self._apipost(url, json.dumps(body), headers=self.headers,
+                               stream=True)
+    if response.status_code not in self.return_codes_ok:
+      logging.error(f'Error retrieving {insight} buckets')
+      logging.info(f'HTTP Code: {response.status_code}')
+      logging.info(f'Response: {response.text}')
+      response.raise_for_status()
+    try:
+      for index, bucket in response.iter_buckets():
+        yield keys[index] if index < len(keys) else index, bucket
+    finally:
+      response.close()
+
+    return
+
+
+  def get_insight(self, insight, period="1w", shard=None, spec=None):
+    '''
+    Get "insight" summaries
+
+    When a rollup store is configured complete days are served from
+    the store and only missing days are requested. Otherwise the window
+    can be split into shards that are fetched concurrently and merged.
+
+    Parameters:
+      insight(str): One of ['activity', 'total_queries', 'doh', 'malware',
+                            'category', 'tclass', 'tproperty', 'dex']
+      period(str): Period in form of 3d, 2w, 1d
+      shard(str/int): Optional shard length, e.g. 1d, or number of
+                      shards, defaults to self.shard
+      spec(dict): Optional insight spec, see insight_query()
+    
+    Returns:
+        requests response object
+
+    '''
+    t0, t1 = self._time_window(period)
+    if shard is None:
+      shard = self.shard
+
+    with b1metrics.label(self.metrics, insight):
+      if self.rollups:
+        response = self.get_insight_rollup(insight, t0, t1, spec)
+      elif shard:
+        response = self.get_insight_sharded(insight, t0, t1, shard, spec)
+      else:
+        response = self.get_insight_window(insight, t0, t1, spec)
+
+    return response
+
+
+  def get_insight_sharded(self, insight, t0, t1, shard, spec=None):
+    '''
+    Get "insight" summary as concurrent sub-window queries
+
+    Parameters:
+      insight(str): Insight name, see insight_query()
+      t0(int): Start of window, epoch seconds
+      t1(int): End of window, epoch seconds
+      shard(str/int): Shard length, e.g. 1d, or number of shards
+      spec(dict): Optional insight spec, see insight_query()
+    
+    Returns:
+        requests response object, same structure as get_insight_window()
+    '''
+    size = self.insight_query(insight, t0, t1, spec)[1].get('size', 0)
+    windows = self.split_window(t0, t1, shard)
+    logging.debug(f'{insight}: fetching {len(windows)} shards')
+    responses = self._fetch_concurrent(
+        lambda w0, w1: self._get_insight_oversampled(insight, w0, w1, size,
+                                                     spec),
+        windows)
+
+    return self._merge_responses(responses,
+               lambda datas: merge_aggregations(datas, size=size))
+
+
+  def _merge_responses(self, responses, merge):
+    '''
+    Merge shard responses, returning the first failure if any
+    '''
+    for response in responses:
+      if response.status_code not in self.return_codes_ok:
+        return response
+    if len(responses) == 1:
+      return responses[0]
+
+    return json_response(merge([ r.json() for r in responses ]))
+
+
+  def get_insight_rollup(self, insight, t0, t1, spec=None):
+    '''
+    Get "insight" summary using stored per day aggregations
+
+    The window is split on UTC day boundaries, complete days missing
+    from the rollup store are fetched and stored, partial days at either
+    end are always fetched. Daily results are merged locally and the top
+    level buckets re-ranked.
+
+    ..Note::
+      Each day is itself a server side top-N, days are therefore
+      requested with size multiplied by oversample to keep the
+      merged ranking accurate.
+
+    Parameters:
+      insight(str): Insight name, see insight_query()
+      t0(int): Start of window, epoch seconds
+      t1(int): End of window, epoch seconds
+      spec(dict): Optional insight spec, see insight_query()
+    
+    Returns:
+        requests response object
+    '''
+    size = self.insight_query(insight, t0, t1, spec)[1].get('size', 0)
+    tenant = self.rollups.tenant(self.api_key)
+    # Days are stored per query, a changed insight spec is fetched again
+    query = b1rollup.query_digest(self._oversampled_query(insight, t0, t1,
+                                                          size, spec)[1])
+    windows = split_days(t0, t1, now=self.now())
+
+    datas = {}
+    missing = []
+    for w0, w1, complete in windows:
+      data = self.rollups.get(tenant, insight, w0, query) if complete else None
+      if data is None:
+        missing.append((w0, w1))
+      else:
+        logging.debug(f'Rollup hit: {insight} {w0}')
+        datas[w0] = data
+
+    responses = self._fetch_concurrent(
+        lambda w0, w1: self._get_insight_oversampled(insight, w0, w1, size,
+                                                     spec),
+        missing)
+    for (w0, w1), response in zip(missing, responses):
+      if response.status_code not in self.return_codes_ok:
+        return response
+      datas[w0] = response.json()
+
+    for w0, w1, complete in windows:
+      if complete and (w0, w1) in missing:
+        self.rollups.put(tenant, insight, w0, datas[w0], query)
+
+    if len(windows) == 1 and missing:
+      merged = responses[0]
+    else:
+      merged = json_response(merge_aggregations(
+                 [ datas[w[0]] for w in windows ], size=size))
+
+    return merged
+
+
+  def _oversampled_query(self, insight, t0, t1, size, spec=None):
+    '''
+    Build insight query with size scaled by oversample
+    '''
+    url, body = self.insight_query(insight, t0, t1, spec)
+    if size:
+      body['size'] = min(size * self.oversample, 10000)
+
+    return url, body
+
+
+  def _get_insight_oversampled(self, insight, t0, t1, size, spec=None):
+    '''
+    Get insight window with size scaled by oversample, used for
+    windows that are later merged and re-ranked
+    '''
+    url, body = self._oversampled_query(insight, t0, t1, size, spec)
+    logging.debug('URL: %s, Body: %s', url, body)
     response = self._apipost(url, json.dumps(body), headers=self.headers)
-    logging.debug(f'{response.json()}')
 
     return response
 
-  def get_counts(self, time_period):
+
+  def backfill_rollups(self, insights, days=30, registry=None):
     '''
+    Populate the rollup store for the last complete days
+
+    Days are stored per planned request, so insights are planned as
+    get_insights() plans them (see plan_insights()) and the days are
+    stored under the same combined names and queries that a report of
+    the same insights and registry looks up.
+
+    Parameters:
+      insights(list): Insight names, e.g. REPORT_INSIGHTS
+      days(int): Number of complete days ending at the last UTC midnight
+      registry(dict): Insight specs, default self.insights, see
+                      insight_registry()
+    
+    Returns:
+        dict of planned (possibly combined) name: requests response
+        object for the merged window
+    '''
+    t1 = self.now()
+    t1 -= t1 % DAY
+    t0 = t1 - days * DAY
+    results = {}
+    for name, _, spec in self.plan_insights(insights, registry):
+      if spec:
+        results[name] = self.get_insight_rollup(name, t0, t1, spec)
+      else:
+        logging.error(f'{name} report not currently supported')
+        results[name] = self._not_found_response(f'{name} insight')
+
+    return results
+
+  def get_counts(self, time_period, response=None):
+    '''
+    Get total data exfiltration and malware hit counts
+
+    Parameters:
+      time_period(str): Period in form of 3d, 2w, 1d
+      response(obj): Pre-fetched tclass insight response, retrieved if
+                     not supplied
+
+    Returns:
+      dict of total_dex_count and total_mal_count, -1 on error
     '''
     counts = {}
     total_dex_count = 0
     total_mal_count = 0
     
-    logging.info('Retrieving security hits')
-    response = self.get_insight('tclass', time_period)
+    if response is None:
+      logging.info('Retrieving security hits')
+      response = self.get_insight('tclass', time_period)
+    response = b1response.wrap(response)
     if response.status_code in self.return_codes_ok:
       logging.info(f' - security hits retrieved')
-      logging.debug(f'{response.json()}')
-      results = response.json().get('results')
-      if isinstance(results, list):
-        for data in results[0].get('sub_bucket'):
-          if 'key' in data.keys():
-            #print(f"{ data['key'] } - { data['count'] }")
-            if 'Data Exfiltration' in data.get('key'):
-              total_dex_count += int(data['count'])
-            if 'Malware' in data.get('key'):
-              total_mal_count += int(data['count'])
+      tree = response.tree()
+      tclass = tree.result(0)
+      total_dex_count = tree.sum_matching(tclass, 'Data Exfiltration')
+      total_mal_count = tree.sum_matching(tclass, 'Malware')
     else:
         logging.error(f'Error retrieving security hits.')
         logging.info(f'HTTP Code: {response.status_code}')
@@ -311,21 +1649,133 @@ class b1reporting(bloxone.b1):
 
     return counts
  
-  def get_total_hits(self, time_period):
+  def get_total_hits(self, time_period, response=None):
     '''
+    Get total number of security hits, formatted for the report
+
+    Parameters:
+      time_period(str): Period in form of 3d, 2w, 1d
+      response(obj): Pre-fetched hit_count insight response, counted
+                     with count_hits() if not supplied
+
+    Returns:
+      str total with thousands separators or -1 on error
     '''
-    response = self.security_activity(time_period)
-    if response.status_code in self.return_codes_ok:
-      logging.debug(f'response.json()')
-      total_events = response.json()['success']['size']
-      total_events = int(total_events)
-      total_events = "{:,}".format(total_events)
+    if response is None:
+      total_events = self.count_hits(time_period)
+    elif response.status_code in self.return_codes_ok:
+      total_events = b1response.wrap(response).total()
     else:
-      logging.error(f'Error retrieving security activity.')
+      logging.error(f'Error retrieving security hit count.')
       logging.info(f'HTTP Code: {response.status_code}')
       logging.info(f'Response: {response.text}')
       total_events = -1
+    if total_events >= 0:
+      total_events = "{:,}".format(total_events)
     
     return total_events
 
+
+  def count_query(self, filter, t0, t1):
+    '''
+    Build minimal aggregation body for counting hits
+
+    Hits are aggregated on type, which has at most four values, so the
+    response is a few buckets whatever the number of hits.
+
+    Parameters:
+      filter(str): _filter expression
+      t0(int): Start of window, epoch seconds
+      t1(int): End of window, epoch seconds
+
+    Returns:
+      Tuple of (url, body (dict))
+    '''
+    url, body = self.insight_query('hit_count', t0, t1)
+    body.pop('_filter', None)
+    if filter:
+      body['_filter'] = filter
+
+    return url, body
+
+
+  def _count_by_type(self, filter, t0, t1):
+    '''
+    Post count query, returns dict of type: count or None on error
+    '''
+    url, body = self.count_query(filter, t0, t1)
+    logging.debug('URL: %s, Body: %s', url, body)
+    response = self._apipost(url, json.dumps(body), headers=self.headers)
+    if response.status_code in self.return_codes_ok:
+      counts = { str(b.key): b.count for b in response.buckets() }
+    else:
+      logging.error(f'Error retrieving counts for filter: {filter}')
+      logging.info(f'HTTP Code: {response.status_code}')
+      logging.info(f'Response: {response.text}')
+      counts = None
+
+    return counts
+
+
+  def count_hits(self, period='1d', filter=SECURITY_HITS_FILTER):
+    '''
+    Count hits matching filter without retrieving the hits
+
+    Parameters:
+      period(str): Period in form of 3d, 2w, 1d
+      filter(str/list): _filter expression, or list of expressions
+                        counted concurrently
+
+    Returns:
+      int count, or list of counts for a list of filters, -1 on error
+    '''
+    t0, t1 = self._time_window(period)
+    filters = filter if isinstance(filter, list) else [ filter ]
+    results = self._fetch_concurrent(self._count_by_type,
+                                     [ (f, t0, t1) for f in filters ])
+    counts = [ sum(r.values()) if r is not None else -1 for r in results ]
+
+    return counts if isinstance(filter, list) else counts[0]
+
+
+  def count_events(self, period='1d', source=''):
+    '''
+    Count DNS security events by source in a single request
+
+    Parameters:
+      period(str): Period in form of 3d, 2w, 1d
+      source(str/list): One or more of ['rpz', 'category', 'analytics'],
+                        all if not specified
+
+    Returns:
+      int count, or dict of source: count for a list of sources,
+      -1 on error
+    '''
+    sources = source if isinstance(source, list) else [ source ]
+    if not source:
+      sources = list(SOURCE_TYPES.keys())
+    for s in sources:
+      if s not in SOURCE_TYPES:
+        logging.warning(f'Unexpected source: {s}, not counted.')
+    types = [ SOURCE_TYPES[s] for s in sources if s in SOURCE_TYPES ]
+    filter = "type in [" + ",".join([ f"'{t}'" for t in types ]) + "]"
+
+    t0, t1 = self._time_window(period)
+    by_type = self._count_by_type(filter, t0, t1)
+    counts = {}
+    for s in sources:
+      if by_type is None:
+        counts[s] = -1
+      else:
+        counts[s] = by_type.get(SOURCE_TYPES.get(s), 0)
+
+    if isinstance(source, list):
+      result = counts
+    elif source:
+      result = counts[source]
+    else:
+      result = -1 if by_type is None else sum(counts.values())
+
+    return result
+
 # End of class
\ No newline at end of file
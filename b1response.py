@@ -0,0 +1,301 @@
+#!/usr/local/bin/python3
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+'''
+------------------------------------------------------------------------
+
+ Description:
+
+ Decode once API responses with typed accessors for insight results
+
+ B1Response wraps a requests response, decoding the JSON body on first
+ use only, with orjson if installed, and gives typed access to the
+ results[].sub_bucket structure of insight and aggregation responses:
+
+    response = b1r.get_insight('tproperty', '7d')
+    for bucket in response.buckets():
+        print(bucket.key, bucket.count)
+
+ Requirements:
+  orjson (optional, faster decoding)
+
+ Date Last Updated: 20261017
+
+ Todo:
+
+ Copyright (c) 2022 Chris Marrison / Infoblox
+
+ Redistribution and use in source and binary forms,
+ with or without modification, are permitted provided
+ that the following conditions are met:
+
+ 1. Redistributions of source code must retain the above copyright
+ notice, this list of conditions and the following disclaimer.
+
+ 2. Redistributions in binary form must reproduce the above copyright
+ notice, this list of conditions and the following disclaimer in the
+ documentation and/or other materials provided with the distribution.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+ "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+ LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+ FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+ COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+ INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+ BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+ LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+ CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+ LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+ ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ POSSIBILITY OF SUCH DAMAGE.
+
+------------------------------------------------------------------------
+'''
+import b1aggregate
+import b1stream
+import collections
+import json
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+__version__ = '0.0.1'
+__author__ = 'Chris Marrison'
+__author_email__ = 'chris@infoblox.com'
+
+_UNSET = object()
+# Bytes read per chunk when parsing a body incrementally
+CHUNK_SIZE = 65536
+
+
+def loads(content):
+    '''
+    Decode JSON bytes or str, using orjson when available
+    '''
+    if orjson:
+        data = orjson.loads(content)
+    else:
+        data = json.loads(content)
+
+    return data
+
+
+def wrap(response):
+    '''
+    Wrap a requests response, B1Response objects are returned as is
+    '''
+    if isinstance(response, B1Response):
+        return response
+
+    return B1Response(response)
+
+
+class Lazy:
+    '''
+    Defer building a log message argument until it is emitted, e.g.
+    logging.debug('%s', Lazy(response.json)) costs nothing unless debug
+    logging is enabled
+    '''
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+        return
+
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+class Bucket(collections.namedtuple('Bucket', [ 'key', 'count',
+                                               'sub_bucket' ])):
+    '''
+    Aggregation bucket with integer count and the raw sub_bucket list
+    '''
+    __slots__ = ()
+
+    def sub_counts(self, key):
+        '''
+        Counts for a sub key (the sub_key of the aggregation)
+
+        Parameters:
+            key (str): Sub key, e.g. 'user'
+
+        Returns:
+            dict of value: count (int)
+        '''
+        counts = {}
+        for sub in self.sub_bucket or []:
+            if sub.get('key') == key:
+                counts = { b.get('key'): int(b.get('count', 0))
+                           for b in sub.get('sub_bucket') or [] }
+                break
+
+        return counts
+
+
+class B1Response:
+    '''
+    requests response wrapper decoding the JSON body only once
+
+    Attributes not defined here (status_code, text, headers, etc.) are
+    those of the wrapped response. The decoded data is shared by all
+    callers of json() and must be treated as read only.
+    '''
+    def __init__(self, response, data=_UNSET):
+        '''
+        Parameters:
+            response (obj): requests response object
+            data (obj): Already decoded body, if known
+        '''
+        self._response = response
+        self._data = data
+        self._tree = None
+        # Called with the seconds taken by each decode of the body
+        self.on_decode = None
+
+        return
+
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+
+    def __bool__(self):
+        return self._response.ok
+
+
+    def __repr__(self):
+        return f'<B1Response [{self._response.status_code}]>'
+
+
+    @property
+    def response(self):
+        '''
+        Wrapped requests response object
+        '''
+        return self._response
+
+
+    def json(self, **kwargs):
+        '''
+        Decoded JSON body, decoded on first call only, or on every call
+        with decoder keyword arguments
+
+        Raises:
+            requests.exceptions.JSONDecodeError if the body is not JSON
+        '''
+        if not kwargs and self._data is not _UNSET:
+            return self._data
+
+        start = time.perf_counter()
+        try:
+            if kwargs:
+                return self._response.json(**kwargs)
+            try:
+                self._data = loads(self._response.content)
+            except ValueError:
+                # Raise the same exception as requests
+                self._data = self._response.json()
+        finally:
+            if self.on_decode:
+                self.on_decode(time.perf_counter() - start)
+
+        return self._data
+
+
+    def results(self):
+        '''
+        List of results, one per aggregation, empty if none
+        '''
+        data = self.json()
+        results = data.get('results') if isinstance(data, dict) else None
+
+        return results if isinstance(results, list) else []
+
+
+    def result(self, index=0):
+        '''
+        Result for aggregation at index, empty dict if not present
+        '''
+        results = self.results()
+
+        return results[index] if index < len(results) else {}
+
+
+    def buckets(self, index=0):
+        '''
+        Top level buckets of a result
+
+        Parameters:
+            index (int): Aggregation index
+
+        Returns:
+            list of Bucket(key, count (int), sub_bucket)
+        '''
+        return [ Bucket(b.get('key'), int(b.get('count', 0)),
+                        b.get('sub_bucket') or [])
+                 for b in self.result(index).get('sub_bucket') or [] ]
+
+
+    def counts(self, index=0):
+        '''
+        Counts of the top level buckets of a result
+
+        Returns:
+            dict of key: count (int)
+        '''
+        return { b.key: b.count for b in self.buckets(index) }
+
+
+    def total(self, index=0):
+        '''
+        Sum of the top level bucket counts of a result
+        '''
+        return sum([ b.count for b in self.buckets(index) ])
+
+
+    def tree(self):
+        '''
+        Indexed form of the results, built on first call only
+
+        Returns:
+            b1aggregate.BucketTree
+        '''
+        if self._tree is None:
+            data = self.json()
+            self._tree = b1aggregate.BucketTree.from_data(
+                            data if isinstance(data, dict) else {})
+
+        return self._tree
+
+
+    def iter_records(self, chunk_size=CHUNK_SIZE):
+        '''
+        Records of an activity response page, parsed incrementally so
+        that a streamed body is never held in memory as a whole
+
+        Yields:
+            records (dict)
+        '''
+        return b1stream.iter_records(
+                    self._response.iter_content(chunk_size))
+
+
+    def iter_buckets(self, chunk_size=CHUNK_SIZE):
+        '''
+        Top level buckets of all results, parsed incrementally
+
+        Yields:
+            (aggregation index, Bucket) tuples
+        '''
+        for index, b in b1stream.iter_buckets(
+                            self._response.iter_content(chunk_size)):
+            yield index, Bucket(b.get('key'), int(b.get('count', 0)),
+                                b.get('sub_bucket') or [])
+
+        return
+
+# End of class
@@ -0,0 +1,341 @@
+#!/usr/local/bin/python3
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+'''
+------------------------------------------------------------------------
+
+ Description:
+
+ Local store of per day insight aggregations for the b1reporting class
+
+ Usage:
+    b1rollup.py -c bloxone.ini -s rollups.db list
+    b1rollup.py -c bloxone.ini -s rollups.db backfill -i dex -i doh -n 30
+    b1rollup.py -c bloxone.ini -s rollups.db invalidate --start 2022-03-01
+
+ Date Last Updated: 20261017
+
+ Todo:
+
+ Copyright (c) 2022 Chris Marrison / Infoblox
+
+ Redistribution and use in source and binary forms,
+ with or without modification, are permitted provided
+ that the following conditions are met:
+
+ 1. Redistributions of source code must retain the above copyright
+ notice, this list of conditions and the following disclaimer.
+
+ 2. Redistributions in binary form must reproduce the above copyright
+ notice, this list of conditions and the following disclaimer in the
+ documentation and/or other materials provided with the distribution.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+ "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+ LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+ FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+ COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+ INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+ BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+ LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+ CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+ LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+ ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ POSSIBILITY OF SUCH DAMAGE.
+
+------------------------------------------------------------------------
+'''
+import logging
+import argparse
+import datetime
+import hashlib
+import json
+import sqlite3
+import threading
+
+__version__ = '0.0.1'
+__author__ = 'Chris Marrison'
+__author_email__ = 'chris@infoblox.com'
+
+
+def day_start(date):
+    '''
+    Convert YYYY-MM-DD to epoch seconds at UTC midnight
+
+    Parameters:
+        date (str): Date in ISO format
+
+    Returns:
+        int epoch seconds
+    '''
+    dt = datetime.datetime.strptime(date, '%Y-%m-%d')
+    dt = dt.replace(tzinfo=datetime.timezone.utc)
+
+    return int(dt.timestamp())
+
+
+def day_name(t0):
+    '''
+    Convert epoch seconds to YYYY-MM-DD (UTC)
+    '''
+    dt = datetime.datetime.fromtimestamp(t0, tz=datetime.timezone.utc)
+
+    return dt.strftime('%Y-%m-%d')
+
+
+def query_digest(body):
+    '''
+    Digest of an insight query, ignoring the time window, so that days
+    stored for one version of an insight are not served for another
+
+    Parameters:
+        body (dict): Aggregation request body
+
+    Returns:
+        str hex digest
+    '''
+    query = { k: v for k, v in body.items() if k not in [ 't0', 't1' ] }
+    encoded = json.dumps(query, sort_keys=True, separators=(',', ':'))
+
+    return hashlib.sha256(encoded.encode()).hexdigest()[:16]
+
+
+class RollupStore:
+    '''
+    SQLite store of insight aggregation responses, one per tenant,
+    insight, query and UTC day
+    '''
+    def __init__(self, filename='b1td_rollups.db'):
+        '''
+        Open (or create) rollup database
+
+        Parameters:
+            filename (str): SQLite database file
+        '''
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, timeout=30,
+                                   check_same_thread=False)
+        with self._lock, self._db:
+            columns = [ row[1] for row in 
+                        self._db.execute('PRAGMA table_info(rollups)') ]
+            if columns and 'query' not in columns:
+                # Days stored without a query digest can not be matched
+                logging.info(f'Rollup store {filename} upgraded, '
+                             'stored days removed')
+                self._db.execute('DROP TABLE rollups')
+            self._db.execute('CREATE TABLE IF NOT EXISTS rollups ('
+                             'tenant TEXT, insight TEXT, query TEXT, '
+                             'day INTEGER, data TEXT, stored REAL, '
+                             'PRIMARY KEY (tenant, insight, query, day))')
+        logging.debug(f'Rollup store {filename} opened')
+
+        return
+
+
+    def tenant(self, api_key):
+        '''
+        Generate tenant id from API key, the key itself is not stored
+        '''
+        return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+
+    def get(self, tenant, insight, day, query=''):
+        '''
+        Retrieve stored day
+
+        Parameters:
+            tenant (str): Tenant id from tenant()
+            insight (str): Insight name
+            day (int): UTC midnight epoch seconds
+            query (str): Query digest from query_digest()
+
+        Returns:
+            Decoded aggregation response (dict) or None
+        '''
+        with self._lock:
+            row = self._db.execute('SELECT data FROM rollups WHERE '
+                                   'tenant = ? AND insight = ? AND '
+                                   'query = ? AND day = ?',
+                                   (tenant, insight, query, day)).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+
+    def put(self, tenant, insight, day, data, query=''):
+        '''
+        Store day aggregation
+
+        Parameters:
+            tenant (str): Tenant id from tenant()
+            insight (str): Insight name
+            day (int): UTC midnight epoch seconds
+            data (dict): Decoded aggregation response
+            query (str): Query digest from query_digest()
+        '''
+        stored = datetime.datetime.now().timestamp()
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO rollups '
+                             '(tenant, insight, query, day, data, stored) '
+                             'VALUES (?, ?, ?, ?, ?, ?)',
+                             (tenant, insight, query, day, json.dumps(data),
+                              stored))
+
+        return
+
+
+    def invalidate(self, tenant=None, insight=None, start=None, end=None):
+        '''
+        Remove stored days of all queries, all arguments are optional
+        filters
+
+        Parameters:
+            tenant (str): Tenant id from tenant()
+            insight (str): Insight name
+            start (int): First day to remove, epoch seconds
+            end (int): Remove days before this, epoch seconds
+
+        Returns:
+            Number of days removed
+        '''
+        where, params = self._where(tenant, insight, start, end)
+        with self._lock, self._db:
+            cursor = self._db.execute('DELETE FROM rollups' + where, params)
+
+        return cursor.rowcount
+
+
+    def list_days(self, tenant=None, insight=None, start=None, end=None):
+        '''
+        List stored days
+
+        Returns:
+            List of (tenant, insight, day) tuples
+        '''
+        where, params = self._where(tenant, insight, start, end)
+        with self._lock:
+            rows = self._db.execute('SELECT tenant, insight, day FROM '
+                                    'rollups' + where +
+                                    ' ORDER BY tenant, insight, day',
+                                    params).fetchall()
+
+        return rows
+
+
+    def _where(self, tenant, insight, start, end):
+        # Build WHERE clause for optional filters
+        clauses = []
+        params = []
+        for clause, value in [ ('tenant = ?', tenant),
+                               ('insight = ?', insight),
+                               ('day >= ?', start),
+                               ('day < ?', end) ]:
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+
+        return where, params
+
+
+    def close(self):
+        '''
+        Close rollup database
+        '''
+        with self._lock:
+            self._db.close()
+
+        return
+
+# End of class
+
+
+def parseargs():
+    '''
+    Parse Arguments Using argparse
+
+    Parameters:
+        None
+
+    Returns:
+        Returns parsed arguments
+    '''
+    parse = argparse.ArgumentParser(description='B1TD Rollup Store Maintenance')
+    parse.add_argument('command', choices=[ 'list', 'backfill', 'invalidate' ])
+    parse.add_argument('-c', '--config', type=str, default='bloxone.ini',
+                       help="bloxone inifile with API key")
+    parse.add_argument('-s', '--store', type=str, default='b1td_rollups.db',
+                       help="Rollup store file")
+    parse.add_argument('-i', '--insight', action='append', default=[],
+                       help="Insight, may be repeated (default all report "
+                            "insights)")
+    parse.add_argument('-r', '--report', type=str, default='',
+                       help="Report inifile, backfill with its [Insight] "
+                            "sections")
+    parse.add_argument('-n', '--days', type=int, default=30,
+                       help="Days to backfill (default 30)")
+    parse.add_argument('--start', type=str, default='',
+                       help="First day YYYY-MM-DD for list/invalidate")
+    parse.add_argument('--end', type=str, default='',
+                       help="Day after last YYYY-MM-DD for list/invalidate")
+    parse.add_argument('-d', '--debug', action='store_true',
+                       help="Enable debug messages")
+
+    return parse.parse_args()
+
+
+def main():
+    '''
+    Core Logic
+    '''
+    import b1reporting
+
+    exitcode = 0
+    args = parseargs()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+                        format='%(levelname)s: %(message)s')
+
+    store = RollupStore(args.store)
+    b1r = b1reporting.b1reporting(args.config, rollups=store)
+    tenant = store.tenant(b1r.api_key)
+    start = day_start(args.start) if args.start else None
+    end = day_start(args.end) if args.end else None
+
+    if args.command == 'backfill':
+        # Store days under the requests the report plans
+        insights = args.insight or b1reporting.REPORT_INSIGHTS
+        registry = b1reporting.insight_registry(args.report)
+        responses = b1r.backfill_rollups(insights, days=args.days,
+                                         registry=registry)
+        for name, response in responses.items():
+            if response.status_code in b1r.return_codes_ok:
+                logging.info(f'{name}: {args.days} days stored')
+            else:
+                logging.error(f'{name}: backfill failed, '
+                              f'HTTP Code: {response.status_code}')
+                exitcode = 1
+    elif args.command == 'invalidate':
+        # Days of combined requests are stored as e.g. tclass+hit_count
+        names = [ None ]
+        if args.insight:
+            names = { insight for _, insight, _ in
+                      store.list_days(tenant, None, start, end)
+                      if set(insight.split('+')) & set(args.insight) }
+        for name in names:
+            count = store.invalidate(tenant, name, start, end)
+            logging.info(f'{count} stored days removed')
+    else:
+        for _, insight, day in store.list_days(tenant, None, start, end):
+            if (not args.insight or
+                set(insight.split('+')) & set(args.insight)):
+                print(f'{insight:<25} {day_name(day)}')
+
+    store.close()
+
+    return exitcode
+
+
+### Main ###
+if __name__ == '__main__':
+    exitcode = main()
+    exit(exitcode)
+## End Main ###
@@ -0,0 +1,266 @@
+#!/usr/local/bin/python3
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+'''
+------------------------------------------------------------------------
+
+ Description:
+
+ Incremental JSON parsing of large API responses
+
+ Yields the items of selected arrays in a JSON document as the body is
+ received, e.g. the hits of an activity page or the buckets of an
+ aggregation, so that only the current item and a small read buffer are
+ held in memory whatever the size of the response. Each item is decoded
+ with the standard library decoder, only the structure leading to the
+ selected arrays is walked in Python.
+
+    for path, hit in b1stream.iter_items(response.iter_content(65536),
+                                         [ ('result',) ]):
+        aggregator.add(hit)
+
+ Date Last Updated: 20261017
+
+ Todo:
+
+ Copyright (c) 2022 Chris Marrison / Infoblox
+
+ Redistribution and use in source and binary forms,
+ with or without modification, are permitted provided
+ that the following conditions are met:
+
+ 1. Redistributions of source code must retain the above copyright
+ notice, this list of conditions and the following disclaimer.
+
+ 2. Redistributions in binary form must reproduce the above copyright
+ notice, this list of conditions and the following disclaimer in the
+ documentation and/or other materials provided with the distribution.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+ "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+ LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+ FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+ COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+ INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+ BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+ LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+ CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+ LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+ ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ POSSIBILITY OF SUCH DAMAGE.
+
+------------------------------------------------------------------------
+'''
+import codecs
+import json
+
+__version__ = '0.0.1'
+__author__ = 'Chris Marrison'
+__author_email__ = 'chris@infoblox.com'
+
+# Locations of the record list in activity responses, see
+# b1reporting.page_records()
+RECORD_PATHS = [ ('result',), ('results',), ('hits',), ('records',),
+                 ('success', 'result'), ('success', 'results'),
+                 ('success', 'hits'), ('success', 'records') ]
+# Top level buckets of each aggregation result
+BUCKET_PATHS = [ ('results', '*', 'sub_bucket') ]
+
+_WHITESPACE = ' \t\n\r'
+# Characters that may continue a number, e.g. after '-2500' or '1e'
+_NUMBER = '.eE+-0123456789'
+# Drop consumed input once this many characters have been parsed
+_COMPACT = 65536
+
+
+def _matches(pattern, path):
+    # '*' in a pattern matches any array index
+    return len(pattern) == len(path) and all(
+        [ p == '*' and isinstance(s, int) or p == s
+          for p, s in zip(pattern, path) ])
+
+
+class _Reader:
+    '''
+    Pull parser over an iterable of byte (or str) chunks
+    '''
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+        return
+
+
+    def more(self):
+        '''
+        Read next chunk, returns False at end of input
+        '''
+        if self.eof:
+            return False
+        if self.pos > _COMPACT:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        for chunk in self._chunks:
+            if isinstance(chunk, bytes):
+                chunk = self._utf8.decode(chunk)
+            if chunk:
+                self.buf += chunk
+                return True
+        self.buf += self._utf8.decode(b'', final=True)
+        self.eof = True
+
+        return False
+
+
+    def peek(self):
+        '''
+        Next non whitespace character, '' at end of input
+        '''
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.more():
+                return ''
+
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f'Expected {char!r} at offset {self.pos}')
+        self.pos += 1
+
+        return
+
+
+    def value(self):
+        '''
+        Decode the next complete JSON value
+        '''
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self.more():
+                    raise
+                continue
+            # A number may continue in the next chunk, e.g. a chunk
+            # ending '-2500.' or '1e+' decodes as -2500 or 1
+            if (isinstance(value, (int, float)) and 
+                not isinstance(value, bool) and not self.eof and
+                (end == len(self.buf) or self.buf[end] in _NUMBER) and
+                self.more()):
+                continue
+            self.pos = end
+            return value
+
+
+    def items(self, targets, path=()):
+        '''
+        Walk the value at the current position yielding the items of
+        arrays whose path matches a target
+        '''
+        char = self.peek()
+        if any([ _matches(t, path) for t in targets ]) and char == '[':
+            self.pos += 1
+            index = 0
+            while True:
+                char = self.peek()
+                if char == ']':
+                    self.pos += 1
+                    return
+                if char == ',':
+                    self.pos += 1
+                    continue
+                yield path, self.value()
+                index += 1
+
+        depth = len(path)
+        relevant = [ t for t in targets
+                     if len(t) > depth and _matches(t[:depth], path) ]
+        if not relevant or char not in '{[':
+            self.value()
+            return
+
+        self.pos += 1
+        if char == '{':
+            keys = { t[depth] for t in relevant }
+            while True:
+                char = self.peek()
+                if char == '}':
+                    self.pos += 1
+                    return
+                if char == ',':
+                    self.pos += 1
+                    continue
+                key = self.value()
+                self.expect(':')
+                if key in keys:
+                    yield from self.items(targets, path + (key,))
+                else:
+                    self.value()
+        else:
+            index = 0
+            while True:
+                char = self.peek()
+                if char == ']':
+                    self.pos += 1
+                    return
+                if char == ',':
+                    self.pos += 1
+                    continue
+                yield from self.items(targets, path + (index,))
+                index += 1
+
+# End of class
+
+
+def iter_items(chunks, targets):
+    '''
+    Incrementally parse a JSON document yielding the items of the
+    selected arrays as they are received
+
+    Parameters:
+        chunks (iterable): bytes or str chunks, e.g.
+                           response.iter_content(65536)
+        targets (list): Paths of arrays to yield, tuples of object keys
+                        and '*' for any array index, e.g.
+                        [ ('results', '*', 'sub_bucket') ]
+
+    Yields:
+        (path, item) tuples, path is the tuple of keys and array indexes
+        of the array, e.g. ('results', 2, 'sub_bucket')
+
+    Raises:
+        ValueError (json.JSONDecodeError) for invalid JSON
+    '''
+    reader = _Reader(chunks)
+    if reader.peek():
+        yield from reader.items([ tuple(t) for t in targets ])
+
+    return
+
+
+def iter_records(chunks):
+    '''
+    Yield the records of an activity response page as received
+    '''
+    for _, record in iter_items(chunks, RECORD_PATHS):
+        yield record
+
+    return
+
+
+def iter_buckets(chunks):
+    '''
+    Yield (result index, bucket) for the top level buckets of each
+    aggregation result as received
+    '''
+    for path, bucket in iter_items(chunks, BUCKET_PATHS):
+        yield path[1], bucket
+
+    return
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+#vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+'''
+
+ Description:
+
+    Experimental: Generate B1TDC Reports for multiple customers in a
+    single process using a worker pool
+
+ Requirements:
+  Python 3.7+
+  bloxone module
+  matplotlib
+  docxtpl
+
+ Author: Chris Marrison
+
+ NOTE: This is a demo based on experimental API calls
+
+ Date Last Updated: 20261017
+
+ Todo:
+
+ Copyright (c) 2022 Chris Marrison / Infoblox
+
+'''
+__version__ = '0.0.1'
+__author__ = 'Chris Marrison'
+__email__ = 'chris@infoblox.com'
+__license__ = 'BSD2'
+
+import logging
+import argparse
+import concurrent.futures
+import glob
+import os
+import time
+import b1td_summary_report
+
+
+def parseargs():
+    '''
+    Parse Arguments Using argparse
+
+    Parameters:
+        None
+
+    Returns:
+        Returns parsed arguments
+    '''
+    parse = argparse.ArgumentParser(description='Experimental B1TD Batch Report Generator')
+    parse.add_argument('source', type=str,
+                       help="Directory of report inifiles or manifest file "
+                            "listing one report inifile per line")
+    parse.add_argument('-t', '--template', type=str,
+                       default='sample_B1TD_report_template.docx',
+                       help="Overide template file")
+    parse.add_argument('-O', '--outdir', type=str, default='',
+                       help="Output directory for generated documents")
+    parse.add_argument('-p', '--processes', type=int, default=os.cpu_count(),
+                       help="Number of report worker processes")
+    parse.add_argument('-w', '--workers', type=int, default=8,
+                       help="Maximum concurrent API requests per report")
+    parse.add_argument('--rate', type=float, default=0,
+                       help="Limit total API requests per second")
+    parse.add_argument('--no-cache', action='store_true',
+                       help="Disable response caches set in report inifiles")
+    parse.add_argument('--refresh', action='store_true',
+                       help="Ignore cached responses and update caches")
+    parse.add_argument('--artifacts', type=str, default='',
+                       help="Reuse charts and documents with unchanged "
+                            "inputs from this directory")
+    parse.add_argument('-d', '--debug', action='store_true',
+                        help="Enable debug messages")
+
+    return parse.parse_args()
+
+
+def read_manifest(source):
+    '''
+    Build list of report inifiles from a directory or manifest
+
+    Parameters:
+        source (str): Directory containing *.ini report files or a
+                      manifest file with one report inifile per line,
+                      relative paths are relative to the manifest
+
+    Returns:
+        List of report inifile names
+    '''
+    configs = []
+    if os.path.isdir(source):
+        configs = sorted(glob.glob(os.path.join(source, '*.ini')))
+    elif os.path.isfile(source):
+        base = os.path.dirname(source)
+        with open(source) as manifest:
+            for line in manifest:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    configs.append(os.path.join(base, line))
+    else:
+        logging.error(f'Batch source {source} not found')
+
+    return configs
+
+
+def run_report(ini_filename, template, workers=8, outdir='',
+               no_cache=False, refresh=False, rate=0, artifacts=''):
+    '''
+    Worker: generate the report for a single report inifile
+
+    Parameters:
+        ini_filename (str): Report inifile
+        template (str): docx template filename
+        workers (int): Maximum concurrent API requests
+        outdir (str): Output directory
+        no_cache (bool): Disable response cache
+        refresh (bool): Ignore cached responses
+        rate (float): API requests per second for this process
+        artifacts (str): Artifact store directory, overrides config
+
+    Returns:
+        dict of results for the batch summary
+    '''
+    result = { 'config': ini_filename, 'customer': '', 'filename': '',
+               'exitcode': 1, 'error': '', 'elapsed': 0.0 }
+    start = time.perf_counter()
+    try:
+        config = b1td_summary_report.read_ini(ini_filename)
+        if config:
+            result['customer'] = config.get('customer')
+            if rate:
+                config['rate_limit'] = rate
+            if artifacts:
+                config['artifact_store'] = artifacts
+            cache = b1td_summary_report.open_cache(config, no_cache=no_cache)
+            exitcode, filename = b1td_summary_report.generate_report(config,
+                                                  template,
+                                                  workers=workers,
+                                                  outdir=outdir,
+                                                  cache=cache,
+                                                  refresh=refresh)
+            result.update({ 'exitcode': exitcode, 'filename': filename })
+        else:
+            result['error'] = 'No report configuration found'
+    except Exception as err:
+        logging.error(f'Report for {ini_filename} failed: {err}')
+        result['error'] = str(err)
+    result['elapsed'] = time.perf_counter() - start
+
+    return result
+
+
+def run_batch(configs, template, processes=None, workers=8, outdir='',
+              no_cache=False, refresh=False, rate=0, artifacts=''):
+    '''
+    Generate reports for a list of report inifiles using a process pool
+
+    Each worker process imports the plotting and templating stacks once
+    and keeps one b1reporting client per API key inifile for all of the
+    reports it generates.
+
+    Parameters:
+        configs (list): Report inifiles
+        template (str): docx template filename
+        processes (int): Number of worker processes
+        workers (int): Maximum concurrent API requests per report
+        outdir (str): Output directory
+        no_cache (bool): Disable response caches
+        refresh (bool): Ignore cached responses
+        rate (float): Total API requests per second, divided between
+                      the worker processes
+        artifacts (str): Artifact store directory, overrides configs
+
+    Returns:
+        List of result dicts in config order
+    '''
+    results = []
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    processes = processes or os.cpu_count()
+    if rate:
+        rate = rate / processes
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes,
+            initializer=b1td_summary_report.setup_logging,
+            initargs=(debug,)) as pool:
+        jobs = [ pool.submit(run_report, ini, template, workers, outdir,
+                             no_cache, refresh, rate, artifacts)
+                 for ini in configs ]
+        for ini, job in zip(configs, jobs):
+            try:
+                results.append(job.result())
+            except Exception as err:
+                # e.g. worker process terminated
+                logging.error(f'Report for {ini} failed: {err}')
+                results.append({ 'config': ini, 'customer': '',
+                                 'filename': '', 'exitcode': 1,
+                                 'error': str(err), 'elapsed': 0.0 })
+
+    return results
+
+
+def print_summary(results):
+    '''
+    Output per customer success/failure summary
+
+    Parameters:
+        results (list): Result dicts from run_batch()
+
+    Returns:
+        Number of failed reports
+    '''
+    failed = 0
+    print('Batch Summary')
+    for result in results:
+        if result['exitcode'] == 0:
+            status = 'OK'
+            detail = result['filename']
+        else:
+            status = 'FAILED'
+            detail = result['error'] or result['filename']
+            failed += 1
+        print(f"{status:<7} {result['customer'] or result['config']:<30} "
+              f"{result['elapsed']:7.1f}s  {detail}")
+    print(f'{len(results) - failed} succeeded, {failed} failed')
+
+    return failed
+
+
+def main():
+    '''
+    Core Logic
+    '''
+    exitcode = 0
+    args = parseargs()
+
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+    else:
+        logging.getLogger().setLevel(logging.INFO)
+
+    configs = read_manifest(args.source)
+    if configs:
+        if args.outdir:
+            os.makedirs(args.outdir, exist_ok=True)
+        logging.info(f'Generating {len(configs)} reports')
+        results = run_batch(configs, args.template,
+                            processes=args.processes,
+                            workers=args.workers,
+                            outdir=args.outdir,
+                            no_cache=args.no_cache,
+                            refresh=args.refresh,
+                            rate=args.rate,
+                            artifacts=args.artifacts)
+        if print_summary(results):
+            exitcode = 1
+    else:
+        logging.error('No report configurations found')
+        exitcode = 1
+
+    return exitcode
+
+
+### Main ###
+if __name__ == '__main__':
+    b1td_summary_report.setup_logging()
+    exitcode = main()
+    exit(exitcode)
+## End Main ###
@@ -0,0 +1,665 @@
+#!/usr/bin/env python3
+#vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+'''
+
+ Description:
+
+    Experimental: Long running B1TDC report service
+
+    Keeps b1reporting clients, HTTP connection pools, the plotting and
+    templating modules and the parsed document template loaded between
+    reports. Reports are queued through a local HTTP (or Unix socket)
+    API or by cron style schedules in the report inifiles and run on a
+    bounded pool of worker threads.
+
+    API:
+        GET  /health            Service status
+        GET  /reports           Registered report configs
+        POST /reports           Queue a report, body {"config": name,
+                                "wait": true} waits for the result
+        GET  /jobs              Recent jobs
+        GET  /jobs/<id>         Job status
+        GET  /metrics           Prometheus metrics
+
+ Requirements:
+  Python 3.7+
+  bloxone module
+  matplotlib
+  docxtpl
+
+ Author: Chris Marrison
+
+ NOTE: This is a demo based on experimental API calls
+
+ Date Last Updated: 20261017
+
+ Todo:
+
+ Copyright (c) 2022 Chris Marrison / Infoblox
+
+'''
+__version__ = '0.0.1'
+__author__ = 'Chris Marrison'
+__email__ = 'chris@infoblox.com'
+__license__ = 'BSD2'
+
+import logging
+import argparse
+import collections
+import datetime
+import http.server
+import json
+import os
+import queue
+import signal
+import socketserver
+import threading
+import time
+import urllib.parse
+import uuid
+import b1td_batch_report
+import b1td_summary_report
+
+# Finished jobs kept for status queries
+JOB_HISTORY = 1000
+# Samples kept for latency percentiles
+LATENCY_SAMPLES = 1000
+PROMETHEUS_PREFIX = 'b1td_service'
+
+
+def parseargs():
+    '''
+    Parse Arguments Using argparse
+
+    Parameters:
+        None
+
+    Returns:
+        Returns parsed arguments
+    '''
+    parse = argparse.ArgumentParser(description='Experimental B1TD Report Service')
+    parse.add_argument('source', type=str,
+                       help="Directory of report inifiles or manifest file "
+                            "listing one report inifile per line")
+    parse.add_argument('-t', '--template', type=str,
+                       default='sample_B1TD_report_template.docx',
+                       help="Overide template file")
+    parse.add_argument('-O', '--outdir', type=str, default='',
+                       help="Output directory for generated documents")
+    parse.add_argument('-l', '--listen', type=str, default='127.0.0.1:8680',
+                       help="HTTP listen address (default 127.0.0.1:8680), "
+                            "empty to disable")
+    parse.add_argument('-s', '--socket', type=str, default='',
+                       help="Also listen on Unix socket path")
+    parse.add_argument('-j', '--jobs', type=int, default=2,
+                       help="Reports run concurrently (default 2)")
+    parse.add_argument('-w', '--workers', type=int, default=8,
+                       help="Maximum concurrent API requests per report")
+    parse.add_argument('-q', '--queue-size', type=int, default=100,
+                       help="Maximum queued reports (default 100)")
+    parse.add_argument('--no-cache', action='store_true',
+                       help="Disable response caches set in report inifiles")
+    parse.add_argument('-d', '--debug', action='store_true',
+                        help="Enable debug messages")
+
+    return parse.parse_args()
+
+
+class Schedule:
+    '''
+    Cron style schedule, five fields: minute hour day-of-month month
+    day-of-week, each *, a value, range or list with optional /step,
+    e.g. '0 6 * * 1' for 06:00 every Monday
+    '''
+    RANGES = [ (0, 59), (0, 23), (1, 31), (1, 12), (0, 7) ]
+
+    def __init__(self, expr):
+        '''
+        Parameters:
+            expr (str): Schedule expression
+
+        Raises:
+            ValueError for an invalid expression
+        '''
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError(f'Schedule must have 5 fields: {expr}')
+        self.expr = expr
+        self.fields = [ self._parse(f, low, high)
+                        for f, (low, high) in zip(fields, self.RANGES) ]
+        # Sunday is 0 or 7
+        if 7 in self.fields[4]:
+            self.fields[4].add(0)
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+
+        return
+
+
+    @staticmethod
+    def _parse(field, low, high):
+        values = set()
+        for part in field.split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/', 1)
+                step = int(step)
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = [ int(v) for v in part.split('-', 1) ]
+            else:
+                start = int(part)
+                end = high if step > 1 else start
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError(f'Invalid schedule field: {field}')
+            values.update(range(start, end + 1, step))
+
+        return values
+
+
+    def matches(self, when):
+        '''
+        Whether the schedule is due at datetime when (to the minute)
+        '''
+        minute, hour, day, month, weekday = self.fields
+        day_match = when.day in day
+        weekday_match = (when.weekday() + 1) % 7 in weekday
+        # As cron, either day field matches when both are restricted
+        if self._any_day or self._any_weekday:
+            day_ok = day_match and weekday_match
+        else:
+            day_ok = day_match or weekday_match
+
+        return (when.minute in minute and when.hour in hour and
+                when.month in month and day_ok)
+
+# End of class
+
+
+class ReportService:
+    '''
+    Report job queue, worker pool and scheduler with warm clients
+    '''
+    def __init__(self, configs, template, jobs=2, workers=8, outdir='',
+                 queue_size=100, no_cache=False):
+        '''
+        Parameters:
+            configs (list): Report inifiles that may be run
+            template (str): docx template filename
+            jobs (int): Reports run concurrently
+            workers (int): Maximum concurrent API requests per report
+            outdir (str): Output directory
+            queue_size (int): Maximum queued reports
+            no_cache (bool): Disable response caches
+        '''
+        self.template = template
+        self.jobs = max(1, jobs)
+        self.workers = workers
+        self.outdir = outdir
+        self.no_cache = no_cache
+        self.started = time.time()
+        self.reports = {}
+        self.history = collections.OrderedDict()
+        self.counters = collections.Counter()
+        self.wait_times = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.run_times = collections.deque(maxlen=LATENCY_SAMPLES)
+        # Totals of all observations, for the Prometheus summaries
+        self.latency_sum = collections.Counter()
+        self.latency_count = collections.Counter()
+        self.running = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        # Reports sharing an API key share a client, run one at a time
+        self._client_locks = collections.defaultdict(threading.Lock)
+        self._stop = threading.Event()
+        self._threads = []
+        for ini in configs:
+            self.register(ini)
+
+        return
+
+
+    def register(self, ini_filename):
+        '''
+        Add report config, named by the inifile name without extension
+
+        Returns:
+            Report name or None if the config is invalid
+        '''
+        name = None
+        config = b1td_summary_report.read_ini(ini_filename)
+        if config:
+            name = os.path.splitext(os.path.basename(ini_filename))[0]
+            schedule = None
+            if config.get('schedule'):
+                try:
+                    schedule = Schedule(config['schedule'])
+                except ValueError as err:
+                    logging.error(f'{ini_filename}: {err}')
+            b1inifile = config.get('b1inifile') or ini_filename
+            self.reports[name] = { 'name': name,
+                                   'filename': ini_filename,
+                                   'customer': config.get('customer', ''),
+                                   'schedule': schedule,
+                                   'client': os.path.realpath(b1inifile),
+                                   'config': config }
+        else:
+            logging.error(f'No report configuration in {ini_filename}')
+
+        return name
+
+
+    def warm(self):
+        '''
+        Import the report stacks, parse the template and create the
+        clients and transports of all registered reports
+        '''
+        import b1charts
+        import b1template
+        import docxtpl
+
+        start = time.perf_counter()
+        b1template.get_template(self.template)
+        for report in self.reports.values():
+            config = report['config']
+            try:
+                b1td_summary_report.get_client(
+                    report['client'],
+                    transport=b1td_summary_report.open_transport(config,
+                                                                 self.workers))
+            except Exception as err:
+                logging.error(f'Failed to create client for '
+                              f'{report["name"]}: {err}')
+        logging.info(f'Service warmed in {time.perf_counter() - start:.1f}s')
+
+        return
+
+
+    def submit(self, name, source='api'):
+        '''
+        Queue a report
+
+        Parameters:
+            name (str): Report name or inifile
+            source (str): 'api' or 'schedule'
+
+        Returns:
+            job (dict)
+
+        Raises:
+            KeyError for an unknown report
+            queue.Full if the queue is full
+        '''
+        if name not in self.reports:
+            matches = [ r['name'] for r in self.reports.values()
+                        if os.path.realpath(r['filename']) ==
+                           os.path.realpath(name) ]
+            if not matches:
+                raise KeyError(name)
+            name = matches[0]
+        job = { 'id': uuid.uuid4().hex[:12], 'report': name,
+                'source': source, 'status': 'queued',
+                'submitted': time.time(), 'started': None, 'finished': None,
+                'filename': '', 'error': '', 'done': threading.Event() }
+        with self._lock:
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                self.counters['rejected'] += 1
+                raise
+            self.history[job['id']] = job
+            while len(self.history) > JOB_HISTORY:
+                self.history.popitem(last=False)
+            self.counters['submitted'] += 1
+        logging.info(f'Job {job["id"]} queued: {name} ({source})')
+
+        return job
+
+
+    def _run(self, job):
+        report = self.reports[job['report']]
+        with self._lock:
+            job['status'] = 'running'
+            job['started'] = time.time()
+            self.running += 1
+            self.wait_times.append(job['started'] - job['submitted'])
+            self.latency_sum['queue_wait_seconds'] += self.wait_times[-1]
+            self.latency_count['queue_wait_seconds'] += 1
+        with self._client_locks[report['client']]:
+            result = b1td_batch_report.run_report(report['filename'],
+                                                  self.template,
+                                                  workers=self.workers,
+                                                  outdir=self.outdir,
+                                                  no_cache=self.no_cache)
+        with self._lock:
+            job['finished'] = time.time()
+            job['filename'] = result['filename']
+            job['error'] = result['error']
+            job['status'] = 'done' if result['exitcode'] == 0 else 'failed'
+            self.running -= 1
+            self.counters[job['status']] += 1
+            self.run_times.append(job['finished'] - job['started'])
+            self.latency_sum['run_seconds'] += self.run_times[-1]
+            self.latency_count['run_seconds'] += 1
+        logging.info(f'Job {job["id"]} {job["status"]}: {job["report"]} '
+                     f'in {job["finished"] - job["started"]:.1f}s')
+        job['done'].set()
+
+        return
+
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            try:
+                self._run(job)
+            except Exception as err:
+                logging.error(f'Job {job["id"]} failed: {err}')
+                with self._lock:
+                    job['status'] = 'failed'
+                    job['error'] = str(err)
+                    job['finished'] = time.time()
+                    self.running = max(0, self.running - 1)
+                    self.counters['failed'] += 1
+                job['done'].set()
+
+        return
+
+
+    def _scheduler(self):
+        last = None
+        while not self._stop.is_set():
+            now = datetime.datetime.now().replace(second=0, microsecond=0)
+            if now != last:
+                last = now
+                for report in self.reports.values():
+                    if report['schedule'] and report['schedule'].matches(now):
+                        try:
+                            self.submit(report['name'], source='schedule')
+                        except queue.Full:
+                            logging.warning(f'Queue full, scheduled report '
+                                            f'{report["name"]} skipped')
+            # Wake just after the next minute
+            self._stop.wait(60.5 - time.time() % 60)
+
+        return
+
+
+    def start(self):
+        '''
+        Start worker and scheduler threads
+        '''
+        for n in range(self.jobs):
+            thread = threading.Thread(target=self._worker, daemon=True,
+                                      name=f'report-worker-{n}')
+            thread.start()
+            self._threads.append(thread)
+        if any([ r['schedule'] for r in self.reports.values() ]):
+            thread = threading.Thread(target=self._scheduler, daemon=True,
+                                      name='report-scheduler')
+            thread.start()
+            self._threads.append(thread)
+
+        return
+
+
+    def stop(self, timeout=None):
+        '''
+        Stop scheduling, finish queued and running jobs
+        '''
+        self._stop.set()
+        for _ in range(self.jobs):
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+
+        return
+
+
+    def status(self, job):
+        '''
+        JSON serialisable job status
+        '''
+        with self._lock:
+            return { k: v for k, v in job.items() if k != 'done' }
+
+
+    def job(self, job_id):
+        return self.history.get(job_id)
+
+
+    def summary(self):
+        '''
+        Service status summary
+        '''
+        with self._lock:
+            summary = { 'uptime_seconds': round(time.time() - self.started, 1),
+                        'queued': self._queue.qsize(),
+                        'running': self.running,
+                        'jobs': dict(self.counters),
+                        'reports': len(self.reports) }
+
+        return summary
+
+
+    def prometheus(self):
+        '''
+        Service metrics in Prometheus text exposition format
+
+        Returns:
+            str
+        '''
+        import b1metrics
+
+        lines = []
+
+        def metric(name, help, type, samples):
+            name = f'{PROMETHEUS_PREFIX}_{name}'
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {type}')
+            for labels, value in samples:
+                lines.append(f'{name}{b1metrics._labels(labels)} {value}')
+
+        with self._lock:
+            waits = list(self.wait_times)
+            runs = list(self.run_times)
+            counters = dict(self.counters)
+            sums = dict(self.latency_sum)
+            counts = dict(self.latency_count)
+            running = self.running
+        metric('queue_depth', 'Reports waiting to run', 'gauge',
+               [ ({}, self._queue.qsize()) ])
+        metric('running', 'Reports running', 'gauge', [ ({}, running) ])
+        metric('jobs_total', 'Reports by outcome', 'counter',
+               [ ({ 'status': s }, counters.get(s, 0))
+                 for s in [ 'submitted', 'done', 'failed', 'rejected' ] ])
+        for name, values, help in [
+                ('queue_wait_seconds', waits, 'Time reports waited to run'),
+                ('run_seconds', runs, 'Report run time') ]:
+            # Quantiles of the last LATENCY_SAMPLES, totals of all
+            metric(name, help, 'summary',
+                   [ ({ 'quantile': str(q / 100) },
+                      round(b1metrics.percentile(values, q), 3))
+                     for q in [ 50, 90, 99 ] ])
+            lines.append(f'{PROMETHEUS_PREFIX}_{name}_sum '
+                         f'{round(sums.get(name, 0.0), 3)}')
+            lines.append(f'{PROMETHEUS_PREFIX}_{name}_count '
+                         f'{counts.get(name, 0)}')
+        metric('uptime_seconds', 'Service uptime', 'gauge',
+               [ ({}, round(time.time() - self.started, 1)) ])
+
+        return '\n'.join(lines) + '\n'
+
+# End of class
+
+
+def make_handler(service):
+    '''
+    HTTP request handler class for the service API
+    '''
+    class ServiceHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+        def address_string(self):
+            # Unix socket clients have no address
+            if isinstance(self.client_address, tuple):
+                return str(self.client_address[0])
+            return 'unix'
+
+        def _send(self, status, data, content_type='application/json'):
+            if content_type == 'application/json':
+                data = json.dumps(data, indent=2)
+            content = data.encode()
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+            return
+
+        def do_GET(self):
+            path = urllib.parse.urlsplit(self.path).path.rstrip('/')
+            if path == '/health':
+                self._send(200, service.summary())
+            elif path == '/metrics':
+                self._send(200, service.prometheus(),
+                           content_type='text/plain; version=0.0.4')
+            elif path == '/reports':
+                self._send(200, [ { 'name': r['name'],
+                                    'customer': r['customer'],
+                                    'schedule': r['schedule'].expr
+                                                if r['schedule'] else '' }
+                                  for r in service.reports.values() ])
+            elif path == '/jobs':
+                self._send(200, [ service.status(j)
+                                  for j in list(service.history.values()) ])
+            elif path.startswith('/jobs/'):
+                job = service.job(path[len('/jobs/'):])
+                if job:
+                    self._send(200, service.status(job))
+                else:
+                    self._send(404, { 'error': 'Job not found' })
+            else:
+                self._send(404, { 'error': 'Not found' })
+
+            return
+
+        def do_POST(self):
+            path = urllib.parse.urlsplit(self.path).path.rstrip('/')
+            if path != '/reports':
+                self._send(404, { 'error': 'Not found' })
+                return
+            try:
+                length = int(self.headers.get('Content-Length') or 0)
+                request = json.loads(self.rfile.read(length) or b'{}')
+                job = service.submit(request['config'])
+            except (ValueError, KeyError, TypeError) as err:
+                self._send(400, { 'error': f'Invalid request: {err}' })
+                return
+            except queue.Full:
+                self._send(503, { 'error': 'Queue full' })
+                return
+            if request.get('wait'):
+                job['done'].wait(request.get('timeout'))
+            status = 200 if job['done'].is_set() else 202
+            self._send(status, service.status(job))
+
+            return
+
+    return ServiceHandler
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(service, listen='127.0.0.1:8680', socket_path=''):
+    '''
+    Run the service API until interrupted or terminated
+
+    Parameters:
+        service (obj): ReportService instance, started
+        listen (str): host:port for HTTP, empty to disable
+        socket_path (str): Unix socket path, empty to disable
+    '''
+    servers = []
+    handler = make_handler(service)
+    if listen:
+        host, _, port = listen.rpartition(':')
+        server = http.server.ThreadingHTTPServer((host or '127.0.0.1',
+                                                  int(port)), handler)
+        server.daemon_threads = True
+        servers.append(server)
+        logging.info(f'Listening on http://{host}:{server.server_port}')
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        servers.append(UnixHTTPServer(socket_path, handler))
+        logging.info(f'Listening on {socket_path}')
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        while not stop.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logging.info('Stopping, waiting for running reports')
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.unlink(socket_path)
+        service.stop()
+
+    return
+
+
+def main():
+    '''
+    Core Logic
+    '''
+    exitcode = 0
+    args = parseargs()
+
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+    else:
+        logging.getLogger().setLevel(logging.INFO)
+
+    configs = b1td_batch_report.read_manifest(args.source)
+    if configs:
+        if args.outdir:
+            os.makedirs(args.outdir, exist_ok=True)
+        service = ReportService(configs, args.template, jobs=args.jobs,
+                                workers=args.workers, outdir=args.outdir,
+                                queue_size=args.queue_size,
+                                no_cache=args.no_cache)
+        logging.info(f'{len(service.reports)} reports registered')
+        service.warm()
+        service.start()
+        serve(service, listen=args.listen, socket_path=args.socket)
+    else:
+        logging.error('No report configurations found')
+        exitcode = 1
+
+    return exitcode
+
+
+### Main ###
+if __name__ == '__main__':
+    b1td_summary_report.setup_logging()
+    exitcode = main()
+    exit(exitcode)
+## End Main ###
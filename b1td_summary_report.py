@@ -16,34 +16,87 @@
 
  NOTE: This is a demo based on experimental API calls
 
- Date Last Updated: 20220331
+ Date Last Updated: 20261017
 
  Todo:
 
  Copyright (c) 2022 Chris Marrison / Infoblox
 
 '''
-__version__ = '0.0.14'
+__version__ = '0.0.15'
 __author__ = 'Chris Marrison'
 __email__ = 'chris@infoblox.com'
 __license__ = 'BSD2'
 
 import logging
-import b1reporting
 import argparse
 import configparser
 import datetime
+import io
 import os
 import shutil
 import re
-import docxtpl
-import matplotlib.pyplot as plt
+import threading
+import time
+# Heavy modules (b1reporting/bloxone/requests, matplotlib, docxtpl) are
+# imported by the stages that use them to keep start up fast
   
 # Global Variables
+_artifacts = {}
+_bundles = {}
+_caches = {}
+_clients = {}
+_rollups = {}
+_transports = {}
+_clients_lock = threading.Lock()
+
+# Per insight charts, available to the template as charts.<name>
+#   name: (insight, aggregation key, sub key, title, axis label)
+#   The top buckets of the aggregation are charted, or when a sub key is
+#   given the sub bucket counts of that key summed over all buckets
+CHARTS = {
+  'dex_users': ('dex', 'user', '', 'Top Data Exfiltration Users', 'User'),
+  'dex_networks': ('dex', 'network', '', 'Top Data Exfiltration Networks',
+                   'Network'),
+  'doh_users': ('doh', 'threat_indicator', 'user', 'Top DoH Users', 'User'),
+  'doh_devices': ('doh', 'threat_indicator', 'device_name',
+                  'Top DoH Devices', 'Device'),
+  'malware_users': ('malware', 'tproperty', 'user', 'Top Malware Users',
+                    'User'),
+  'malware_devices': ('malware', 'tproperty', 'device_name',
+                      'Top Malware Devices', 'Device'),
+  'category_users': ('category', 'feed_name', 'user', 'Top Category Users',
+                     'User'),
+  'category_devices': ('category', 'feed_name', 'device_name',
+                       'Top Category Devices', 'Device'),
+}
 # log = logging.getLogger(__name__)
 # log.addHandler(console_handler)
 
 
+def shard_arg(value):
+  '''
+  Check a shard setting, a length such as 6h or 1d, or a number of
+  shards, see b1reporting.split_window()
+
+  Parameters:
+    value (str): Shard setting, empty for none
+
+  Returns:
+    value (str)
+
+  Raises:
+    argparse.ArgumentTypeError if invalid
+  '''
+  match = re.fullmatch(r'\s*(\d+)([hdwm]?)\s*', str(value or '0'), re.I)
+  if not match or (value and int(match.group(1)) < 1):
+    raise argparse.ArgumentTypeError(
+        f'invalid shard {value!r}, use a length such as 1h, 1d or 1w '
+        'or a number of shards of at least 1')
+
+  return value
+
+
 def parseargs():
     '''
     Parse Arguments Using argparse
@@ -64,6 +117,52 @@ def parseargs():
                         help="Ouput log to file <customer>.log") 
     parse.add_argument('-d', '--debug', action='store_true', 
                         help="Enable debug messages")
+    parse.add_argument('-g', '--graph', type=str, default='',
+                        help="Also save graph as PNG file")
+    parse.add_argument('-w', '--workers', type=int, default=8,
+                        help="Maximum concurrent API requests (default 8)")
+    parse.add_argument('--cache', type=str, default='',
+                        help="Cache API responses in sqlite file")
+    parse.add_argument('--cache-ttl', type=int, default=0,
+                        help="Cache entry lifetime in seconds (default 86400)")
+    parse.add_argument('--no-cache', action='store_true',
+                        help="Disable response cache")
+    parse.add_argument('--refresh', action='store_true',
+                        help="Ignore cached responses and update cache")
+    parse.add_argument('--rollups', type=str, default='',
+                        help="Store daily insight rollups in sqlite file")
+    parse.add_argument('--shard', type=shard_arg, default='',
+                        help="Split queries into concurrent windows, e.g. 1d")
+    parse.add_argument('--rate', type=float, default=0,
+                        help="Limit API requests per second")
+    parse.add_argument('--retries', type=int, default=None,
+                        help="Retries for failed or throttled requests "
+                             "(default 3)")
+    parse.add_argument('--timeout', type=float, default=0,
+                        help="API read timeout in seconds (default 300)")
+    parse.add_argument('--record', type=str, default='',
+                        help="Record API calls to replay bundle file")
+    parse.add_argument('--replay', type=str, default='',
+                        help="Answer API calls from replay bundle file")
+    parse.add_argument('--latency', type=float, default=0,
+                        help="Seconds added per replayed API call")
+    parse.add_argument('--error-rate', type=float, default=0,
+                        help="Fraction of replayed API calls failed")
+    parse.add_argument('--metrics', type=str, default='',
+                        help="Write run metrics as JSON to file")
+    parse.add_argument('--prometheus', type=str, default='',
+                        help="Write run metrics as Prometheus textfile")
+    parse.add_argument('--trend', action='store_true',
+                        help="Compare with the previous period")
+    parse.add_argument('--charts', type=str, default='',
+                        help="Also render per insight charts, comma "
+                             "separated names or all")
+    parse.add_argument('--chart-processes', type=int, default=None,
+                        help="Chart rendering processes (default one "
+                             "per CPU, 0 in process)")
+    parse.add_argument('--artifacts', type=str, default='',
+                        help="Reuse charts and documents with unchanged "
+                             "inputs from this directory")
 
     return parse.parse_args()
 
@@ -154,6 +253,11 @@ def read_ini(ini_filename):
     ini_keys = [ 'b1inifile', 'doc_title', 'customer', 'contact',
                  'contact_phone', 'contact_email', 'time_period',
                  'prepared_by', 'prepared_email' ]
+    opt_keys = [ 'cache_file', 'cache_ttl', 'cache_size', 'cache_granularity',
+                 'rollup_store', 'shard', 'rate_limit', 'retries',
+                 'timeout', 'metrics_file', 'prometheus_file', 'schedule',
+                 'trend', 'artifact_store', 'artifact_size', 'charts',
+                 'chart_processes' ]
 
     # Attempt to read api_key from ini file
     try:
@@ -172,6 +276,10 @@ def read_ini(ini_filename):
             else:
                 logging.warning(f'Key {key} not found in {section} section.')
                 config[key] = ''
+        for key in opt_keys:
+            if key in cfg[section]:
+                config[key] = cfg[section][key].strip("'\"<>")
+                logging.debug(f'Key {key} found in {ini_filename}: {config[key]}')
     else:
         logging.warning(f'No {section} Section in config file: {ini_filename}')
 
@@ -179,76 +287,565 @@ def read_ini(ini_filename):
 
 
 def generate_graph(b1r, time_period, show=False, 
-                   save=True, filename='threat_view.png'):
+                   save=False, filename='threat_view.png', response=None,
+                   artifacts=None):
   '''
+  Generate the top 5 feed hits graph in memory
+
+  Parameters:
+    b1r (obj): b1reporting instance
+    time_period (str): Period in form of 3d, 2w, 1d
+    show (bool): Display the graph
+    save (bool): Save the graph to filename
+    filename (str): Filename for saved graph
+    response (obj): Pre-fetched tproperty insight response, retrieved
+                    if not supplied
+    artifacts (obj): Optional b1artifacts.ArtifactStore, a graph of the
+                     same data is reused rather than drawn
+
+  Returns:
+    io.BytesIO containing PNG image
   '''
+  import b1artifacts
+  import b1response
+
   list_key =[]
   list_count =[]
 
   # *** Graph code start
-  logging.info('Retrieving data for graph') 
-  response = b1r.get_insight('tproperty', time_period) 
+  if response is None:
+    logging.info('Retrieving data for graph') 
+    response = b1r.get_insight('tproperty', time_period) 
+  response = b1response.wrap(response)
   if response.status_code in b1r.return_codes_ok:
     logging.info('- Graph data retrieved')
-    logging.debug(f'{response.json()}')
     # Populate Graph Data
-    for data in response.json()['results'][0]['sub_bucket']:
-        logging.debug(f"{ data['key'] } - { data['count'] }")
-        list_key.append(data['key'])
-        list_count.append(int(data['count']))
-
-  # Gernerate graph
-  ax = plt.subplot()
-  hbar = ax.barh(range(len(list_count)), list_count, align='center', 
-                color=['red', 'orange', 'cyan', 'blue', 'green']) 
-  ax.set_title('Top 5 Feed Hits')
-  ax.set_xlabel('Total Hits')
-  ax.set_ylabel('Feed Name')
-  ax.set_xscale('log')
-  # ax.set_xticks(range(len(list_count)))
-  ax.set_yticks(range(len(list_count)), list_key)
-  ax.bar_label(hbar)
-  # plt.subplots_adjust(left=0.2, right=0.9, bottom=0.3, top=0.9)
-  plt.tight_layout()
-  logging.info('- Graph generated')
+    for bucket in response.buckets():
+        logging.debug('%s - %s', bucket.key, bucket.count)
+        list_key.append(bucket.key)
+        list_count.append(bucket.count)
+
+  # Generate graph, or reuse a stored graph of the same data
+  chart = { 'keys': list_key, 'counts': list_count,
+            'title': 'Top 5 Feed Hits', 'xlabel': 'Total Hits',
+            'ylabel': 'Feed Name', 'log': True }
+  png = None
+  if artifacts:
+    key = b1artifacts.digest('barh_chart', chart)
+    png = artifacts.get(key, '.png')
+  if png is not None:
+    image = io.BytesIO(png)
+    if save:
+      with open(filename, 'wb') as f:
+        f.write(png)
+    logging.info('- Graph reused')
+  else:
+    import b1charts
+    image = b1charts.barh_chart(**chart, filename=filename if save else '')
+    if artifacts:
+      artifacts.put(key, image.getvalue(), '.png')
+    logging.info('- Graph generated')
   if show:
+    import matplotlib.pyplot as plt
+    plt.imshow(plt.imread(image))
+    plt.axis('off')
     plt.show()
+    image.seek(0)
     logging.info('- Graph displayed')
-  if save:
-    plt.savefig(filename)
-    logging.info(f'- Graph saved as {filename}')
   # *** Graph code ends
 
-  return
+  return image
 
 
-def main():
+def chart_names(charts):
   '''
-  Core Logic
+  Chart names from a comma separated list, or all
+
+  Parameters:
+    charts (str): e.g. 'dex_users,doh_devices' or 'all'
+
+  Returns:
+    List of names in CHARTS
   '''
+  if str(charts).strip().lower() == 'all':
+    return list(CHARTS.keys())
+  names = []
+  for name in str(charts or '').split(','):
+    name = name.strip()
+    if name in CHARTS:
+      names.append(name)
+    elif name:
+      logging.warning(f'Unknown chart {name}, one of {list(CHARTS.keys())}')
+
+  return names
+
+
+def build_chart_specs(insights, report_data, names, size=10):
+  '''
+  Build chart specs from the report insight data
+
+  Parameters:
+    insights (dict): Insight registry of the report, for the insight
+                     aggregations, see b1reporting.insight_registry()
+    report_data (dict): Report data from fetch_report_data()
+    names (list): Chart names in CHARTS
+    size (int): Bars per chart
+
+  Returns:
+    List of chart specs for b1charts.render_charts(), charts without
+    data are omitted
+  '''
+  import collections
+  import b1aggregate
+  import b1response
+
+  specs = []
+  for name in names:
+    insight, agg_key, sub_key, title, label = CHARTS[name]
+    aggs = [ a.get('key') for a in insights.get(insight, {}).get('aggs', []) ]
+    data = report_data.get(f'data_{insight}') or {}
+    results = data.get('results') or []
+    buckets = []
+    if agg_key in aggs and aggs.index(agg_key) < len(results):
+      buckets = results[aggs.index(agg_key)].get('sub_bucket') or []
+
+    counts = collections.Counter()
+    for b in buckets:
+      bucket = b1response.Bucket(b.get('key'), int(b.get('count', 0)),
+                                 b.get('sub_bucket') or [])
+      if sub_key:
+        counts.update(bucket.sub_counts(sub_key))
+      else:
+        counts[bucket.key] += bucket.count
+    top = b1aggregate.top_n(counts, size)
+    if not top:
+      logging.info(f'- No data for {name} chart')
+      continue
+    # Largest at the top of the chart
+    top.reverse()
+    specs.append({ 'name': name,
+                   'keys': [ str(k) for k, _ in top ],
+                   'counts': [ c for _, c in top ],
+                   'title': title, 'xlabel': 'Hits', 'ylabel': label })
+
+  return specs
+
+
+def generate_charts(insights, report_data, names, artifacts=None,
+                    processes=None, metrics=None):
+  '''
+  Render per insight charts, in parallel worker processes
+
+  Parameters:
+    insights (dict): Insight registry of the report
+    report_data (dict): Report data from fetch_report_data()
+    names (list): Chart names in CHARTS
+    artifacts (obj): Optional b1artifacts.ArtifactStore, charts of the
+                     same data are reused rather than drawn
+    processes (int): Rendering processes, see b1charts.render_charts()
+    metrics (obj): Optional b1metrics.Metrics, the render time of each
+                   chart is recorded as stage chart_<name>
+
+  Returns:
+    dict of name: io.BytesIO PNG
+  '''
+  import b1artifacts
+
+  charts = {}
+  pending = []
+  for spec in build_chart_specs(insights, report_data, names):
+    key = b1artifacts.digest('chart', spec)
+    png = artifacts.get(key, '.png') if artifacts else None
+    if png is not None:
+      charts[spec['name']] = io.BytesIO(png)
+      logging.info(f'- {spec["name"]} chart reused')
+    else:
+      pending.append((key, spec))
+
+  if pending:
+    import b1charts
+    rendered = b1charts.render_charts([ spec for _, spec in pending ],
+                                      processes=processes)
+    for key, spec in pending:
+      image, seconds = rendered[spec['name']]
+      charts[spec['name']] = image
+      if artifacts:
+        artifacts.put(key, image.getvalue(), '.png')
+      if metrics:
+        metrics.record_stage(f'chart_{spec["name"]}', seconds)
+      logging.info(f'- {spec["name"]} chart rendered in {seconds:.2f}s')
+
+  return { name: charts[name] for name in names if name in charts }
+
+
+def fetch_report_data(b1r, time_period, workers=8, insights=None):
+  '''
+  Retrieve all report data concurrently
+
+  The insights, counts, graph and total hit data are requested together
+  through the b1reporting planner, which combines compatible insights
+  into single requests and runs the requests concurrently, wall-clock
+  time is therefore roughly that of the slowest single call.
+
+  Parameters:
+    b1r (obj): b1reporting instance
+    time_period (str): Period in form of 3d, 2w, 1d
+    workers (int): Maximum number of concurrent requests
+    insights (dict): Insight registry of the report, default the
+                     client registry, see b1reporting.insight_registry()
+
+  Returns:
+    Tuple of (report_data (dict), graph_response, exitcode (int))
+  '''
+  import b1reporting
+
   exitcode = 0
-  # usefile = False
-  doc_data = {}
+  report_data = {}
+  sections = [ 'dex', 'doh', 'malware', 'category' ]
 
-  args = parseargs()
-  config = read_ini(args.config)
-  b1inifile = config['b1inifile']
-  time_period = config.get('time_period')
+  b1r.max_workers = max(1, workers)
+  logging.info(f'Retrieving report data, max {workers} concurrent requests')
+  responses = b1r.get_insights(b1reporting.REPORT_INSIGHTS, time_period,
+                               registry=insights)
 
-  if config['b1inifile']:
-      b1inifile = config['b1inifile']
-  else:
-      # Try to use inifile
-      b1inifile = args.config
+  # Get core insights - note data is processed in doc template
+  for insight in sections:
+    section_name = 'data_' + insight
+    response = responses[insight]
+    if response.status_code in b1r.return_codes_ok:
+      logging.info(f' - {insight} data retrieved')
+      data = response.json()
+    else:
+      logging.error(f'Error for {insight} report.')
+      logging.info(f'HTTP Code: {response.status_code}')
+      logging.info(f'Response: {response.text}')
+      data = {}
+      exitcode = 1
+    report_data.update({ section_name: data })
 
-  if args.debug:
-    logging.getLogger().setLevel(logging.DEBUG) 
-  else:
-    logging.getLogger().setLevel(logging.INFO) 
+  # Add total security hit counts
+  report_data.update(b1r.get_counts(time_period, 
+                                    response=responses['tclass']))
+  # Get total number of security hits
+  report_data.update({ "total_events": 
+                       b1r.get_total_hits(time_period, 
+                                          response=responses['hit_count']) })
+  graph_response = responses['tproperty']
 
-  logging.info('Configuration read.')
+  return report_data, graph_response, exitcode
+
+
+def fetch_trend_data(b1r, time_period, workers=8, insights=None):
+  '''
+  Retrieve report data for the period and the previous period
+
+  Both periods are retrieved concurrently through the same client, so
+  together they share its limit of workers requests in flight and the
+  wall-clock time is close to that of a single period. With a rollup
+  store the complete days of the previous period are normally served
+  from the store.
+
+  Parameters:
+    b1r (obj): b1reporting instance
+    time_period (str): Period in form of 3d, 2w, 1d
+    workers (int): Maximum number of concurrent requests
+    insights (dict): Insight registry of the report
+
+  Returns:
+    Tuple of (current report_data, previous report_data, 
+              graph_response, exitcode (int))
+  '''
+  import b1reporting
+  import concurrent.futures
+
+  previous_period = b1reporting.previous_period(time_period)
+  with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+    jobs = [ pool.submit(fetch_report_data, b1r, period, workers, insights)
+             for period in [ time_period, previous_period ] ]
+    (current, graph_response, exitcode), (previous, _, previous_exit) = [
+        job.result() for job in jobs ]
+
+  return current, previous, graph_response, exitcode or previous_exit
+
+
+def result_counts(data):
+  '''
+  Top level bucket counts of each result in an insight response
+
+  Parameters:
+    data (dict): Decoded insight response
+
+  Returns:
+    dict of result key (or index): dict of bucket key: count (int)
+  '''
+  counts = {}
+  for index, result in enumerate(data.get('results') or []):
+    counts[result.get('key') or str(index)] = {
+        b.get('key'): int(b.get('count', 0))
+        for b in result.get('sub_bucket') or [] }
+
+  return counts
+
+
+def build_trend(current, previous, time_period):
+  '''
+  Build period over period changes for the template
+
+  Parameters:
+    current (dict): Report data for the period
+    previous (dict): Report data for the previous period
+    time_period (str): Period in form of 3d, 2w, 1d
+
+  Returns:
+    trend (dict): 'period', 'totals' of total_events, total_dex_count
+                  and total_mal_count, and 'insights' of per insight and
+                  result key lists of b1aggregate.compare_counts() rows
+  '''
+  import b1aggregate
+
+  trend = { 'period': time_period, 'totals': {}, 'insights': {} }
+  def count(value):
+    # total_events is formatted with separators, -1 on error
+    value = int(str(value or 0).replace(',', ''))
+    return None if value < 0 else value
+
+  for key in [ 'total_events', 'total_dex_count', 'total_mal_count' ]:
+    trend['totals'][key] = b1aggregate.change(count(current.get(key)),
+                                              count(previous.get(key)))
+  for section, data in current.items():
+    if section.startswith('data_') and isinstance(data, dict):
+      # Failed sections are empty, their counts are unknown
+      previous_counts = None
+      if previous.get(section):
+        previous_counts = result_counts(previous[section])
+      trend['insights'][section[len('data_'):]] = {
+          key: b1aggregate.compare_counts(
+                   counts,
+                   None if previous_counts is None 
+                   else previous_counts.get(key, {}),
+                   size=len(counts))
+          for key, counts in result_counts(data).items() }
+
+  total = trend['totals']['total_events']
+  if total['change'] is not None:
+    logging.info(f'Total hits {total["current"]:,}, {total["change"]:+}% '
+                 f'on the previous {time_period}')
+
+  return trend
+
+
+def open_cache(config, no_cache=False):
+  '''
+  Open the response cache specified in the report config
+
+  Caches are shared per process by filename and options, so reports
+  with different cache settings do not share a cache object. To bypass
+  the cache for a report use the refresh argument of generate_report().
+
+  Parameters:
+    config (dict): Report config from read_ini()
+    no_cache (bool): Disable cache regardless of config
+
+  Returns:
+    b1cache.ResponseCache instance or None
+  '''
+  import b1cache
+
+  cache = None
+  filename = config.get('cache_file')
+  if filename and not no_cache:
+    options = {}
+    if config.get('cache_ttl'):
+      options['ttl'] = int(config['cache_ttl'])
+    if config.get('cache_size'):
+      options['max_size'] = int(config['cache_size']) * 1024 * 1024
+    if config.get('cache_granularity'):
+      options['granularity'] = int(config['cache_granularity'])
+    key = (filename, tuple(sorted(options.items())))
+    with _clients_lock:
+      if key not in _caches:
+        _caches[key] = b1cache.ResponseCache(filename, **options)
+      cache = _caches[key]
+    logging.info(f'Using response cache {filename}')
+
+  return cache
+
+
+def open_artifacts(config):
+  '''
+  Open the artifact store specified in the report config
+
+  Stores are shared per process by directory.
+
+  Parameters:
+    config (dict): Report config from read_ini()
+
+  Returns:
+    b1artifacts.ArtifactStore instance or None
+  '''
+  store = None
+  directory = config.get('artifact_store')
+  if directory:
+    import b1artifacts
+    with _clients_lock:
+      if directory not in _artifacts:
+        options = {}
+        if config.get('artifact_size'):
+          options['max_size'] = int(config['artifact_size']) * 1024 * 1024
+        _artifacts[directory] = b1artifacts.ArtifactStore(directory,
+                                                          **options)
+      store = _artifacts[directory]
+    logging.info(f'Using artifact store {directory}')
+
+  return store
+
+
+def open_rollups(config):
+  '''
+  Open the daily rollup store specified in the report config
+
+  Parameters:
+    config (dict): Report config from read_ini()
+
+  Returns:
+    b1rollup.RollupStore instance or None
+  '''
+  import b1rollup
+
+  store = None
+  filename = config.get('rollup_store')
+  if filename:
+    with _clients_lock:
+      if filename not in _rollups:
+        _rollups[filename] = b1rollup.RollupStore(filename)
+      store = _rollups[filename]
+    logging.info(f'Using rollup store {filename}')
+
+  return store
+
+
+def open_bundle(config):
+  '''
+  Get the record or replay bundle specified in the report config
+
+  Bundles are shared per process by filename.
+
+  Parameters:
+    config (dict): Report config, record or replay key set to the
+                   bundle filename
+
+  Returns:
+    b1replay.Bundle instance or None
+  '''
+  bundle = None
+  filename = config.get('replay') or config.get('record')
+  if filename:
+    import b1replay
+    with _clients_lock:
+      if filename not in _bundles:
+        if config.get('replay'):
+          _bundles[filename] = b1replay.Bundle.load(filename)
+        else:
+          _bundles[filename] = b1replay.Bundle()
+          logging.info(f'Recording API calls to {filename}')
+      bundle = _bundles[filename]
+
+  return bundle
+
+
+def open_transport(config, workers=8):
+  '''
+  Get the HTTP transport for the report config
+
+  Transports, and so connection pools and the request rate limit, are
+  shared per process by all clients with the same settings. When
+  recording or replaying the transport records to, or answers from,
+  the bundle.
+
+  Parameters:
+    config (dict): Report config from read_ini()
+    workers (int): Maximum concurrent API requests, sizes the pool
+
+  Returns:
+    b1transport.Transport instance
+  '''
+  import b1transport
+
+  rate = float(config.get('rate_limit') or 0)
+  retries = int(config.get('retries') or 3)
+  timeout = float(config.get('timeout') or 300)
+  bundle = open_bundle(config)
+  latency = float(config.get('replay_latency') or 0)
+  error_rate = float(config.get('replay_error_rate') or 0)
+  key = (workers, rate, retries, timeout, config.get('record'),
+         config.get('replay'), latency, error_rate)
+  with _clients_lock:
+    if key not in _transports:
+      limiter = None
+      if rate:
+        limiter = b1transport.shared_limiter('csp', rate)
+        logging.info(f'API requests limited to {rate}/s')
+      _transports[key] = b1transport.Transport(pool_size=workers,
+                                               retries=retries,
+                                               timeout=(10, timeout),
+                                               limiter=limiter)
+      if bundle:
+        import b1replay
+        if config.get('replay'):
+          b1replay.replay(_transports[key], 
+                          b1replay.Replayer(bundle, latency=latency,
+                                            error_rate=error_rate))
+        else:
+          b1replay.record(_transports[key], bundle)
+
+  return _transports[key]
+
+
+def get_client(b1inifile, cache=None, rollups=None, transport=None,
+               refresh=False):
+  '''
+  Return a b1reporting instance for the bloxone inifile
+
+  Instances are cached per process so that reports sharing an API key
+  also share a client.
+
+  Parameters:
+    b1inifile (str): bloxone module inifile with API key
+    cache (obj): Optional b1cache.ResponseCache instance
+    rollups (obj): Optional b1rollup.RollupStore instance
+    transport (obj): Optional b1transport.Transport instance
+    refresh (bool): Bypass (and update) cached responses
+
+  Returns:
+    b1reporting instance
+  '''
+  import b1reporting
+
+  key = os.path.realpath(b1inifile)
+  with _clients_lock:
+    if key not in _clients:
+      _clients[key] = b1reporting.b1reporting(b1inifile)
+    _clients[key].cache = cache
+    _clients[key].refresh = refresh
+    _clients[key].rollups = rollups
+    if transport:
+      _clients[key].transport = transport
+
+  return _clients[key]
+
+
+def build_doc_data(config):
+  '''
+  Build the document dictionary from the report config
+
+  Parameters:
+    config (dict): Report config from read_ini()
+
+  Returns:
+    doc_data (dict): Base template data
+  '''
+  doc_data = {}
   iso_date = (datetime.date.today()).strftime("%Y-%m-%d")
-  # Build document dictionary
   doc_data.update({"doc_title": config.get('doc_title')})
   doc_data.update({"customer": config.get('customer')})
   doc_data.update({"contact": config.get('contact')})
@@ -258,70 +855,291 @@ def main():
   doc_data.update({"prepared_email": config.get('prepared_email')})
   doc_data.update({"iso_date": iso_date})
 
-  # Instantiate reporting class
-  b1r = b1reporting.b1reporting(b1inifile)
+  return doc_data
 
-  # Get core insights - note data is processed in doc template
-  insights = [ 'dex', 'doh', 'malware', 'category' ]
-  for insight in insights:
-    section_name = 'data_' + insight
-    logging.info(f'Retrieving {insight} data')
-    response = b1r.get_insight(insight, time_period)
-    if response.status_code in b1r.return_codes_ok:
-      logging.info(f' - {insight} data retrieved')
-      report_data = response.json()
-    else:
-      logging.error(f'Error for {insight} report.')
-      logging.info(f'HTTP Code: {response.status_code}')
-      logging.info(f'Response: {response.text}')
-      report_data = {}
-      exitcode = 1
-    doc_data.update({ section_name: report_data })
 
+def report_filename(config, outdir=''):
+  '''
+  Generate the output document filename for a report config
+
+  Parameters:
+    config (dict): Report config from read_ini()
+    outdir (str): Optional output directory
+
+  Returns:
+    filename (str)
+  '''
+  iso_date = (datetime.date.today()).strftime("%Y-%m-%d")
+  filename = ("B1TD_Report_" + iso_date + "_" + 
+              re.sub('[^a-zA-Z0-9]', '_', config.get('customer', '')) + ".docx")
+  if outdir:
+    filename = os.path.join(outdir, filename)
+
+  return filename
+
+
+def print_categories(doc_data):
+  '''
+  Print the category users and devices
+  '''
+  import b1aggregate
+
+  tree = b1aggregate.BucketTree.from_data(doc_data.get('data_category') or {})
   # To break out the users and networks later
   print('Categories')
-  for data in doc_data['data_category']['results'][0]['sub_bucket']:
-    print(f"{ data['key'] } - { data['count'] }")
-    for da in data['sub_bucket']:
-      #print(f"{ da['key'] } - { da['count'] }")
-      if da['key'] == 'user':
+  for category in tree.children(tree.result(0)):
+    print(f"{ tree.value(category) } - { tree.count[category] }")
+    for sub_key in tree.children(category):
+      name = tree.value(sub_key)
+      if name == 'user':
         print("User")
-      if da['key'] == 'device_name':
+      if name == 'device_name':
         print("Device")
-      for d in da['sub_bucket']:
-        if da['key'] != 'feed_name':
-          print(f"\b1{ d['key'] } - { d['count'] }")
+      if name != 'feed_name':
+        for key, count in tree.items(sub_key):
+          print(f"\b1{ key } - { count }")
 
-  # Add total security hit counts
-  doc_data.update(b1r.get_counts(time_period))
- 
-  # Generate graph
-  generate_graph(b1r, time_period)
+  return
 
-  # Get total number of security hits
-  total_events = b1r.get_total_hits(time_period)
-  doc_data.update({ "total_events": total_events })
 
-  # Define template file to use
-  doc = docxtpl.DocxTemplate(args.template)
+def generate_report(config, template, workers=8, outdir='', 
+                    show_categories=False, cache=None, graph_file='',
+                    refresh=False):
+  '''
+  Generate the report document for a single report config
+
+  When the config trend key is set the previous period is also
+  retrieved and the template data includes 'previous' (report data for
+  the previous period) and 'trend', see build_trend().
 
-  # Adding the graph_data to the Word Doc
-  myimage = docxtpl.InlineImage(doc, image_descriptor='threat_view.png')
-  doc_data.update({"myimage": myimage})
+  Parameters:
+    config (dict): Report config from read_ini()
+    template (str): docx template filename
+    workers (int): Maximum concurrent API requests
+    outdir (str): Optional output directory
+    show_categories (bool): Print category breakdown
+    cache (obj): Optional b1cache.ResponseCache instance
+    graph_file (str): Also save the graph as PNG to this file
+    refresh (bool): Bypass (and update) cached responses
 
-  # Populate Template
-  logging.info('Generating document')
-  doc.render(doc_data)
-  # The output file is 
-  # doc.save("report5.docx")
-  filename = ("B1TD_Report_" + iso_date + "_" + 
-              re.sub('[^a-zA-Z0-9]', '_', config.get('customer')) + ".docx")
+  Returns:
+    Tuple of (exitcode (int), filename (str))
+  '''
+  import b1metrics
+  import b1reporting
+
+  start = time.perf_counter()
+  metrics = b1metrics.Metrics()
+  time_period = config.get('time_period')
+  trend = str(config.get('trend', '')).lower() in [ '1', 'true', 'yes', 'on' ]
+
+  if config.get('b1inifile'):
+      b1inifile = config['b1inifile']
+  else:
+      # Try to use inifile
+      b1inifile = config.get('filename')
+
+  # Build document dictionary
+  doc_data = build_doc_data(config)
+  filename = report_filename(config, outdir=outdir)
+
+  try:
+    shard_arg(config.get('shard', ''))
+  except argparse.ArgumentTypeError as err:
+    logging.error(f'{config.get("filename")}: {err}')
+    return 1, filename
+
+  # Instantiate reporting class
+  with metrics.stage('setup'):
+    b1r = get_client(b1inifile, cache=cache, rollups=open_rollups(config),
+                     transport=open_transport(config, workers),
+                     refresh=refresh)
+    b1r.shard = config.get('shard', '')
+    b1r.metrics = metrics
+    # Recorded windows are requested again on replay
+    bundle = open_bundle(config)
+    b1r.clock = bundle.now if bundle else None
+    # Per report insights, [Insight] sections apply to this report only
+    insights = b1reporting.insight_registry(config.get('filename'))
+    artifacts = open_artifacts(config)
+
+  # All report queries use one time window and share identical requests
+  with b1r.snapshot():
+    # Retrieve insights, counts and graph data
+    with metrics.stage('fetch'):
+      if trend:
+        report_data, previous, graph_response, exitcode = fetch_trend_data(
+            b1r, time_period, workers, insights)
+        report_data['previous'] = previous
+        report_data['trend'] = build_trend(report_data, previous,
+                                           time_period)
+      else:
+        report_data, graph_response, exitcode = fetch_report_data(
+            b1r, time_period, workers, insights)
+    doc_data.update(report_data)
+
+    if show_categories:
+      print_categories(doc_data)
+
+    # Generate graph in memory, optionally saved
+    with metrics.stage('graph'):
+      image = generate_graph(b1r, time_period, response=graph_response, 
+                             save=bool(graph_file), filename=graph_file,
+                             artifacts=artifacts)
+
+    # Per insight charts
+    charts = {}
+    names = chart_names(config.get('charts', ''))
+    if names:
+      processes = config.get('chart_processes')
+      with metrics.stage('charts'):
+        charts = generate_charts(insights, report_data, names,
+                                 artifacts=artifacts, metrics=metrics,
+                                 processes=None if processes in [ None, '' ]
+                                           else int(processes))
+
+  # Reuse the document if template, report data and graphs are unchanged
+  document = None
+  if artifacts:
+    import b1artifacts
+    doc_key = b1artifacts.digest('docx', b1artifacts.file_digest(template),
+                                 doc_data, image.getvalue(),
+                                 { k: v.getvalue() for k, v in charts.items() })
+    document = artifacts.get(doc_key, '.docx')
+
+  if document is not None:
+    try:
+      with metrics.stage('save'):
+        with open(filename, 'wb') as f:
+          f.write(document)
+      logging.info(f'Document {filename} reused')
+    except OSError:
+      logging.error(f'Failed to create document {filename}')
+      exitcode = 1
+  else:
+    import b1template
+    import docxtpl
+
+    # Define template file to use, parsed once per process
+    with metrics.stage('template'):
+      doc = b1template.get_template(template)
+
+    # Adding the graph_data to the Word Doc
+    myimage = docxtpl.InlineImage(doc, image_descriptor=image)
+    doc_data.update({"myimage": myimage})
+    doc_data.update({"charts": { name: docxtpl.InlineImage(doc, 
+                                                           image_descriptor=c)
+                                 for name, c in charts.items() }})
+
+    # Populate Template
+    logging.info('Generating document')
+    with metrics.stage('render'):
+      doc.render(doc_data)
+    try:
+      with metrics.stage('save'):
+        doc.save(filename)
+      logging.info(f'Document {filename} created')
+      if artifacts and not exitcode:
+        with open(filename, 'rb') as f:
+          artifacts.put(doc_key, f.read(), '.docx')
+    except:
+      logging.error(f'Failed to create document {filename}')
+      exitcode = 1
+
+  b1r.metrics = None
+  metrics.record_stage('total', time.perf_counter() - start)
+  metrics.log_summary()
+  write_metrics(config, metrics, exitcode, filename)
+
+  return exitcode, filename
+
+
+def write_metrics(config, metrics, exitcode, filename):
+  '''
+  Write run metrics to the files specified in the report config
+
+  Parameters:
+    config (dict): Report config, optional metrics_file and
+                   prometheus_file keys
+    metrics (obj): b1metrics.Metrics instance
+    exitcode (int): Report exit code
+    filename (str): Report document filename
+  '''
+  customer = config.get('customer', '')
   try:
-    doc.save(filename)
-    logging.info(f'Document {filename} created')
-  except:
-    logging.error(f'Failed to create document {filename}')
-    exitcode = 1
+    if config.get('metrics_file'):
+      metrics.write_json(config['metrics_file'], customer=customer,
+                         document=filename, exitcode=exitcode)
+      logging.info(f'Metrics written to {config["metrics_file"]}')
+    if config.get('prometheus_file'):
+      metrics.write_prometheus(config['prometheus_file'],
+                               labels={ 'customer': customer },
+                               success=(exitcode == 0))
+      logging.info(f'Metrics written to {config["prometheus_file"]}')
+  except OSError as err:
+    logging.error(f'Failed to write metrics: {err}')
+
+  return
+
+
+def main():
+  '''
+  Core Logic
+  '''
+  exitcode = 0
+
+  args = parseargs()
+  config = read_ini(args.config)
+
+  if args.debug:
+    logging.getLogger().setLevel(logging.DEBUG) 
+  else:
+    logging.getLogger().setLevel(logging.INFO) 
+
+  logging.info('Configuration read.')
+  if args.cache:
+    config['cache_file'] = args.cache
+  if args.cache_ttl:
+    config['cache_ttl'] = args.cache_ttl
+  if args.rollups:
+    config['rollup_store'] = args.rollups
+  if args.shard:
+    config['shard'] = args.shard
+  if args.rate:
+    config['rate_limit'] = args.rate
+  if args.retries is not None:
+    config['retries'] = args.retries
+  if args.timeout:
+    config['timeout'] = args.timeout
+  if args.metrics:
+    config['metrics_file'] = args.metrics
+  if args.prometheus:
+    config['prometheus_file'] = args.prometheus
+  if args.trend:
+    config['trend'] = 'true'
+  if args.artifacts:
+    config['artifact_store'] = args.artifacts
+  if args.charts:
+    config['charts'] = args.charts
+  if args.chart_processes is not None:
+    config['chart_processes'] = args.chart_processes
+  if args.record or args.replay:
+    # Every API call must reach the recorder/replayer
+    config['record'] = args.record
+    config['replay'] = args.replay
+    config['replay_latency'] = args.latency
+    config['replay_error_rate'] = args.error_rate
+    args.no_cache = True
+  cache = open_cache(config, no_cache=args.no_cache)
+
+  exitcode, filename = generate_report(config, args.template, 
+                                       workers=args.workers,
+                                       show_categories=True,
+                                       cache=cache,
+                                       graph_file=args.graph,
+                                       refresh=args.refresh)
+  if args.record:
+    open_bundle(config).save(args.record)
 
   return exitcode
 
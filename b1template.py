@@ -0,0 +1,282 @@
+#!/usr/local/bin/python3
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+'''
+------------------------------------------------------------------------
+
+ Description:
+
+ Parsed and compiled docx template cache for B1TD reports
+
+ Loading a docxtpl template unzips and parses the .docx, and rendering
+ it patches the XML and compiles the Jinja template each time. The cache
+ does this work once per template file (keyed by path, mtime and size)
+ and hands out cheap per render copies, so rendering N reports costs one
+ parse and compile plus N renders, e.g.
+
+    doc = b1template.get_template('sample_B1TD_report_template.docx')
+    doc.render(context)
+    doc.save(filename)
+
+ Requirements:
+  docxtpl
+
+ Date Last Updated: 20261017
+
+ Todo:
+
+ Copyright (c) 2022 Chris Marrison / Infoblox
+
+ Redistribution and use in source and binary forms,
+ with or without modification, are permitted provided
+ that the following conditions are met:
+
+ 1. Redistributions of source code must retain the above copyright
+ notice, this list of conditions and the following disclaimer.
+
+ 2. Redistributions in binary form must reproduce the above copyright
+ notice, this list of conditions and the following disclaimer in the
+ documentation and/or other materials provided with the distribution.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+ "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+ LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+ FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+ COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+ INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+ BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+ LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+ CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+ LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+ ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ POSSIBILITY OF SUCH DAMAGE.
+
+------------------------------------------------------------------------
+'''
+import logging
+import copy
+import hashlib
+import io
+import os
+import threading
+import docx
+import docxtpl
+import jinja2
+
+__version__ = '0.0.1'
+__author__ = 'Chris Marrison'
+__author_email__ = 'chris@infoblox.com'
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+class CachingEnvironment(jinja2.Environment):
+    '''
+    Jinja environment that compiles each distinct template source once
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._compiled = {}
+        self._compiled_lock = threading.Lock()
+
+        return
+
+
+    def from_string(self, source, globals=None, template_class=None):
+        if globals or template_class or not isinstance(source, str):
+            return super().from_string(source, globals, template_class)
+        template = self._compiled.get(source)
+        if template is None:
+            template = super().from_string(source)
+            with self._compiled_lock:
+                template = self._compiled.setdefault(source, template)
+
+        return template
+
+
+class TemplateEntry:
+    '''
+    Parsed template file shared by all renders in the process
+    '''
+    def __init__(self, filename, key):
+        '''
+        Parameters:
+            filename (str): docx template file
+            key (tuple): Cache key (path, mtime, size)
+        '''
+        self.filename = filename
+        self.key = key
+        with open(filename, 'rb') as f:
+            self.blob = f.read()
+        self.digest = hashlib.sha256(self.blob).hexdigest()
+        self.docx = docx.Document(io.BytesIO(self.blob))
+        self.renders = 0
+        self._envs = {}
+        self._patched = {}
+        self._lock = threading.Lock()
+
+        return
+
+
+    def copy_docx(self):
+        '''
+        Independent copy of the parsed document
+        '''
+        with self._lock:
+            self.renders += 1
+
+        return copy.deepcopy(self.docx)
+
+
+    def environment(self, autoescape=False):
+        '''
+        Shared compiling Jinja environment
+        '''
+        with self._lock:
+            if autoescape not in self._envs:
+                self._envs[autoescape] = CachingEnvironment(
+                                                    autoescape=autoescape)
+
+        return self._envs[autoescape]
+
+
+    def patch_xml(self, src_xml, patch):
+        '''
+        Memoised docxtpl XML patching, the result only depends on the
+        template XML
+        '''
+        patched = self._patched.get(src_xml)
+        if patched is None:
+            patched = patch(src_xml)
+            with self._lock:
+                patched = self._patched.setdefault(src_xml, patched)
+
+        return patched
+
+
+class CachedDocxTemplate(docxtpl.DocxTemplate):
+    '''
+    DocxTemplate using a shared TemplateEntry for the parsed document,
+    patched XML and compiled Jinja templates. Use once per document.
+    '''
+    def __init__(self, entry):
+        super().__init__(entry.filename)
+        self._entry = entry
+
+        return
+
+
+    def init_docx(self, reload=True):
+        if not self.docx or (self.is_rendered and reload):
+            self.docx = self._entry.copy_docx()
+            self.is_rendered = False
+
+        return
+
+
+    def patch_xml(self, src_xml):
+        return self._entry.patch_xml(src_xml, super().patch_xml)
+
+
+    def render(self, context, jinja_env=None, autoescape=False):
+        if jinja_env is None:
+            jinja_env = self._entry.environment(autoescape)
+        super().render(context, jinja_env=jinja_env, autoescape=autoescape)
+
+        return
+
+
+class TemplateCache:
+    '''
+    Per process cache of parsed docx templates
+
+    Entries are keyed by absolute path, modification time and size, so
+    an edited template is reloaded on next use.
+    '''
+    def __init__(self, max_entries=8):
+        '''
+        Parameters:
+            max_entries (int): Template files kept, least recently used
+                               are dropped
+        '''
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+        return
+
+
+    def entry(self, filename):
+        '''
+        Get parsed template entry, loading it if required
+
+        Parameters:
+            filename (str): docx template file
+
+        Returns:
+            TemplateEntry
+        '''
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry and entry.key == key:
+                self.hits += 1
+            else:
+                if entry:
+                    logging.debug(f'Template {path} changed, reloading')
+                logging.debug(f'Loading template {path}')
+                entry = TemplateEntry(path, key)
+                self.misses += 1
+            # Most recently used last
+            self._entries[path] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.pop(next(iter(self._entries)))
+
+        return entry
+
+
+    def get(self, filename):
+        '''
+        Get a template ready to render
+
+        Parameters:
+            filename (str): docx template file
+
+        Returns:
+            CachedDocxTemplate, a new instance per call
+        '''
+        return CachedDocxTemplate(self.entry(filename))
+
+
+    def clear(self):
+        '''
+        Drop all cached templates
+        '''
+        with self._lock:
+            self._entries.clear()
+
+        return
+
+# End of class
+
+
+def get_template(filename):
+    '''
+    Get a template ready to render from the process wide cache
+
+    Parameters:
+        filename (str): docx template file
+
+    Returns:
+        CachedDocxTemplate, a new instance per call
+    '''
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = TemplateCache()
+
+    return _default_cache.get(filename)
@@ -0,0 +1,261 @@
+#!/usr/local/bin/python3
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+'''
+------------------------------------------------------------------------
+
+ Description:
+
+ Pooled, retrying and rate limited HTTP transport for b1reporting
+
+ Date Last Updated: 20261017
+
+ Todo:
+
+ Copyright (c) 2022 Chris Marrison / Infoblox
+
+ Redistribution and use in source and binary forms,
+ with or without modification, are permitted provided
+ that the following conditions are met:
+
+ 1. Redistributions of source code must retain the above copyright
+ notice, this list of conditions and the following disclaimer.
+
+ 2. Redistributions in binary form must reproduce the above copyright
+ notice, this list of conditions and the following disclaimer in the
+ documentation and/or other materials provided with the distribution.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+ "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+ LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+ FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+ COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+ INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+ BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+ LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+ CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+ LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+ ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ POSSIBILITY OF SUCH DAMAGE.
+
+------------------------------------------------------------------------
+'''
+import logging
+import email.utils
+import random
+import threading
+import time
+import requests
+import requests.adapters
+
+__version__ = '0.0.1'
+__author__ = 'Chris Marrison'
+__author_email__ = 'chris@infoblox.com'
+
+# Status codes that are retried
+RETRY_CODES = [ 429, 500, 502, 503, 504 ]
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class TokenBucket:
+    '''
+    Thread safe token bucket request rate limiter
+    '''
+    def __init__(self, rate, burst=None):
+        '''
+        Parameters:
+            rate (float): Requests per second
+            burst (int): Bucket size, defaults to rate (minimum 1)
+        '''
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+        return
+
+
+    def acquire(self):
+        '''
+        Block until a request may be made
+
+        Returns:
+            Seconds waited
+        '''
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst,
+                                   self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+def shared_limiter(name, rate, burst=None):
+    '''
+    Get a named rate limiter shared by all transports in the process
+    with the same rate, e.g. one limiter for all tenants on the same CSP
+
+    Limiters are kept per name and rate, so a config with a different
+    rate gets its own limiter rather than the rate of the first caller.
+
+    Parameters:
+        name (str): Limiter name
+        rate (float): Requests per second
+        burst (int): Bucket size
+
+    Returns:
+        TokenBucket instance
+    '''
+    key = (name, float(rate), burst)
+    with _limiters_lock:
+        if key not in _limiters:
+            others = [ k[1] for k in _limiters if k[0] == name ]
+            if others:
+                logging.warning(f'Rate limit {name} of {rate}/s added to '
+                                f'existing limits {others}/s, the total '
+                                'request rate may exceed either')
+            _limiters[key] = TokenBucket(rate, burst)
+
+    return _limiters[key]
+
+
+def retry_after(response):
+    '''
+    Parse Retry-After header in seconds or HTTP date form
+
+    Returns:
+        Seconds to wait or None
+    '''
+    value = response.headers.get('Retry-After')
+    delay = None
+    if value:
+        try:
+            delay = max(0.0, float(value))
+        except ValueError:
+            try:
+                when = email.utils.parsedate_to_datetime(value)
+                delay = max(0.0, when.timestamp() - time.time())
+            except (TypeError, ValueError):
+                delay = None
+
+    return delay
+
+
+class Transport:
+    '''
+    HTTP transport with a sized connection pool, retries with
+    exponential backoff and jitter, optional rate limiting and
+    per request timeouts
+    '''
+    def __init__(self, pool_size=8, retries=3, backoff=0.5, max_backoff=30,
+                 timeout=(10, 300), limiter=None):
+        '''
+        Parameters:
+            pool_size (int): Connections kept per host, normally the
+                             number of concurrent requests
+            retries (int): Retries for connection errors and RETRY_CODES
+            backoff (float): Initial backoff in seconds
+            max_backoff (float): Maximum backoff in seconds
+            timeout (tuple/float): (connect, read) timeout in seconds
+            limiter (obj): Optional TokenBucket, may be shared
+        '''
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.limiter = limiter
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        self.mount(requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                 pool_maxsize=pool_size))
+
+        return
+
+
+    def mount(self, adapter):
+        '''
+        Use adapter for all http and https requests, e.g. to record or
+        replay API traffic beneath the retry and rate limit logic
+
+        Parameters:
+            adapter (obj): requests transport adapter
+        '''
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        return
+
+
+    def _delay(self, attempt, response=None):
+        # Honour Retry-After, otherwise exponential backoff, full jitter
+        delay = retry_after(response) if response is not None else None
+        if delay is None:
+            cap = min(self.max_backoff, self.backoff * (2 ** attempt))
+            delay = random.uniform(0, cap)
+
+        return min(delay, self.max_backoff)
+
+
+    def request(self, method, url, headers=None, data=None, stream=False):
+        '''
+        Make HTTP request
+
+        Parameters:
+            method (str): HTTP method
+            url (str): Full URL
+            headers (dict): Request headers
+            data (str): Request body
+            stream (bool): Do not read body on return
+
+        Returns:
+            requests response object, response.retries holds the number
+            of retries made
+
+        Raises:
+            requests.exceptions.RequestException once retries exhausted
+        '''
+        attempt = 0
+        while True:
+            if self.limiter:
+                self.limiter.acquire()
+            try:
+                response = self.session.request(method, url, headers=headers,
+                                                data=data, stream=stream,
+                                                timeout=self.timeout)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as err:
+                if attempt >= self.retries:
+                    raise
+                delay = self._delay(attempt)
+                logging.warning(f'{err}, retrying in {delay:.1f}s')
+            else:
+                if (response.status_code not in RETRY_CODES or
+                    attempt >= self.retries):
+                    response.retries = attempt
+                    return response
+                delay = self._delay(attempt, response)
+                logging.warning(f'HTTP {response.status_code} from {url}, '
+                                f'retrying in {delay:.1f}s')
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+
+    def close(self):
+        '''
+        Close pooled connections
+        '''
+        self.session.close()
+
+        return
+
+# End of class
@@ -0,0 +1,413 @@
+#!/usr/local/bin/python3
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+'''
+------------------------------------------------------------------------
+
+ Description:
+
+ End to end benchmark for the report pipeline
+
+ Runs each stage of the summary report (insight fetches, counts, graph,
+ template render and save, the full main() pipeline and a security hit
+ stream) against a synthetic CSP at one or more scales. Wall time, peak
+ RSS and API calls are reported per stage and can be saved as JSON and
+ compared with a previous run, e.g. from another commit.
+
+ Each scale runs in a separate process so that peak RSS is per scale.
+
+ Usage:
+    benchmarks/bench_pipeline.py -s small medium -o before.json
+    benchmarks/bench_pipeline.py -s small medium -o after.json \
+        --compare before.json
+
+ Date Last Updated: 20261017
+
+ Todo:
+
+ Copyright (c) 2022 Chris Marrison / Infoblox
+
+ Redistribution and use in source and binary forms,
+ with or without modification, are permitted provided
+ that the following conditions are met:
+
+ 1. Redistributions of source code must retain the above copyright
+ notice, this list of conditions and the following disclaimer.
+
+ 2. Redistributions in binary form must reproduce the above copyright
+ notice, this list of conditions and the following disclaimer in the
+ documentation and/or other materials provided with the distribution.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+ "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+ LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+ FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+ COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+ INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+ BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+ LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+ CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+ LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+ ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ POSSIBILITY OF SUCH DAMAGE.
+
+------------------------------------------------------------------------
+'''
+import argparse
+import contextlib
+import json
+import logging
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import synthetic
+
+__version__ = '0.0.1'
+__author__ = 'Chris Marrison'
+__author_email__ = 'chris@infoblox.com'
+
+INSIGHTS = [ 'dex', 'doh', 'malware', 'category', 'tclass', 'tproperty',
+             'hit_count' ]
+HIT_COLUMNS = [ 'feed_name', 'user', 'device_name' ]
+TEMPLATE = os.path.join(REPO, 'sample_B1TD_report_template.docx')
+
+
+def parseargs():
+    '''
+    Parse Arguments Using argparse
+
+    Parameters:
+        None
+
+    Returns:
+        Returns parsed arguments
+    '''
+    parse = argparse.ArgumentParser(description='Report pipeline benchmark')
+    parse.add_argument('-s', '--scales', nargs='+', default=[ 'small' ],
+                       choices=list(synthetic.SCALES.keys()),
+                       help="Scales to run (default small)")
+    parse.add_argument('-p', '--period', type=str, default='30d',
+                       help="Report period (default 30d)")
+    parse.add_argument('-w', '--workers', type=int, default=8,
+                       help="Maximum concurrent API requests (default 8)")
+    parse.add_argument('-l', '--latency', type=float, default=0,
+                       help="Seconds added per API call (default 0)")
+    parse.add_argument('-r', '--repeat', type=int, default=1,
+                       help="Runs per scale, median wall time is used")
+    parse.add_argument('--skip', nargs='+', default=[],
+                       help="Stages to skip, e.g. hits")
+    parse.add_argument('--tracemalloc', action='store_true',
+                       help="Also report Python heap peak per stage "
+                            "(slower)")
+    parse.add_argument('-o', '--output', type=str, default='',
+                       help="Write results as JSON")
+    parse.add_argument('-c', '--compare', type=str, default='',
+                       help="Compare with results JSON from a previous run")
+    parse.add_argument('--threshold', type=float, default=10,
+                       help="Regression threshold in percent (default 10)")
+    parse.add_argument('--min-ms', type=float, default=20,
+                       help="Ignore changes smaller than this (default 20)")
+    parse.add_argument('--run-scale', type=str, default='',
+                       help=argparse.SUPPRESS)
+
+    return parse.parse_args()
+
+
+def rss_mb():
+    '''
+    Peak resident set size of this process in MB
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak = peak / 1024
+
+    return round(peak / 1024, 1)
+
+
+class StageTimer:
+    '''
+    Record wall time, peak RSS and API calls for each stage
+    '''
+    def __init__(self, csp, heap=False):
+        self.csp = csp
+        self.heap = heap
+        self.stages = {}
+
+        return
+
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        calls = self.csp.calls
+        if self.heap:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        yield
+        result = { 'wall_ms': round((time.perf_counter() - start) * 1000, 1),
+                   'rss_peak_mb': rss_mb(),
+                   'api_calls': self.csp.calls - calls }
+        if self.heap:
+            result['heap_peak_mb'] = round(
+                tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+        self.stages[name] = result
+        logging.debug(f'{name}: {result}')
+
+        return
+
+
+def write_config(tmpdir, period):
+    '''
+    Write bloxone and report inifiles for the synthetic tenant
+    '''
+    b1ini = os.path.join(tmpdir, 'bloxone.ini')
+    with open(b1ini, 'w') as f:
+        f.write('[BloxOne]\n'
+                "url = 'https://csp.synthetic.invalid'\n"
+                "api_version = 'v1'\n"
+                "api_key = '" + '0' * 64 + "'\n")
+    report_ini = os.path.join(tmpdir, 'report.ini')
+    with open(report_ini, 'w') as f:
+        f.write('[B1TDC Report]\n'
+                f'b1inifile = {b1ini}\n'
+                'doc_title = Benchmark Report\n'
+                'customer = benchmark\n'
+                'contact = contact\n'
+                'contact_phone = phone\n'
+                'contact_email = email\n'
+                f'time_period = {period}\n'
+                'prepared_by = prepared by\n'
+                'prepared_email = prepared email\n')
+
+    return report_ini
+
+
+def run_scale(scale, period, workers, latency, skip=(), heap=False):
+    '''
+    Run all stages at one scale in this process
+
+    Returns:
+        dict of stage results
+    '''
+    import b1replay
+    import b1td_summary_report as report
+
+    csp = synthetic.SyntheticCSP(scale, latency=latency)
+    timer = StageTimer(csp, heap=heap)
+    if heap:
+        tracemalloc.start()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        report_ini = write_config(tmpdir, period)
+        config = report.read_ini(report_ini)
+        # Transports are shared per process, so main() uses this one
+        transport = report.open_transport(config, workers)
+        b1replay.replay(transport, csp)
+
+        with timer.stage('imports'):
+            import b1charts
+            import b1reporting
+            import b1template
+            import docxtpl
+
+        with timer.stage('client'):
+            b1r = report.get_client(config['b1inifile'], transport=transport)
+            b1r.max_workers = workers
+
+        responses = {}
+        for insight in INSIGHTS:
+            with timer.stage(f'fetch_{insight}'):
+                responses[insight] = b1r.get_insight(insight, period)
+                responses[insight].json()
+
+        with timer.stage('get_counts'):
+            counts = b1r.get_counts(period, response=responses['tclass'])
+        with timer.stage('get_total_hits'):
+            total = b1r.get_total_hits(period,
+                                       response=responses['hit_count'])
+
+        with timer.stage('graph'):
+            image = report.generate_graph(b1r, period,
+                                          response=responses['tproperty'])
+
+        with timer.stage('render'):
+            doc_data = report.build_doc_data(config)
+            doc_data.update({ 'data_' + i: responses[i].json()
+                              for i in [ 'dex', 'doh', 'malware',
+                                         'category' ] })
+            doc_data.update(counts)
+            doc_data['total_events'] = total
+            doc = b1template.get_template(TEMPLATE)
+            doc_data['myimage'] = docxtpl.InlineImage(doc,
+                                                      image_descriptor=image)
+            doc.render(doc_data)
+            doc.save(os.path.join(tmpdir, 'render.docx'))
+
+        if 'main' not in skip:
+            argv = sys.argv
+            cwd = os.getcwd()
+            sys.argv = [ 'b1td_summary_report.py', '-c', report_ini,
+                         '-t', TEMPLATE, '-w', str(workers) ]
+            os.chdir(tmpdir)
+            try:
+                with timer.stage('main'):
+                    report.main()
+            finally:
+                sys.argv = argv
+                os.chdir(cwd)
+
+        if 'hits' not in skip:
+            with timer.stage('hits'):
+                b1r.aggregate_hits(period, HIT_COLUMNS)
+
+    return timer.stages
+
+
+def run_child(scale, args):
+    '''
+    Run one scale in a new process
+
+    Returns:
+        dict of stage results
+    '''
+    cmd = [ sys.executable, os.path.abspath(__file__), '--run-scale', scale,
+            '-p', args.period, '-w', str(args.workers),
+            '-l', str(args.latency) ]
+    if args.skip:
+        cmd += [ '--skip' ] + args.skip
+    if args.tracemalloc:
+        cmd.append('--tracemalloc')
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode:
+        sys.stderr.write(result.stderr)
+        raise RuntimeError(f'Scale {scale} failed')
+
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def merge_runs(runs):
+    '''
+    Median wall time and maximum RSS/heap of repeated runs
+    '''
+    merged = {}
+    for stage in runs[0]:
+        merged[stage] = dict(runs[0][stage])
+        merged[stage]['wall_ms'] = round(statistics.median(
+                                      [ r[stage]['wall_ms'] for r in runs ]), 1)
+        for key in [ 'rss_peak_mb', 'heap_peak_mb' ]:
+            if key in runs[0][stage]:
+                merged[stage][key] = max([ r[stage][key] for r in runs ])
+
+    return merged
+
+
+def git_commit():
+    '''
+    Current commit of the repository, if available
+    '''
+    try:
+        result = subprocess.run([ 'git', 'rev-parse', '--short', 'HEAD' ],
+                                cwd=REPO, capture_output=True, text=True)
+        commit = result.stdout.strip()
+    except OSError:
+        commit = ''
+
+    return commit
+
+
+def print_results(results):
+    '''
+    Print stage table for each scale
+    '''
+    for scale, stages in results['scales'].items():
+        print(f'\nScale: {scale} {synthetic.SCALES[scale]}')
+        print(f"{'Stage':<20} {'Wall ms':>10} {'RSS MB':>8} {'Calls':>6}")
+        for name, stage in stages.items():
+            print(f"{name:<20} {stage['wall_ms']:>10.1f} "
+                  f"{stage['rss_peak_mb']:>8.1f} {stage['api_calls']:>6}")
+
+    return
+
+
+def compare(results, baseline, threshold, min_ms):
+    '''
+    Print wall time change per stage against a baseline
+
+    Returns:
+        Number of stages slower than threshold percent
+    '''
+    regressions = 0
+    print(f"\nCompared with {baseline.get('commit') or 'baseline'}")
+    print(f"{'Scale':<8} {'Stage':<20} {'Before':>10} {'After':>10} "
+          f"{'Change':>8}")
+    for scale, stages in results['scales'].items():
+        for name, stage in stages.items():
+            before = baseline.get('scales', {}).get(scale, {}).get(name)
+            if not before:
+                continue
+            old = before['wall_ms']
+            new = stage['wall_ms']
+            change = (new - old) / old * 100 if old else 0
+            flag = ''
+            if change > threshold and new - old > min_ms:
+                flag = ' SLOWER'
+                regressions += 1
+            elif change < -threshold and old - new > min_ms:
+                flag = ' faster'
+            print(f'{scale:<8} {name:<20} {old:>10.1f} {new:>10.1f} '
+                  f'{change:>+7.1f}%{flag}')
+
+    return regressions
+
+
+def main():
+    '''
+    Core Logic
+    '''
+    exitcode = 0
+    args = parseargs()
+
+    if args.run_scale:
+        logging.basicConfig(level=logging.WARNING)
+        stages = run_scale(args.run_scale, args.period, args.workers,
+                           args.latency, skip=args.skip,
+                           heap=args.tracemalloc)
+        print(json.dumps(stages))
+        return exitcode
+
+    results = { 'commit': git_commit(),
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': sys.version.split()[0],
+                'period': args.period,
+                'workers': args.workers,
+                'latency': args.latency,
+                'scales': {} }
+    for scale in args.scales:
+        runs = [ run_child(scale, args) for _ in range(args.repeat) ]
+        results['scales'][scale] = merge_runs(runs)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold, args.min_ms):
+            exitcode = 1
+
+    return exitcode
+
+
+### Main ###
+if __name__ == '__main__':
+    exitcode = main()
+    exit(exitcode)
+## End Main ###
@@ -0,0 +1,172 @@
+#!/usr/local/bin/python3
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+'''
+------------------------------------------------------------------------
+
+ Description:
+
+ Document render benchmark
+
+ Renders the report template N times with synthetic data, once creating
+ a new docxtpl template per document (the previous behaviour) and once
+ through the b1template cache, and reports the time per document.
+
+ Usage:
+    benchmarks/bench_render.py
+    benchmarks/bench_render.py --docs 50 --size 50 --output render.json
+
+ Date Last Updated: 20261017
+
+ Todo:
+
+ Copyright (c) 2022 Chris Marrison / Infoblox
+
+ Redistribution and use in source and binary forms,
+ with or without modification, are permitted provided
+ that the following conditions are met:
+
+ 1. Redistributions of source code must retain the above copyright
+ notice, this list of conditions and the following disclaimer.
+
+ 2. Redistributions in binary form must reproduce the above copyright
+ notice, this list of conditions and the following disclaimer in the
+ documentation and/or other materials provided with the distribution.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+ "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+ LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+ FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+ COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+ INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+ BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+ LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+ CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+ LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+ ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ POSSIBILITY OF SUCH DAMAGE.
+
+------------------------------------------------------------------------
+'''
+import argparse
+import io
+import json
+import os
+import statistics
+import sys
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import b1charts
+import b1reporting
+import b1template
+import docxtpl
+import synthetic
+
+__version__ = '0.0.1'
+__author__ = 'Chris Marrison'
+__author_email__ = 'chris@infoblox.com'
+
+
+def parseargs():
+    '''
+    Parse Arguments Using argparse
+
+    Parameters:
+        None
+
+    Returns:
+        Returns parsed arguments
+    '''
+    parse = argparse.ArgumentParser(description='Document render benchmark')
+    parse.add_argument('-n', '--docs', type=int, default=20,
+                       help="Documents rendered per method (default 20)")
+    parse.add_argument('-t', '--template', type=str,
+                       default=os.path.join(REPO,
+                                            'sample_B1TD_report_template.docx'),
+                       help="docx template")
+    parse.add_argument('-s', '--size', type=int, default=10,
+                       help="Buckets per insight aggregation (default 10)")
+    parse.add_argument('-o', '--output', type=str, default='',
+                       help="Write results as JSON")
+
+    return parse.parse_args()
+
+
+def report_context(size, seed=0):
+    '''
+    Synthetic template data for one report
+    '''
+    context = { 'doc_title': 'BloxOne Threat Defense Summary Report',
+                'customer': f'customer {seed}',
+                'contact': 'contact',
+                'contact_phone': 'phone',
+                'contact_email': 'email',
+                'prepared_by': 'prepared by',
+                'prepared_email': 'prepared email',
+                'iso_date': '2022-01-01',
+                'total_dex_count': 1234,
+                'total_mal_count': 5678,
+                'total_events': 123456 }
+    for insight in [ 'dex', 'doh', 'malware', 'category' ]:
+        context['data_' + insight] = synthetic.insight_data(
+                                        b1reporting.INSIGHTS[insight],
+                                        size=size, seed=seed)
+
+    return context
+
+
+def render(doc, context, image):
+    '''
+    Render and save one document in memory, returns elapsed ms
+    '''
+    start = time.perf_counter()
+    data = dict(context)
+    data['myimage'] = docxtpl.InlineImage(doc,
+                                          image_descriptor=io.BytesIO(image))
+    doc.render(data)
+    doc.save(io.BytesIO())
+
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    '''
+    Core Logic
+    '''
+    args = parseargs()
+    image = b1charts.barh_chart([ 'a', 'b', 'c' ], [ 1, 10, 100 ],
+                                log=True).getvalue()
+    contexts = [ report_context(args.size, seed=n) for n in range(args.docs) ]
+
+    uncached = [ render(docxtpl.DocxTemplate(args.template), c, image)
+                 for c in contexts ]
+    cache = b1template.TemplateCache()
+    cached = [ render(cache.get(args.template), c, image) for c in contexts ]
+
+    results = { 'docs': args.docs,
+                'size': args.size,
+                'uncached_ms': round(statistics.median(uncached), 1),
+                'cached_first_ms': round(cached[0], 1),
+                'cached_ms': round(statistics.median(cached[1:] or cached), 1),
+                'uncached_total_ms': round(sum(uncached), 1),
+                'cached_total_ms': round(sum(cached), 1),
+                'template_loads': cache.misses }
+    results['speedup'] = round(results['uncached_total_ms'] /
+                               results['cached_total_ms'], 2)
+    for key, value in results.items():
+        print(f'{key:<20} {value}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    return 0
+
+
+### Main ###
+if __name__ == '__main__':
+    exitcode = main()
+    exit(exitcode)
+## End Main ###
@@ -0,0 +1,163 @@
+#!/usr/local/bin/python3
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+'''
+------------------------------------------------------------------------
+
+ Description:
+
+ Start up benchmark for the report CLI
+
+ Measures the median wall time of the CLI --help and of importing the
+ report modules, less the time to start the interpreter, and checks
+ that heavy dependencies are not imported at start up. Exits 1 if the
+ budget in startup_budget.json is exceeded.
+
+ Usage:
+    benchmarks/bench_startup.py
+    benchmarks/bench_startup.py --runs 20 --output startup.json
+
+ Date Last Updated: 20261017
+
+ Todo:
+
+ Copyright (c) 2022 Chris Marrison / Infoblox
+
+ Redistribution and use in source and binary forms,
+ with or without modification, are permitted provided
+ that the following conditions are met:
+
+ 1. Redistributions of source code must retain the above copyright
+ notice, this list of conditions and the following disclaimer.
+
+ 2. Redistributions in binary form must reproduce the above copyright
+ notice, this list of conditions and the following disclaimer in the
+ documentation and/or other materials provided with the distribution.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+ "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+ LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+ FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+ COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+ INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+ BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+ LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+ CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+ LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+ ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ POSSIBILITY OF SUCH DAMAGE.
+
+------------------------------------------------------------------------
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+__version__ = '0.0.1'
+__author__ = 'Chris Marrison'
+__author_email__ = 'chris@infoblox.com'
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUDGET = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'startup_budget.json')
+
+
+def parseargs():
+    '''
+    Parse Arguments Using argparse
+
+    Parameters:
+        None
+
+    Returns:
+        Returns parsed arguments
+    '''
+    parse = argparse.ArgumentParser(description='CLI start up benchmark')
+    parse.add_argument('-r', '--runs', type=int, default=10,
+                       help="Runs per measurement (default 10)")
+    parse.add_argument('-b', '--budget', type=str, default=BUDGET,
+                       help="Budget file")
+    parse.add_argument('-o', '--output', type=str, default='',
+                       help="Write results as JSON")
+
+    return parse.parse_args()
+
+
+def median_ms(cmd, runs):
+    '''
+    Median wall time of a command in milliseconds
+    '''
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, cwd=REPO, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, check=True)
+        times.append((time.perf_counter() - start) * 1000)
+
+    return statistics.median(times)
+
+
+def loaded_modules(modules, candidates):
+    '''
+    Return candidate modules loaded after importing modules
+    '''
+    code = ('import sys\n' +
+            ''.join([ f'import {m}\n' for m in modules ]) +
+            f'print(" ".join([ m for m in {candidates!r} '
+            'if m in sys.modules ]))')
+    result = subprocess.run([ sys.executable, '-c', code ], cwd=REPO,
+                            capture_output=True, text=True, check=True)
+
+    return result.stdout.split()
+
+
+def main():
+    '''
+    Core Logic
+    '''
+    exitcode = 0
+    args = parseargs()
+    with open(args.budget) as f:
+        budget = json.load(f)
+
+    python = median_ms([ sys.executable, '-c', 'pass' ], args.runs)
+    help_ms = median_ms([ sys.executable, 'b1td_summary_report.py',
+                          '--help' ], args.runs)
+    import_ms = median_ms([ sys.executable, '-c',
+                            'import b1td_summary_report, b1td_batch_report' ],
+                          args.runs)
+    heavy = loaded_modules([ 'b1td_summary_report', 'b1td_batch_report' ],
+                           budget.get('forbidden_modules', []))
+
+    results = { 'python_ms': round(python, 1),
+                'help_overhead_ms': round(help_ms - python, 1),
+                'import_overhead_ms': round(import_ms - python, 1),
+                'heavy_modules_at_startup': heavy }
+    for key, value in results.items():
+        print(f'{key:<26} {value}')
+
+    for key in [ 'help_overhead_ms', 'import_overhead_ms' ]:
+        if key in budget and results[key] > budget[key]:
+            print(f'FAIL: {key} {results[key]} exceeds budget {budget[key]}')
+            exitcode = 1
+    if heavy:
+        print(f'FAIL: heavy modules imported at start up: {heavy}')
+        exitcode = 1
+    if not exitcode:
+        print('Start up within budget')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    return exitcode
+
+
+### Main ###
+if __name__ == '__main__':
+    exitcode = main()
+    exit(exitcode)
+## End Main ###
@@ -0,0 +1,215 @@
+#!/usr/local/bin/python3
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+'''
+------------------------------------------------------------------------
+
+ Description:
+
+ Synthetic API data for benchmarks
+
+ Generates insight responses and security hit pages in the same form as
+ the B1TD API, at a range of scales, so that benchmarks run without a
+ tenant.
+
+ Date Last Updated: 20261017
+
+ Todo:
+
+ Copyright (c) 2022 Chris Marrison / Infoblox
+
+ Redistribution and use in source and binary forms,
+ with or without modification, are permitted provided
+ that the following conditions are met:
+
+ 1. Redistributions of source code must retain the above copyright
+ notice, this list of conditions and the following disclaimer.
+
+ 2. Redistributions in binary form must reproduce the above copyright
+ notice, this list of conditions and the following disclaimer in the
+ documentation and/or other materials provided with the distribution.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+ "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+ LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+ FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+ COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+ INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+ BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+ LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+ CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+ LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+ ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ POSSIBILITY OF SUCH DAMAGE.
+
+------------------------------------------------------------------------
+'''
+import json
+import random
+import threading
+import time
+import urllib.parse
+
+__version__ = '0.0.1'
+__author__ = 'Chris Marrison'
+__author_email__ = 'chris@infoblox.com'
+
+THREAT_CLASSES = [ 'Malware C2', 'Data Exfiltration', 'Phishing',
+                   'Malware DGA', 'Suspicious', 'TI-IID' ]
+
+
+def bucket_key(key, i):
+    '''
+    Synthetic bucket key for aggregation key
+    '''
+    if key == 'tclass':
+        name = THREAT_CLASSES[i % len(THREAT_CLASSES)]
+        value = name if i < len(THREAT_CLASSES) else f'{name} {i}'
+    else:
+        value = f'{key}-{i}'
+
+    return value
+
+
+def insight_data(spec, size=10, sub_size=3, seed=0):
+    '''
+    Synthetic insight response data for an insight spec
+
+    Parameters:
+        spec (dict): Insight spec from b1reporting.INSIGHTS
+        size (int): Buckets per aggregation
+        sub_size (int): Buckets per sub key
+        seed (int): Random seed
+
+    Returns:
+        dict of form { 'results': [ ... ] }, one result per agg
+    '''
+    rand = random.Random(seed)
+    results = []
+    for agg in spec.get('aggs', []):
+        buckets = []
+        for i in range(min(size, spec.get('size', size))):
+            bucket = { 'key': bucket_key(agg['key'], i),
+                       'count': str(rand.randint(1, 100000)) }
+            if 'sub_key' in agg:
+                bucket['sub_bucket'] = [
+                    { 'key': sub['key'],
+                      'sub_bucket': [ { 'key': bucket_key(sub['key'], j),
+                                        'count': str(rand.randint(1, 1000)) }
+                                      for j in range(sub_size) ] }
+                    for sub in agg['sub_key'] ]
+            buckets.append(bucket)
+        results.append({ 'key': agg['key'], 'sub_bucket': buckets })
+
+    return { 'results': results }
+
+
+# Benchmark scales, buckets per insight aggregation, values per sub key,
+# buckets in the dex aggregation and total security hits
+SCALES = {
+    'small': { 'buckets': 10, 'sub_buckets': 3, 'dex_buckets': 100,
+               'hits': 10000 },
+    'medium': { 'buckets': 100, 'sub_buckets': 10, 'dex_buckets': 1000,
+                'hits': 100000 },
+    'large': { 'buckets': 1000, 'sub_buckets': 25, 'dex_buckets': 10000,
+               'hits': 1000000 },
+}
+
+# Aggregation keys with few distinct values
+SMALL_KEYS = { 'type': 4, 'policy_action': 3, 'severity': 4 }
+
+
+def hit_record(n):
+    '''
+    Synthetic security hit record n
+    '''
+    return { 'event_time': 1640995200 + n,
+             'qname': f'host{n % 50000}.example{n % 997}.com.',
+             'feed_name': f'feed-{n % 37}',
+             'user': f'user-{n % 1013}',
+             'device_name': f'device-{n % 2003}',
+             'network': f'network-{n % 11}',
+             'tclass': THREAT_CLASSES[n % len(THREAT_CLASSES)],
+             'tproperty': f'tproperty-{n % 29}',
+             'policy_action': [ 'Log', 'Block', 'Redirect' ][n % 3],
+             'severity': [ 'High', 'Medium', 'Low', 'Info' ][n % 4],
+             'type': str(2 + n % 3) }
+
+
+class SyntheticCSP:
+    '''
+    Stand in for the CSP API generating responses at a given scale
+
+    Implements the Replayer interface so it can be mounted on a
+    b1transport.Transport with b1replay.replay(), or served with
+    b1replay.serve().
+    '''
+    def __init__(self, scale='small', latency=0.0):
+        '''
+        Parameters:
+            scale (str/dict): Name in SCALES or scale dict
+            latency (float): Seconds added to every response
+        '''
+        self.scale = SCALES[scale] if isinstance(scale, str) else scale
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+        return
+
+
+    def insight(self, url, body):
+        '''
+        Synthetic aggregation response for a request body
+        '''
+        if url.endswith('/aggregations'):
+            size = self.scale['dex_buckets']
+        else:
+            size = self.scale['buckets']
+        results = []
+        for n, agg in enumerate(body.get('aggs', [])):
+            count = min(size, body.get('size', size),
+                        SMALL_KEYS.get(agg['key'], size))
+            spec = { 'aggs': [ agg ], 'size': count }
+            results.extend(insight_data(spec, size=count,
+                                        sub_size=self.scale['sub_buckets'],
+                                        seed=n)['results'])
+
+        return { 'results': results }
+
+
+    def hits(self, query):
+        '''
+        Synthetic page of security hits for _offset and _limit
+        '''
+        offset = int(query.get('_offset', 0))
+        limit = int(query.get('_limit', 1000))
+        end = min(offset + limit, self.scale['hits'])
+
+        return { 'success': { 'size': max(0, end - offset) },
+                 'result': [ hit_record(n) for n in range(offset, end) ] }
+
+
+    def respond(self, method, url, body=None):
+        '''
+        Get the response for a request
+
+        Returns:
+            Tuple of (status (int), headers (dict), content (bytes))
+        '''
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        parts = urllib.parse.urlsplit(url)
+        if parts.path.endswith('/hits'):
+            data = self.hits(dict(urllib.parse.parse_qsl(parts.query)))
+        elif body:
+            data = self.insight(parts.path, json.loads(body))
+        else:
+            data = { 'results': [] }
+
+        return (200, { 'Content-Type': 'application/json' },
+                json.dumps(data).encode())
+
+# End of class